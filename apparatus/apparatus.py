@@ -1,11 +1,17 @@
 import logging
 import time
 
+import RPi.GPIO as GPIO
+
 from apparatus.apparatus_config import config
 from apparatus.apparatus_interface import ApparatusInterface
+from apparatus.calibration import load_calibration, save_calibration
 from apparatus.carousel import Carousel
+from apparatus.i2c_bus import I2CBus
 from apparatus.ledout import COLORS, LedOut
 from apparatus.lever import Lever
+from apparatus.stepgen import StepGenerator
+from apparatus.timer_service import TimerService
 
 
 class Apparatus(ApparatusInterface):
@@ -18,6 +24,13 @@ class Apparatus(ApparatusInterface):
     def __init__(self):
         """ class init
         """
+        # both carousels are stepped from one timing loop
+        self.step_generator = StepGenerator(GPIO.output, name="Apparatus-steps")
+        backend = None
+        if config.apparatus.get('stepper_backend', 'gpio') == 'pigpio':
+            from apparatus.waveform import PigpioBackend
+            backend = PigpioBackend()
+
         self.carousel1 = Carousel(
             config.carousel1['stepper_step'],
             config.carousel1['stepper_dir'],
@@ -31,6 +44,20 @@ class Apparatus(ApparatusInterface):
             config.carousel1['servo_timeout'],
             config.carousel1['nema_timeout'],
             config.carousel1['sensorless'],
+            max_velocity=config.carousel1.get('max_velocity'),
+            max_accel=config.carousel1.get('max_accel'),
+            max_jerk=config.carousel1.get('max_jerk'),
+            start_velocity=config.carousel1.get('start_velocity'),
+            closed_loop=config.carousel1.get('closed_loop', False),
+            step_generator=self.step_generator,
+            backend=backend,
+            mode_pins=config.carousel1.get('stepper_mode_pins'),
+            microsteps=config.carousel1.get('microsteps', Carousel.MICROSTEPS),
+            cruise_microsteps=config.carousel1.get('cruise_microsteps'),
+            encoder_sample_rate=config.carousel1.get('encoder_sample_rate', 0),
+            door_velocity=config.carousel1.get('door_velocity'),
+            door_speed=config.carousel1.get('door_speed'),
+            door_latency=config.carousel1.get('door_latency'),
         )
 
         self.carousel2 = Carousel(
@@ -46,6 +73,20 @@ class Apparatus(ApparatusInterface):
             config.carousel2['servo_timeout'],
             config.carousel2['nema_timeout'],
             config.carousel2['sensorless'],
+            max_velocity=config.carousel2.get('max_velocity'),
+            max_accel=config.carousel2.get('max_accel'),
+            max_jerk=config.carousel2.get('max_jerk'),
+            start_velocity=config.carousel2.get('start_velocity'),
+            closed_loop=config.carousel2.get('closed_loop', False),
+            step_generator=self.step_generator,
+            backend=backend,
+            mode_pins=config.carousel2.get('stepper_mode_pins'),
+            microsteps=config.carousel2.get('microsteps', Carousel.MICROSTEPS),
+            cruise_microsteps=config.carousel2.get('cruise_microsteps'),
+            encoder_sample_rate=config.carousel2.get('encoder_sample_rate', 0),
+            door_velocity=config.carousel2.get('door_velocity'),
+            door_speed=config.carousel2.get('door_speed'),
+            door_latency=config.carousel2.get('door_latency'),
         )
 
         NUM_LED = config.led_strip['count']
@@ -67,6 +108,9 @@ class Apparatus(ApparatusInterface):
             config.lever['lock_servo_range'],
             config.lever['servo_timeout'],
             self._io_callback,
+            servo_velocity=config.lever.get('lock_velocity'),
+            servo_speed=config.lever.get('lock_speed'),
+            servo_latency=config.lever.get('lock_latency'),
         )
 
         # self.pcb_led = Servo(config.pcb_led['led_servo_id'], config.pcb_led['led_servo_range'])
@@ -74,13 +118,20 @@ class Apparatus(ApparatusInterface):
 
         self.carousel = (self.carousel1, self.carousel2)
 
+        # per rig compartment angles, see calibrate
+        self.calibration_file = config.apparatus.get('calibration_file')
+        calibrations = load_calibration(self.calibration_file)
+        for name, carousel in zip(("carousel1", "carousel2"), self.carousel):
+            if name in calibrations:
+                carousel.apply_calibration(calibrations[name])
+
     def set_io_callback(self, callback):
         self.lever.io_callback = callback
 
     def set_wait_callback(self, callback):
         self.wait_callback = callback
 
-    def _io_callback(self, pin_io, name, state):
+    def _io_callback(self, pin_io, name, state, timestamp=None, status=None):
         logging.debug("GOT IO")
         pass
 
@@ -99,6 +150,25 @@ class Apparatus(ApparatusInterface):
         # clean up gpio last
         # GPIO.cleanup()
 
+    def calibrate(self):
+        """ sweeps both carousels and writes the calibration file of the rig """
+        commands = [carousel.calibrate(blocking=False) for carousel in self.carousel
+                    if not carousel.sensorless]
+        for command in commands:
+            command.wait()
+        calibrations = {}
+        for name, carousel in zip(("carousel1", "carousel2"), self.carousel):
+            if carousel.calibration is not None:
+                calibrations[name] = carousel.calibration
+        for command in commands:
+            if command.error is not None:
+                raise command.error
+        if self.calibration_file:
+            save_calibration(self.calibration_file, calibrations)
+            logging.info("Calibration written to %s" %
+                         self.calibration_file)
+        return calibrations
+
     def motors_off(self):
         self.carousel[0].motors_off()
         self.carousel[1].motors_off()
@@ -110,19 +180,26 @@ class Apparatus(ApparatusInterface):
         self.ledout.humanlight = True
         self.ledout.testlight = False
 
-        logging.info("Initialise Carousel 1")
+        # the servo ticker writes all doors of a tick in one batch
         self.carousel1.servo_human.door_open = False
         self.carousel1.servo_monkey.door_open = False
+        self.carousel2.servo_human.door_open = False
+        self.carousel2.servo_monkey.door_open = False
+
+        logging.info("Initialise Carousel 1")
         self.carousel1.move_to(0, monkey=True, blocking=False)
 
         logging.info("Initialise Carousel 2")
-        self.carousel2.servo_human.door_open = False
-        self.carousel2.servo_monkey.door_open = False
         self.carousel2.move_to(0, monkey=True, blocking=False)
         self.carousel1.move_to_wait()
 
         logging.info("Wait for Carousel 1 to reach target")
         self.carousel2.move_to_wait()
+        logging.info("Stepper jitter: %s" % self.step_generator.jitter_report())
+        logging.info("Carousel 1 power: %s" % self.carousel1.motor.power.report())
+        logging.info("Carousel 2 power: %s" % self.carousel2.motor.power.report())
+        logging.info("I2C bus:\n%s" % I2CBus.get().report())
+        logging.info("Timers: %s" % TimerService.get().report())
 
         logging.info("Initialise Lever")
         self.lever.lever_open = False
@@ -171,21 +248,28 @@ class Apparatus(ApparatusInterface):
         pass
 
     def move_to(self, carousel_id, compartment_id, monkey=False, blocking=False):
-        self.carousel[carousel_id].move_to(compartment_id,
-                                           monkey,
-                                           callback=lambda: self._wait_callback(carousel_id, "move_to"))
-        pass
+        return self.carousel[carousel_id].move_to(compartment_id,
+                                                  monkey,
+                                                  blocking,
+                                                  callback=lambda: self._wait_callback(carousel_id, "move_to"))
 
     def move_to_wait(self, carousel_id):
-        logging.warn("move_to_wait not implemented")
+        self.carousel[carousel_id].move_to_wait()
 
     def deploy(self, carousel_id, compartment_id, monkey=False, blocking=False):
-        self.carousel[carousel_id].deploy(compartment_id,
-                                          monkey,
-                                          callback=lambda: self._wait_callback(carousel_id, "move_to"))
+        return self.carousel[carousel_id].deploy(compartment_id,
+                                                 monkey,
+                                                 blocking,
+                                                 callback=lambda: self._wait_callback(carousel_id, "move_to"))
 
     def deploy_wait(self, carousel_id):
-        logging.warn("deploy_wait not implemented")
+        self.carousel[carousel_id].move_to_wait()
+
+    def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False) -> float:
+        return self.carousel[carousel_id].estimate_move(compartment_id, monkey, deploy)
+
+    def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        self.carousel[carousel_id].prepare_move(compartment_id, monkey)
 
     def set_test_light(self, state, color=None, timestamp=None):
         if color is not None:
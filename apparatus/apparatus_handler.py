@@ -1,12 +1,15 @@
+import inspect
 import logging
-import pickle
 import threading
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from apparatus.apparatus import Apparatus
 from apparatus.apparatus_config import config
 from apparatus.apparatus_interface import ApparatusInterface
+from apparatus.command_executor import CommandExecutor
+from apparatus.lever import ButtonHandler
+from apparatus.rpc import BATCH_COMMANDS
 from apparatus.server import Handler
 
 
@@ -32,10 +35,8 @@ class ApparatusServerHandler(ApparatusInterface):
     def _send_dict(self, dict):
         if self.closed:
             return
-        data: bytes = pickle.dumps(dict)
-        msg: bytes = len(data).to_bytes(
-            self._HEADERSIZE, "little", signed=False)+data
-        self._socket.send(msg)
+        # framed and encoded with the negotiated codec
+        self.server.send_dict(dict)
 
     def _async_send(self, stop_thread):
         while True:
@@ -69,24 +70,24 @@ class ApparatusServerHandler(ApparatusInterface):
                          'LEVER_SWITCH_UP_IO',
                          self.apparatus.lever.get_switch_up_io_state(), forced=True)
 
-    def io_callback(self, pin_io, name, state, forced=False):
+    def io_callback(self, pin_io, name, state, timestamp=None, status=None, forced=False):
+        """ sends the debounced lever inputs, see lever.ButtonHandler: an
+        io_event for every change of the state, with the time of the edge, and
+        an io_confirm_event once the level of an edge held or was retracted """
+        if timestamp is None:
+            timestamp = datetime.now()
+        if status in (ButtonHandler.CONFIRM, ButtonHandler.RETRACT):
+            self.server.send_dict(
+                {"type": "io_confirm_event", "pin_io": pin_io, "name": name, "state": state, "timestamp": timestamp, "confirmed": status == ButtonHandler.CONFIRM})
+            if status == ButtonHandler.CONFIRM:
+                return
+
         if "%s_%d" % (name, pin_io) not in self.io_last_state:
             self.io_last_state["%s_%d" % (name, pin_io)] = state
             old_state = not state
         else:
             old_state = self.io_last_state["%s_%d" % (name, pin_io)]
 
-        timestamp = datetime.now()
-        if pin_io == config.lever['touch_io']:
-            timestamp -= timedelta(
-                milliseconds=config.lever['touch_io_bounce_time'])
-        if pin_io == config.lever['switch_io']:
-            timestamp -= timedelta(
-                milliseconds=config.lever['switch_io_bounce_time'])
-        if pin_io == config.lever['switch_up_io']:
-            timestamp -= timedelta(
-                milliseconds=config.lever['switch_up_io_bounce_time'])
-
         if forced or state != old_state:
             self.io_last_state["%s_%d" % (name, pin_io)] = state
             self.server.send_dict(
@@ -97,6 +98,8 @@ class ApparatusServerHandler(ApparatusInterface):
             {"type": "wait_event", "carousel_id": carousel_id, "func_name": func_name})
 
     def close(self):
+        logging.info("Scheduled commands: %s" %
+                     CommandExecutor.get().report())
         self._stop_async_send_thread = True
         self.closed = True
         self.thread.join()
@@ -109,36 +112,46 @@ class ApparatusServerHandler(ApparatusInterface):
     def hw_self_test(self):
         self.apparatus.hw_self_test()
 
+    # commands that finish later return their handle, the server replies
+    # once it is done, see Handler.process_command
+
     def play_sound(self, file="on-status.mp3", volume=90, timestamp=None):
         if timestamp is not None:
-            delay = (timestamp - datetime.now()).total_seconds()
-            threading.Timer(delay, self.apparatus.play_sound,
-                            args=(file, volume,)).start()
-            return
+            return CommandExecutor.get().submit_at(
+                timestamp, self.apparatus.play_sound, file, volume)
         self.apparatus.play_sound(file, volume)
 
     def empty_human(self):
         self.apparatus.empty_human()
 
     def move_to(self, carousel_id, compartment_id, monkey=False, blocking=False):
-        self.apparatus.move_to(carousel_id, compartment_id, monkey, blocking)
+        # never block the connection, the reply is sent when the move is done
+        return self.apparatus.move_to(carousel_id, compartment_id, monkey, False)
 
     def move_to_wait(self, carousel_id):
-        self.apparatus.move_to_wait(carousel_id)
+        # the client waits for the reply of move_to, the connection never blocks
+        pass
 
     def deploy(self, carousel_id, compartment_id, monkey=False, blocking=False):
-        self.apparatus.deploy(carousel_id, compartment_id,
-                              monkey, blocking)
+        return self.apparatus.deploy(carousel_id, compartment_id,
+                                     monkey, False)
 
     def deploy_wait(self, carousel_id):
-        self.apparatus.deploy_wait(carousel_id)
+        # the client waits for the reply of deploy, the connection never blocks
+        pass
+
+    def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False) -> float:
+        # the duration is the result of the reply
+        return self.apparatus.estimate_move(
+            carousel_id, compartment_id, monkey, deploy)
+
+    def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        self.apparatus.prepare_move(carousel_id, compartment_id, monkey)
 
     def set_test_light(self, state, color=None, timestamp=None):
         if timestamp is not None:
-            delay = (timestamp - datetime.now()).total_seconds()
-            threading.Timer(delay, self.apparatus.set_test_light,
-                            args=(state, color,)).start()
-            return
+            return CommandExecutor.get().submit_at(
+                timestamp, self.apparatus.set_test_light, state, color)
         self.apparatus.set_test_light(state, color)
 
     def set_human_light(self, state, color=None):
@@ -146,10 +159,8 @@ class ApparatusServerHandler(ApparatusInterface):
 
     def set_light(self, color, timestamp=None):
         if timestamp is not None:
-            delay = (timestamp - datetime.now()).total_seconds()
-            threading.Timer(delay, self.apparatus.set_light,
-                            args=(color,)).start()
-            return
+            return CommandExecutor.get().submit_at(
+                timestamp, self.apparatus.set_light, color)
         self.apparatus.set_light(color)
 
     def wait_lever_state(self, pin_io, state, timeout=-1, spinlock=False) -> bool:
@@ -159,8 +170,49 @@ class ApparatusServerHandler(ApparatusInterface):
 
     def set_lever_open(self, state, timestamp=None):
         if timestamp is not None:
-            delay = (timestamp - datetime.now()).total_seconds()
-            threading.Timer(delay, self.apparatus.set_lever_open,
-                            args=(state,)).start()
-            return
+            return CommandExecutor.get().submit_at(
+                timestamp, self.apparatus.set_lever_open, state)
         self.apparatus.set_lever_open(state)
+
+    def batch(self, commands, timestamp=None):
+        """Runs several commands back to back, at timestamp as one command of
+        the CommandExecutor. All commands are checked before any of them runs.
+
+        Args:
+            commands (list): {"func", "args"} of commands in BATCH_COMMANDS, their timestamps are ignored
+            timestamp (datetime, optional): A future timestamp at which the batch should be executed. Defaults to None.
+
+        Returns:
+            list: the results of the commands, None for a move, it is done when it started
+        """
+        calls = []
+        for command in commands:
+            if command["func"] not in BATCH_COMMANDS:
+                raise ValueError("%s can not be part of a batch" %
+                                 command["func"])
+            method = getattr(self, command["func"])
+            args = dict(command["args"])
+            args.pop("timestamp", None)
+            # raises TypeError for missing or unknown args
+            inspect.signature(method).bind(**args)
+            calls.append((method, args))
+        if timestamp is not None:
+            return CommandExecutor.get().submit_at(timestamp, self._run_batch, calls)
+        return self._run_batch(calls)
+
+    def _run_batch(self, calls):
+        results = []
+        error = None
+        for method, args in calls:
+            try:
+                result = method(**args)
+            except Exception as e:
+                # the rest of the batch still runs
+                logging.exception(e)
+                error = error or e
+                result = None
+            results.append(None if hasattr(
+                result, "add_done_callback") else result)
+        if error is not None:
+            raise error
+        return results
@@ -1,6 +1,5 @@
 
 import logging
-import pickle
 import threading
 import time
 
@@ -23,10 +22,8 @@ class ApparatusServerHandlerDummy(ApparatusInterface):
         self.thread.start()
 
     def _send_dict(self, dict):
-        data: bytes = pickle.dumps(dict)
-        msg: bytes = len(data).to_bytes(
-            self._HEADERSIZE, "little", signed=False)+data
-        self._socket.send(msg)
+        # framed and encoded with the negotiated codec
+        self.server.send_dict(dict)
 
     def _async_send(self, stop_thread):
         while True:
@@ -86,6 +83,14 @@ class ApparatusServerHandlerDummy(ApparatusInterface):
         logging.debug(self._localtodict(locals()))
         pass
 
+    def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False) -> float:
+        logging.debug(self._localtodict(locals()))
+        return 0.
+
+    def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        logging.debug(self._localtodict(locals()))
+        pass
+
     def set_test_light(self, state, color=None, timestamp=None):
         logging.debug(self._localtodict(locals()))
         pass
@@ -87,6 +87,33 @@ class ApparatusInterface(metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False) -> float:
+        """[summary]
+        Predicts how long a move_to (or deploy) started now would take, from the current angle of the carousel,
+        the step profile and the door timing. The prediction is calibrated against the measured moves.
+        Args:
+            carousel_id (int): The identification of the carousel to be driven
+            compartment_id (int): The identification of the compartment to be placed above the output.
+            monkey (bool, optional): Sets the side of the output to monkey or human side. Defaults to False.
+            deploy (bool, optional): Includes opening and closing the door of a deploy. Defaults to False.
+        Returns:
+            float: The predicted duration in s.
+        """
+        pass
+
+    @abc.abstractmethod
+    def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        """[summary]
+        Renders the step train of a move_to (or deploy) ahead of time, e.g. during the inter-trial interval,
+        so the next move to the compartment starts without planning. It is used if the carousel does not move in between.
+        Args:
+            carousel_id (int): The identification of the carousel to be driven
+            compartment_id (int): The identification of the compartment to be placed above the output.
+            monkey (bool, optional): Sets the side of the output to monkey or human side. Defaults to False.
+        """
+        pass
+
     @abc.abstractmethod
     def set_test_light(self, state, color=Ledout.COLORS["RED"]):
         """[summary]
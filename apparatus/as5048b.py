@@ -1,11 +1,17 @@
 # python Port of https://github.com/sosandroid/AMS_AS5048B
 
+import logging
+import threading
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 from enum import Enum
 
 import numpy as np
 import smbus
 
+from apparatus.i2c_bus import PRIORITY_TELEMETRY, I2CBus
+
 # Default addresses for AS5048B
 AS5048_ADDRESS = 0x40  # 0b10000 + ( A1 & A2 to GND)
 AS5048B_PROG_REG = 0x03
@@ -20,18 +26,39 @@ AS5048B_ANGLMSB_REG = 0xFE  # bits 0..7
 AS5048B_ANGLLSB_REG = 0xFF  # bits 0..5
 AS5048B_RESOLUTION = pow(2, 14)  # 16384.0  # 14 bits
 
+# diagnostic register bits
+AS5048B_DIAG_OCF = 0x01  # offset compensation finished
+AS5048B_DIAG_COF = 0x02  # CORDIC overflow, angle and magnitude invalid
+AS5048B_DIAG_COMP_LOW = 0x04  # magnetic field too strong
+AS5048B_DIAG_COMP_HIGH = 0x08  # magnetic field too weak
+
+# registers 0xFA..0xFF are read in one burst: gain, diag, magnitude, angle
+AS5048B_BURST_REG = AS5048B_GAIN_REG
+AS5048B_BURST_LEN = 6
+
 #  Moving Exponential Average on angle - beware heavy calculation for some Arduino boards
 #  This is a 1st order low pass filter
 #  Moving average is calculated on Sine et Cosine values of the angle to provide an extrapolated accurate angle value.
 EXP_MOVAVG_N = 5  # history length impact on moving average impact - keep in mind the moving average will be impacted by the measurement frequency too
 EXP_MOVAVG_LOOP = 1  # number of measurements before starting mobile Average - starting with a simple average - 1 allows a quick start. Value must be 1 minimum
 
+# background sampling, see AS5048B.startSampling
+SAMPLER_RATE = 200  # Hz
+SAMPLER_HISTORY = 256  # samples kept in the ring buffer
+# filtered is NaN until the moving average is primed, see EXP_MOVAVG_LOOP
+SAMPLE_DTYPE = np.dtype(
+    [("timestamp", np.int64), ("raw", np.double), ("filtered", np.double)])
+
 # unit consts - just to make the units more readable
 
 
 MASK_14BITS = 0x3FFF
 MASK_6BITS = 0x3F
 
+# all diagnostics of a single burst read, angle in the requested unit
+AS5048BSnapshot = namedtuple(
+    "AS5048BSnapshot", ["angle", "magnitude", "gain", "diag"])
+
 
 class AS5048B(object):
     """
@@ -41,6 +68,20 @@ class AS5048B(object):
     units: Enum = Enum(
         'units', 'RAW TRN DEG RAD GRAD MOA SOA MILNATO MILSE MILRU')
 
+    # factor from the raw sensor value to each unit
+    __unitScale = {
+        units.RAW: 1.,  # Sensor raw measurement
+        units.TRN: 1. / AS5048B_RESOLUTION,  # full turn ratio
+        units.DEG: 360.0 / AS5048B_RESOLUTION,  # degree
+        units.RAD: 2 * np.pi / AS5048B_RESOLUTION,  # Radian
+        units.MOA: 60.0 * 360.0 / AS5048B_RESOLUTION,  # minute of arc
+        units.SOA: 60.0 * 60.0 * 360.0 / AS5048B_RESOLUTION,  # second of arc
+        units.GRAD: 400.0 / AS5048B_RESOLUTION,  # grade
+        units.MILNATO: 6400.0 / AS5048B_RESOLUTION,  # NATO MIL
+        units.MILSE: 6300.0 / AS5048B_RESOLUTION,  # Swedish MIL
+        units.MILRU: 6000.0 / AS5048B_RESOLUTION,  # Russian MIL
+    }
+
     # variables
     __debugFlag: bool
     __clockWise: bool
@@ -53,6 +94,9 @@ class AS5048B(object):
     __movingAvgExpCos: np.double = 0.
     __movingAvgExpAlpha: np.double = 0.
     __movingAvgCountLoop: int
+    __samplerThread: threading.Thread = None
+    # (timestamp ns, raw, filtered) of the last sample, replaced as a whole
+    __latest: tuple = None
 
     def __init__(self, *, address=AS5048_ADDRESS):
         """Class initialisation
@@ -62,17 +106,96 @@ class AS5048B(object):
         """
         self.__chipAddress = address
         self.bus: smbus = smbus.SMBus(1)
+        # all transactions run on the shared bus manager, raise the priority
+        # while the readings are needed for motion
+        self.i2c: I2CBus = I2CBus.get()
+        self.priority: int = PRIORITY_TELEMETRY
 
         self.__clockWise = True
         self.__lastAngleRaw = 0.0
+        # reused by every burst read
+        self.__burstBuf = bytearray(AS5048B_BURST_LEN)
         self.__zeroRegVal = self.zeroRegR()
         self.__addressRegVal = self.addressRegR()
 
         self.resetMovingAvgExp()
 
     def cleanup(self):
-        # TODO cleanup
-        pass
+        self.stopSampling()
+
+    def startSampling(self, rate: float = SAMPLER_RATE, history: int = SAMPLER_HISTORY):
+        """Starts a thread that reads the angle at a fixed rate. It keeps the raw and
+        the exponential moving averaged angle of every sample in a ring buffer, so
+        angleR(newVal=False), getMovingAvgExp and latestSample do not touch the bus.
+
+        Args:
+            rate (float, optional): Samples per second. Defaults to SAMPLER_RATE.
+            history (int, optional): Samples kept in the ring buffer. Defaults to SAMPLER_HISTORY.
+        """
+        self.stopSampling()
+        self.__samples = np.zeros(history, dtype=SAMPLE_DTYPE)
+        self.__sampleCount = 0
+        self.__samplerStop = threading.Event()
+        self.__samplerThread = threading.Thread(
+            target=self.__sampleLoop, args=(1. / rate,),
+            name="AS5048B-0x%02x" % (self.__chipAddress,), daemon=True)
+        self.__samplerThread.start()
+
+    def stopSampling(self):
+        if self.__samplerThread is None:
+            return
+        self.__samplerStop.set()
+        self.__samplerThread.join()
+        self.__samplerThread = None
+
+    @property
+    def sampling(self) -> bool:
+        return self.__samplerThread is not None
+
+    def latestSample(self) -> tuple:
+        """last sample of the sampling thread
+
+        Returns:
+            tuple: (timestamp in perf_counter_ns, raw angle, filtered raw angle), None before the first sample.
+            The filtered angle is NaN for the first EXP_MOVAVG_LOOP - 1 samples, before the moving average is primed
+        """
+        return self.__latest
+
+    def getHistory(self, n: int = None) -> np.ndarray:
+        """copy of the most recent samples, oldest first
+
+        Args:
+            n (int, optional): Maximum number of samples. Defaults to all in the ring buffer.
+
+        Returns:
+            np.ndarray: structured array with the fields timestamp (ns), raw and filtered, filtered is NaN before the moving average is primed
+        """
+        if self.__samplerThread is None:
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+        size = len(self.__samples)
+        count = self.__sampleCount
+        if n is None or n > size:
+            n = size
+        n = min(n, count)
+        samples = self.__samples[(np.arange(count - n, count)) % size]
+        # drop the samples overwritten while copying
+        overwritten = self.__sampleCount - size - (count - n)
+        return samples[min(max(overwritten, 0), n):]
+
+    @contextmanager
+    def prioritized(self, priority: int):
+        """Runs the transactions of this sensor, including the sampler, at another
+        priority of the I2C bus within the block.
+
+        Args:
+            priority (int): apparatus.i2c_bus.PRIORITY_*.
+        """
+        previous = self.priority
+        self.priority = priority
+        try:
+            yield
+        finally:
+            self.priority = previous
 
     def setClockWise(self, cw: bool = True):
         """ Set / unset clock wise counting - sensor counts CCW natively
@@ -217,6 +340,31 @@ class AS5048B(object):
         """
         return self.__readReg8(AS5048B_DIAG_REG)
 
+    def snapshot(self, unit: Enum = None) -> AS5048BSnapshot:
+        """reads angle, magnitude, auto gain and diagnostics in one I2C transaction
+
+        Args:
+            unit (int, optional): The unit of the angle. Sensor raw value as default. Defaults to RAW.
+
+        Returns:
+            AS5048BSnapshot: (angle, magnitude, gain, diag) of the same instant
+        """
+        if unit is None:
+            unit = self.units.RAW
+
+        buf = self.__readBurst()
+        angleRaw = (buf[4] << 6 | buf[5]) & MASK_14BITS
+        if(self.__clockWise):
+            angleRaw = MASK_14BITS - angleRaw
+        self.__lastAngleRaw = np.double(angleRaw)
+
+        return AS5048BSnapshot(
+            self.__convertAngle(unit, self.__lastAngleRaw),
+            (buf[2] << 6 | buf[3]) & MASK_14BITS,
+            buf[0],
+            buf[1],
+        )
+
     def angleR(self, unit: Enum = None, newVal: bool = True) -> np.double:
         """reads current angle value and converts it into the desired unit
 
@@ -246,18 +394,35 @@ class AS5048B(object):
 
         return self.__convertAngle(unit, angleRaw)
 
+    def convertAngles(self, angles, unit: Enum = None) -> np.ndarray:
+        """converts raw angles, e.g. the raw or filtered field of getHistory, in one vectorized operation
+
+        Args:
+            angles (array_like): Raw sensor values.
+            unit (int, optional): The target unit. Sensor raw value as default. Defaults to RAW.
+
+        Returns:
+            np.ndarray: float64 array of the angles in the desired unit
+        """
+        if unit is None:
+            unit = self.units.RAW
+        return np.multiply(angles, self.__unitScale[unit], dtype=np.double)
+
     def updateMovingAvgExp(self):
         """Performs an exponential moving average on the angle.
                         Works on Sine and Cosine of the angle to avoid issues 0°/360° discontinuity
         """
-        angle: np.double = self.angleR(self.units.RAD, True)
+        self.__updateMovingAvgExp(self.angleR(self.units.RAD, True))
 
+    def __updateMovingAvgExp(self, angle: np.double):
         if (self.__movingAvgCountLoop < EXP_MOVAVG_LOOP):
             self.__movingAvgExpSin += np.sin(angle)
             self.__movingAvgExpCos += np.cos(angle)
             if (self.__movingAvgCountLoop == (EXP_MOVAVG_LOOP - 1)):
                 self.__movingAvgExpSin = self.__movingAvgExpSin / EXP_MOVAVG_LOOP
                 self.__movingAvgExpCos = self.__movingAvgExpCos / EXP_MOVAVG_LOOP
+                # primed, the simple average is the first value
+                self.__movingAvgExpAngle = self.__getExpAvgRawAngle()
 
             self.__movingAvgCountLoop += 1
 
@@ -289,52 +454,70 @@ class AS5048B(object):
         """reset the exponential moving averaged angle
         """
         self.__movingAvgExpAngle = 0.0
+        self.__movingAvgExpSin = 0.0
+        self.__movingAvgExpCos = 0.0
         self.__movingAvgCountLoop = 0
         self.__movingAvgExpAlpha = 2.0 / (EXP_MOVAVG_N + 1.0)
 
     # private methods
+    def __sampleLoop(self, period: float):
+        twopi: np.double = 2 * np.pi
+        deadline = time.perf_counter()
+        while not self.__samplerStop.is_set():
+            try:
+                raw = self.angleR()
+            except OSError as e:
+                logging.error("AS5048B 0x%02x: %s" %
+                              (self.__chipAddress, e))
+            else:
+                timestamp = time.perf_counter_ns()
+                self.__updateMovingAvgExp(raw / AS5048B_RESOLUTION * twopi)
+                filtered = self.__movingAvgExpAngle
+                if self.__movingAvgCountLoop < EXP_MOVAVG_LOOP:
+                    # no average yet, a 0 would read as an angle
+                    filtered = np.nan
+                sample = (timestamp, raw, filtered)
+                self.__samples[self.__sampleCount %
+                               len(self.__samples)] = sample
+                self.__sampleCount += 1
+                self.__latest = sample
+
+            deadline += period
+            delay = deadline - time.perf_counter()
+            if delay < 0:
+                # overrun, do not try to catch up
+                deadline -= delay
+                delay = 0
+            self.__samplerStop.wait(delay)
+
+    def __call(self, func, *args):
+        return self.i2c.call(self.__chipAddress, func, self.__chipAddress, *args,
+                             priority=self.priority)
+
     def __readReg8(self, address: np.uint8) -> np.uint8:
-        return self.bus.read_byte_data(self.__chipAddress, AS5048B_ANGLMSB_REG)
+        return self.__call(self.bus.read_byte_data, address)
 
     def __readReg16(self, address: np.uint8) -> np.uint16:
         # 16 bit value got from 2x8bits registers (7..0 MSB + 5..0 LSB) => 14 bits value
+        # both are read in one transaction, so the value can not tear
 
-        value: np.uint16 = (self.bus.read_byte_data(
-            self.__chipAddress, address)) << 6 | (self.bus.read_byte_data(
-                self.__chipAddress, address+1))
+        msb, lsb = self.__call(self.bus.read_i2c_block_data, address, 2)
+        value: np.uint16 = msb << 6 | lsb
 
         return value & MASK_14BITS
 
+    def __readBurst(self) -> bytearray:
+        # gain, diag, magnitude MSB/LSB, angle MSB/LSB in one transaction
+        self.__burstBuf[:] = self.__call(
+            self.bus.read_i2c_block_data, AS5048B_BURST_REG, AS5048B_BURST_LEN)
+        return self.__burstBuf
+
     def __writeReg(self, address: np.uint8, value: np.uint8):
-        self.bus.write_byte_data(self.__chipAddress, address, value)
+        # not coalesced, the register writes are command sequences
+        self.__call(self.bus.write_byte_data, address, value)
 
     def __convertAngle(self, unit: Enum,  angle: np.double) -> np.double:
-
-        # RAW, TRN, DEG, RAD, GRAD, MOA, SOA, MILNATO, MILSE, MILRU
-        conversions = {
-            "RAW_comment": "Sensor raw measurement",
-            self.units.RAW: angle,
-            "TRN_comment": "full turn ratio",
-            self.units.TRN: (angle / AS5048B_RESOLUTION),
-            "DEG_comment": "degree",
-            self.units.DEG: (angle / AS5048B_RESOLUTION) * 360.0,
-            "RAD_comment": "Radian",
-            self.units.RAD: (angle / AS5048B_RESOLUTION) * 2 * np.pi,
-            "MOA_comment": "minute of arc",
-            self.units.MOA: (angle / AS5048B_RESOLUTION) * 60.0 * 360.0,
-            "SOA_comment": "second of arc",
-            self.units.SOA: (angle / AS5048B_RESOLUTION) * 60.0 * 60.0 * 360.0,
-            "GRAD_comment": "grade",
-            self.units.GRAD: (angle / AS5048B_RESOLUTION) * 400.0,
-            "MILNATO_comment": "NATO MIL",
-            self.units.MILNATO: (angle / AS5048B_RESOLUTION) * 6400.0,
-            "MILSE_comment": "Swedish MIL",
-            self.units.MILSE: (angle / AS5048B_RESOLUTION) * 6300.0,
-            "MILRcomment": "Russian MIL",
-            self.units.MILRU: (angle / AS5048B_RESOLUTION) * 6000.0
-        }
-
-        return conversions[unit]
+        return angle * self.__unitScale[unit]
 
     def __getExpAvgRawAngle(self) -> np.double:
 
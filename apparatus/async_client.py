@@ -0,0 +1,296 @@
+import asyncio
+import logging
+
+import apparatus.apparatus_interface
+from apparatus import codec
+from apparatus.framing import FrameDecoder, encode_frame
+from apparatus.rpc import PendingRequests
+
+# pin_io of the interface to the name in the io_event
+LEVER_NAMES = {
+    apparatus.apparatus_interface.ApparatusInterface.LEVER_TOUCH: "LEVER_TOUCHS_IO",
+    apparatus.apparatus_interface.ApparatusInterface.LEVER_PULLED: "LEVER_SWITCH_IO",
+    apparatus.apparatus_interface.ApparatusInterface.LEVER_RELEASED: "LEVER_SWITCH_UP_IO",
+}
+
+
+class _ClientProtocol(asyncio.Protocol):
+    """ Feeds the stream of the connection to the FrameDecoder of the client """
+
+    def __init__(self, client):
+        self._client = client
+
+    def connection_made(self, transport):
+        self._client._transport = transport
+
+    def data_received(self, data):
+        self._client._data_received(data)
+
+    def connection_lost(self, exc):
+        self._client._connection_lost(exc)
+
+
+class AsyncApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
+    """ ApparatusClient for asyncio, every command and wait is a coroutine.
+
+    The connection is an asyncio.Protocol on the running loop, without a
+    receive thread, so one loop drives any number of rigs. The protocol is
+    the same as of ApparatusClient: a command is done once its reply arrived,
+    a move once it finished. IO events are delivered by events, waits on
+    several rigs compose with asyncio.wait or event_util.OrWaitAsync:
+
+        left = await AsyncApparatusClient.connect(host, 5000)
+        right = await AsyncApparatusClient.connect(host, 5001)
+        done, index = await event_util.OrWaitAsync(
+            left.wait_lever_state(left.LEVER_PULLED, True),
+            right.wait_lever_state(right.LEVER_PULLED, True), timeout=10)
+    """
+
+    HELLO_TIMEOUT = 5.  # s, for the codec negotiation
+
+    def __init__(self):
+        """ not connected, see connect """
+        self._transport = None
+        self._codec = codec.PICKLE
+        self._decoder = FrameDecoder()
+        self._hello = None
+        self._closed = None
+
+        # commands in flight, and the last move_to or deploy per carousel
+        self._requests = PendingRequests()
+        self._motion = [None, None]
+
+        # lever levels, (name, state) set while the lever is in state
+        self._levels = {(name, state): asyncio.Event()
+                        for name in LEVER_NAMES.values() for state in (False, True)}
+        self._subscribers = []  # queues of events
+
+    @classmethod
+    async def connect(cls, host, port, codecs=("binary", "pickle")):
+        """Opens the connection and negotiates the codec.
+
+        Args:
+            host (string): Server.
+            port (int): Port of the server.
+            codecs (tuple, optional): Codecs in order of preference. Defaults to ("binary", "pickle").
+
+        Returns:
+            AsyncApparatusClient: the connected client
+        """
+        client = cls()
+        loop = asyncio.get_running_loop()
+        client._hello = loop.create_future()
+        client._closed = loop.create_future()
+        await loop.create_connection(lambda: _ClientProtocol(client), host, port)
+        await client._negotiate(codecs)
+        return client
+
+    async def _negotiate(self, codecs):
+        """ the server answers with the codec to use, a server without codecs
+        without one and the connection stays with pickle """
+        self._send_dict({"type": "hello", "codecs": list(codecs)})
+        try:
+            await asyncio.wait_for(asyncio.shield(self._hello), self.HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("No codec negotiated, using pickle")
+            return
+        logging.info("Codec: %s" % self._codec.name)
+
+    def _send_dict(self, dict):
+        if self._transport is None or self._transport.is_closing():
+            raise ConnectionError("Connection closed")
+        self._transport.write(encode_frame(self._codec.encode(dict)))
+
+    def _call(self, func, args) -> asyncio.Future:
+        """ sends a command with a new request id, the returned future is
+        resolved by the reply of the server """
+        future = self._requests.create(func)
+        try:
+            self._send_dict({"type": "command", "func": func,
+                            "args": args, "id": future.request_id})
+        except OSError as e:
+            self._requests.discard(future, e)
+            raise
+        return asyncio.wrap_future(future)
+
+    def _data_received(self, data):
+        self._decoder.feed(data)
+        # any number of frames, the last one partially
+        for frame in self._decoder.frames():
+            if not frame:
+                continue
+            try:
+                dict = self._codec.decode(frame)
+            except ValueError as e:
+                # the framing is intact, the next frame is read as usual
+                logging.warning("Frame skipped: %s" % e)
+                continue
+            self._dispatch(dict)
+
+    def _connection_lost(self, exc):
+        self._requests.fail_all(ConnectionError("Connection closed"))
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+        if not self._closed.done():
+            self._closed.set_result(exc)
+        logging.debug("Frames: %s" % self._decoder.report())
+        logging.debug("Requests: %s" % self._requests.report())
+
+    def _dispatch(self, dict):
+        if "type" not in dict:
+            # package not to spec
+            return
+        if "id" in dict and "success" in dict:
+            # reply to a command sent with _call
+            self._requests.resolve(dict)
+            return
+        if dict["type"] == "hello":
+            # the frames after the answer are in the new codec
+            self._codec = codec.CODECS.get(dict.get("codec"), codec.PICKLE)
+            if not self._hello.done():
+                self._hello.set_result(self._codec)
+            return
+        logging.debug(dict)
+        if dict["type"] == "io_event":
+            state = bool(dict["state"])
+            if (dict["name"], state) in self._levels:
+                self._levels[(dict["name"], state)].set()
+                # arm since state change
+                self._levels[(dict["name"], not state)].clear()
+        if dict["type"] in ("io_event", "io_confirm_event"):
+            for queue in self._subscribers:
+                queue.put_nowait(dict)
+
+    async def events(self):
+        """Yields the io_event and io_confirm_event dicts received from now
+        on, until the connection is closed. Every iterator gets every event.
+
+            async for event in client.events():
+                csv_logger.write(event_id=event["name"], event_state=event["state"])
+        """
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return  # closed connection
+                yield event
+        finally:
+            self._subscribers.remove(queue)
+
+    async def close_connection(self):
+        if self._transport is not None:
+            self._transport.close()
+            await self._closed
+
+    def _localtodict(self, l: dict) -> dict:
+        l.pop('self', None)
+        return l
+
+    async def init_hw(self):
+        args = self._localtodict(locals())
+        func = self.init_hw.__name__
+        # until the hardware is initialized
+        return await self._call(func, args)
+
+    async def hw_self_test(self):
+        args = self._localtodict(locals())
+        func = self.hw_self_test.__name__
+        return await self._call(func, args)
+
+    async def play_sound(self, file=None, volume=90, timestamp=None):
+        args = self._localtodict(locals())
+        func = self.play_sound.__name__
+        return await self._call(func, args)
+
+    async def empty_human(self):
+        args = self._localtodict(locals())
+        func = self.empty_human.__name__
+        return await self._call(func, args)
+
+    async def move_to(self, carousel_id, compartment_id, monkey=False, blocking=False) -> asyncio.Future:
+        """ returns once the move is sent, with blocking once it finished.
+        The returned future is done once the move finished, see move_to_wait """
+        args = self._localtodict(locals())
+        func = self.move_to.__name__
+        future = self._call(func, args)
+        self._motion[carousel_id] = future
+        if blocking:
+            # a cancelled wait leaves the move to move_to_wait
+            await asyncio.shield(future)
+        return future
+
+    async def move_to_wait(self, carousel_id, timeout=None) -> bool:
+        """ waits for the last move_to or deploy of the carousel, returns
+        False on timeout """
+        future = self._motion[carousel_id]
+        if future is None:
+            return True
+        await asyncio.wait((future,), timeout=timeout)
+        return future.done()
+
+    async def deploy(self, carousel_id, compartment_id, monkey=False, blocking=False) -> asyncio.Future:
+        args = self._localtodict(locals())
+        func = self.deploy.__name__
+        # done once the door is closed again
+        future = self._call(func, args)
+        self._motion[carousel_id] = future
+        if blocking:
+            # a cancelled wait leaves the move to move_to_wait
+            await asyncio.shield(future)
+        return future
+
+    async def deploy_wait(self, carousel_id, timeout=None) -> bool:
+        return await self.move_to_wait(carousel_id, timeout)
+
+    async def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False, timeout=None) -> float:
+        args = self._localtodict(locals())
+        args.pop('timeout')
+        func = self.estimate_move.__name__
+        try:
+            return await asyncio.wait_for(self._call(func, args), timeout)
+        except asyncio.TimeoutError:
+            return None  # Timeout
+
+    async def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        args = self._localtodict(locals())
+        func = self.prepare_move.__name__
+        return await self._call(func, args)
+
+    async def set_test_light(self, state, color=None, timestamp=None):
+        args = self._localtodict(locals())
+        func = self.set_test_light.__name__
+        return await self._call(func, args)
+
+    async def set_human_light(self, state, color=None):
+        args = self._localtodict(locals())
+        func = self.set_human_light.__name__
+        return await self._call(func, args)
+
+    async def set_light(self, color, timestamp=None):
+        args = self._localtodict(locals())
+        func = self.set_light.__name__
+        return await self._call(func, args)
+
+    def get_wait_lever_state_event(self, pin_io, state) -> asyncio.Event:
+        """ the event set while the lever is in state, None for an unknown pin_io """
+        if pin_io not in LEVER_NAMES:
+            return None
+        return self._levels[(LEVER_NAMES[pin_io], bool(state))]
+
+    async def wait_lever_state(self, pin_io, state, timeout=None, spinlock=False) -> bool:
+        """ waits until the lever is in state, returns False on timeout """
+        event = self.get_wait_lever_state_event(pin_io, state)
+        if event is None:
+            return False
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def set_lever_open(self, state, timestamp=None):
+        args = self._localtodict(locals())
+        func = self.set_lever_open.__name__
+        return await self._call(func, args)
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+CALIBRATION_VERSION = 1
+
+# sweep parameters
+SAMPLES_PER_COMPARTMENT = 2
+SWEEP_SETTLE_TIME = .15  # s, after every step of the sweep
+SWEEP_READS = 8  # encoder reads averaged per sample
+SWEEP_HARMONICS = 2  # of the periodic encoder error
+
+
+class CarouselCalibration(object):
+    """ Measured geometry of a carousel, see calibrate_carousel """
+
+    def __init__(self, zeroreg, microsteps, steps_per_degree, zero_offset, compartment_angles, error_harmonics=(), residual_rms=0.):
+        """ class init
+        (1) zeroreg type=int, help=Zero register of the encoder the angles were measured with
+        (2) microsteps type=int, help=Positioning resolution of the sweep
+        (3) steps_per_degree type=float, help=Fitted steps per degree at microsteps
+        (4) zero_offset type=float, help=Angle in deg of compartment 0 with the
+        encoder error removed, how far the zero register is off
+        (5) compartment_angles type=list of float, help=Encoder angle in deg of each compartment
+        (6) error_harmonics type=list of (sin, cos), help=Periodic error of the
+        encoder in deg over the turn, starting at compartment 0
+        (7) residual_rms type=float, help=RMS in deg of the readings around the fit
+        """
+        self.zeroreg = zeroreg
+        self.microsteps = microsteps
+        self.steps_per_degree = steps_per_degree
+        self.zero_offset = zero_offset
+        self.compartment_angles = list(compartment_angles)
+        self.error_harmonics = [tuple(h) for h in error_harmonics]
+        self.residual_rms = residual_rms
+
+        # angles of the compartments with the encoder error removed
+        pitch = 360. / len(self.compartment_angles)
+        self.compartment_positions = [
+            (zero_offset + k * pitch) % 360. for k in range(len(self.compartment_angles))]
+
+    def error(self, position):
+        """ encoder error in deg at a position (deg, encoder error removed) """
+        phase = np.deg2rad(position - self.zero_offset)
+        return sum(s * np.sin(k * phase) + c * np.cos(k * phase)
+                   for k, (s, c) in enumerate(self.error_harmonics, 1))
+
+    def position(self, angle):
+        """ encoder angle in deg with the encoder error removed """
+        position = angle
+        for _ in range(3):
+            # the error changes slowly, a few fixed point iterations converge
+            position = angle - self.error(position)
+        return float(position % 360.)
+
+    def to_dict(self):
+        return {
+            "zeroreg": self.zeroreg,
+            "microsteps": self.microsteps,
+            "steps_per_degree": self.steps_per_degree,
+            "zero_offset": self.zero_offset,
+            "compartment_angles": self.compartment_angles,
+            "error_harmonics": self.error_harmonics,
+            "residual_rms": self.residual_rms,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __repr__(self):
+        return "CarouselCalibration(zeroreg=%d, microsteps=%d, steps_per_degree=%.4f, zero_offset=%.3f deg, residual_rms=%.3f deg)" % (
+            self.zeroreg, self.microsteps, self.steps_per_degree, self.zero_offset, self.residual_rms)
+
+
+def fit_sweep(steps, angles, compartments, harmonics=SWEEP_HARMONICS):
+    """Fits a sweep over a full turn.
+
+    The stepper moves the carousel in equal steps, so the encoder readings are
+    a line over the step count plus the periodic error of the encoder (magnet
+    eccentricity). Both are fitted together in one least squares problem, the
+    periodic error as the first harmonics of the turn.
+
+    Args:
+        steps (array_like): Cumulative steps towards increasing angles at each sample.
+        angles (array_like): Encoder angles in deg at each sample.
+        compartments (int): Number of compartments.
+        harmonics (int, optional): Harmonics of the periodic error. Defaults to SWEEP_HARMONICS.
+
+    Returns:
+        CarouselCalibration: without zeroreg and microsteps
+    """
+    steps = np.asarray(steps, dtype=np.double)
+    angles = np.rad2deg(np.unwrap(np.deg2rad(angles)))
+
+    # the phase of the error is the turned angle, first estimate it from the
+    # nominal full turn and refine it with the fitted slope
+    k = np.arange(1, harmonics + 1)
+    slope = 360. / steps[-1]
+    for _ in range(2):
+        phase = np.deg2rad(slope * steps)
+        basis = np.column_stack([steps, np.ones_like(steps),
+                                 np.sin(np.outer(phase, k)), np.cos(np.outer(phase, k))])
+        coefficients = np.linalg.lstsq(basis, angles, rcond=None)[0]
+        slope, intercept = coefficients[:2]
+    residual = angles - basis @ coefficients
+    error_harmonics = list(
+        zip(coefficients[2:2 + harmonics].tolist(), coefficients[2 + harmonics:].tolist()))
+
+    # compartment 0 is where the sweep started
+    calibration = CarouselCalibration(
+        0, 0, float(1. / slope), float((intercept + 180.) % 360. - 180.),
+        [0.] * compartments, error_harmonics, float(np.sqrt(np.mean(residual ** 2))))
+    positions = np.array(calibration.compartment_positions)
+    calibration.compartment_angles = (
+        (positions + calibration.error(positions)) % 360.).tolist()
+    return calibration
+
+
+def calibrate_carousel(carousel, samples_per_compartment=SAMPLES_PER_COMPARTMENT):
+    """Sweeps a carousel through a full turn starting at compartment 0 and
+    fits its steps per degree and compartment angles. Has to run on the
+    motion worker of the carousel, see Carousel.calibrate.
+
+    Returns:
+        CarouselCalibration: the fitted calibration
+    """
+    if carousel.sensorless:
+        raise ValueError("Calibration needs the encoder")
+    compartments = carousel.COMPARTMENTS
+    pitch = 360. / carousel.ANGLE_RES_STEPS / compartments / samples_per_compartment
+    samples = compartments * samples_per_compartment
+
+    steps = [0]
+    angles = [_read_angle(carousel)]
+    played = 0
+    for i in range(1, samples + 1):
+        # positive steps turn towards smaller angles
+        target = int(round(i * pitch))
+        played += carousel._go(-(target - played))
+        steps.append(played)
+        angles.append(_read_angle(carousel))
+    # the last sample closes the turn at compartment 0
+    calibration = fit_sweep(steps, angles, compartments)
+    calibration.zeroreg = carousel.sensor_zeroreg
+    calibration.microsteps = carousel.MICROSTEPS
+    logging.info(calibration)
+    return calibration
+
+
+def _read_angle(carousel):
+    time.sleep(SWEEP_SETTLE_TIME)
+    encoder = carousel.encoder
+    raw = np.array([encoder.angleR() for _ in range(SWEEP_READS)])
+    # circular mean, the readings might wrap at 0
+    radians = encoder.convertAngles(raw, encoder.units.RAD)
+    return np.rad2deg(np.arctan2(np.sin(radians).mean(), np.cos(radians).mean())) % 360.
+
+
+def load_calibration(path):
+    """ calibrations of a rig by carousel name, empty if the file does not exist """
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("version") != CALIBRATION_VERSION:
+        logging.error("Unsupported calibration file: %s" % path)
+        return {}
+    return {name: CarouselCalibration.from_dict(calibration)
+            for name, calibration in data["carousels"].items()}
+
+
+def save_calibration(path, calibrations):
+    data = {
+        "version": CALIBRATION_VERSION,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "carousels": {name: calibration.to_dict() for name, calibration in calibrations.items()},
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
@@ -1,10 +1,37 @@
+import contextlib
 import logging
 import threading
 import time
 
 from apparatus.as5048b import AS5048B
+from apparatus.calibration import CarouselCalibration, calibrate_carousel
+from apparatus.i2c_bus import PRIORITY_MOTION
+from apparatus.motion_model import MotionModel
+from apparatus.motion_planner import MotionPlanner
+from apparatus.motion_worker import MotionCommand, MotionWorker
 from apparatus.nemamotor import NemaMotor
 from apparatus.servo import Servo
+from apparatus.servo_motion import ServoTicker
+
+
+class MoveStats(object):
+    """ Statistics of a single Carousel._move_to """
+
+    def __init__(self, target_id, steps=0, closed_loop=False):
+        self.target_id = target_id
+        self.steps = steps  # steps planned for the first pass
+        self.steps_played = 0
+        self.corrections = 0
+        self.final_error = 0.  # deg, encoder angle minus target angle
+        self.duration = 0.  # s
+        self.predicted = 0.  # s, kinematic duration
+        self.stalled = False
+        self.closed_loop = closed_loop
+
+    def __repr__(self):
+        return "MoveStats(target_id=%d, steps=%d, steps_played=%d, corrections=%d, final_error=%.3f deg, duration=%.3f s, predicted=%.3f s, stalled=%s, closed_loop=%s)" % (
+            self.target_id, self.steps, self.steps_played, self.corrections,
+            self.final_error, self.duration, self.predicted, self.stalled, self.closed_loop)
 
 
 class Carousel(object):
@@ -13,12 +40,32 @@ class Carousel(object):
     motor: NemaMotor = None
     # encoder: AS5048B = None
 
-    MICROSTEPS = 8
+    MICROSTEPS = 8  # positioning resolution, steps and offsets are counted in it
+    CRUISE_MICROSTEPS = 8  # resolution of the cruise of long moves
     ANGLE_RES_STEPS = 0.5/MICROSTEPS
     COMPARTMENTS = 16
     STEPS_COMPARTMENT = 360/ANGLE_RES_STEPS
     ANGLE_COMPARTMENT = 360/COMPARTMENTS
 
+    # closed loop positioning
+    CLOSED_LOOP_TOLERANCE = 4  # steps, target error that is corrected
+    CLOSED_LOOP_APPROACH = 160  # steps, remaining steps in which the target is tracked
+    STALL_TOLERANCE = 5.  # deg, between played steps and encoder movement
+    SETTLE_TIME = .02  # s, before the final encoder reading
+    SAMPLE_MAX_AGE = .005  # s, cached encoder samples used while moving
+    CORRECTION_DELAY = .1  # s, between the passes of an open loop move
+
+    # timing of the duration estimate
+    WAKE_DELAY = .05  # s, initdelay of a de-energized driver
+
+    # microstep resolution switching
+    APPROACH_ANGLE = 5.  # deg, final approach at the positioning resolution
+    TMC2209_MICROSTEPS = (8, 16, 32, 64)
+    STRAPPED_MICROSTEPS = 8  # MS1, MS2 low, the resolution without mode_pins
+    HALF_TURN_MARGIN = 1.05  # longest move relative to half a turn, see _check_backend
+
+    DOOR_TIMEOUT_MARGIN = 1.  # s, after the predicted end of a door move
+
     step_pin = 0
     dir_pin = 0
     en_pin = 0
@@ -26,7 +73,14 @@ class Carousel(object):
     _sensor_zeroreg = 0
 
     _lock: threading.Lock = None
-    _thread: threading.Thread = None
+    _worker: MotionWorker = None
+    _command: MotionCommand = None  # last submitted command
+    last_move: MoveStats = None
+    _prepared: dict = None  # steps -> segments rendered by prepare_move
+    cruise_planner: MotionPlanner = None
+    model: MotionModel = None
+    calibration: CarouselCalibration = None
+    _steps_per_degree: float = 0.  # of the calibration
 
     @property
     def sensor_zeroreg(self):
@@ -39,81 +93,377 @@ class Carousel(object):
         if not self.sensorless:
             self.encoder.zeroRegW(value)
 
-    def __init__(self, step_pin, dir_pin, en_pin, sensor_addr=0x40, sensor_zeroreg=0, servo_monkey_id=0, servo_monkey_id_range=(0, 1), servo_human_id=1, servo_human_id_range=(0, 1), servo_timeout=0, nema_timeout=0, sensorless=False):
+    def __init__(self, step_pin, dir_pin, en_pin, sensor_addr=0x40, sensor_zeroreg=0, servo_monkey_id=0, servo_monkey_id_range=(0, 1), servo_human_id=1, servo_human_id_range=(0, 1), servo_timeout=0, nema_timeout=0, sensorless=False, max_velocity=None, max_accel=None, max_jerk=None, start_velocity=None, closed_loop=False, step_generator=None, backend=None, mode_pins=None, microsteps=MICROSTEPS, cruise_microsteps=None, encoder_sample_rate=0, door_velocity=None, door_speed=None, door_latency=None):
         """ class init
+        max_velocity (deg/s), max_accel (deg/s^2), max_jerk (deg/s^3) and
+        start_velocity (deg/s) configure the motion planner of the stepper.
+        Without max_velocity and max_accel the fixed sigmoid ramp is used.
+        closed_loop tracks the encoder during the move instead of a second
+        corrective move, it is ignored for sensorless carousels.
+        step_generator lets several carousels share one StepGenerator and
+        backend selects the WaveformBackend that plays the moves.
+        microsteps is the positioning resolution all steps are counted in,
+        other than the strapped 8 it needs mode_pins. With mode_pins (MS1, MS2) and a coarser cruise_microsteps the cruise
+        of long moves is played at cruise_microsteps and only the last
+        APPROACH_ANGLE at microsteps; this needs the motion planner.
+        encoder_sample_rate (Hz) starts the background sampling of the
+        encoder, the position is then tracked without bus reads while moving.
+        door_velocity (deg/s) is the peak velocity of the door motion profile,
+        door_speed (us/s) and door_latency (s) the calibrated timing of the
+        door servos, see Servo.
         """
+        if microsteps not in self.TMC2209_MICROSTEPS:
+            raise ValueError("invalid microsteps: {}".format(microsteps))
+        if not mode_pins:
+            # MS1, MS2 not driven, the TMC2209 stays at its strapped 1/8
+            if microsteps != self.STRAPPED_MICROSTEPS:
+                raise ValueError(
+                    "microsteps {} needs mode_pins".format(microsteps))
+            if cruise_microsteps is not None:
+                logging.warning(
+                    "cruise_microsteps is ignored without mode_pins")
+                cruise_microsteps = None
+        if cruise_microsteps is None:
+            cruise_microsteps = microsteps
+        if not mode_pins and cruise_microsteps < microsteps:
+            raise ValueError(
+                "cruise_microsteps {} needs mode_pins".format(cruise_microsteps))
+        if cruise_microsteps not in self.TMC2209_MICROSTEPS or microsteps % cruise_microsteps:
+            raise ValueError(
+                "invalid cruise_microsteps: {}".format(cruise_microsteps))
+        self.MICROSTEPS = microsteps
+        self.CRUISE_MICROSTEPS = cruise_microsteps
+        self.ANGLE_RES_STEPS = 0.5/microsteps
+        self.STEPS_COMPARTMENT = 360/self.ANGLE_RES_STEPS
+        self.steptype = "1/%d" % microsteps
+        self.cruise_steptype = "1/%d" % cruise_microsteps
+
+        planner = None
+        if max_velocity and max_accel:
+            planner = MotionPlanner(
+                self.ANGLE_RES_STEPS,
+                max_velocity,
+                max_accel,
+                max_jerk,
+                start_velocity,
+            )
+            if mode_pins and cruise_microsteps < microsteps:
+                self.cruise_planner = MotionPlanner(
+                    0.5/cruise_microsteps,
+                    max_velocity,
+                    max_accel,
+                    max_jerk,
+                    start_velocity,
+                )
+        elif cruise_microsteps < microsteps:
+            logging.warning(
+                "Microstep switching needs max_velocity and max_accel")
+        if backend is not None:
+            self._check_backend(backend, closed_loop and not sensorless)
         self.motor = NemaMotor(
             dir_pin,
             step_pin,
             en_pin,
-            nema_timeout=nema_timeout
+            mode_pins=mode_pins,
+            nema_timeout=nema_timeout,
+            step_generator=step_generator,
+            planner=planner,
+            backend=backend,
         )
-        self.motor.motor_enable(True)
+        self.motor.power.on()
+        # moves by whole compartments are the common case, up to half a turn
+        self.motor.warm_profiles(
+            k * self.ANGLE_COMPARTMENT / self.ANGLE_RES_STEPS for k in range(1, self.COMPARTMENTS // 2 + 1))
 
         self.sensorless = sensorless
+        self.closed_loop = closed_loop and not sensorless
         self.current_id = -1
         if not self.sensorless:
             self.encoder = AS5048B(address=sensor_addr)
+            if encoder_sample_rate:
+                self.encoder.startSampling(encoder_sample_rate)
         self.sensor_zeroreg = sensor_zeroreg
         self._lock = threading.Lock()
+        self._worker = MotionWorker("Carousel-%d" % (step_pin,))
+        self.model = MotionModel()
 
         self.servo_monkey = Servo(
             servo_monkey_id,
             servo_monkey_id_range,
             servo_timeout,
+            velocity=door_velocity,
+            speed=door_speed,
+            latency=door_latency,
         )
         self.servo_human = Servo(
             servo_human_id,
             servo_human_id_range,
             servo_timeout,
+            velocity=door_velocity,
+            speed=door_speed,
+            latency=door_latency,
         )
 
+    def _check_backend(self, backend, closed_loop):
+        """ refuses a backend that can not play the moves of this carousel """
+        if closed_loop and not backend.retargetable:
+            raise ValueError("closed_loop needs a backend that retargets playing moves, %s can not" %
+                             type(backend).__name__)
+        if backend.max_edges is not None:
+            # half a turn, a calibration may need a few more steps per degree
+            steps = int(180 / self.ANGLE_RES_STEPS * self.HALF_TURN_MARGIN)
+            edges = 2 + 2 * max(abs(segment_steps)
+                                for _, _, segment_steps, _ in self._segments(steps))
+            if edges > backend.max_edges:
+                raise ValueError("A half turn at 1/%d takes %d edges, %s plays %d" % (
+                    self.CRUISE_MICROSTEPS, edges, type(backend).__name__, backend.max_edges))
+
     def motors_off(self):
-        self.motor.motor_enable(False)
-        for i in range(0, self.servo_human.servokit._channels):
-            self.servo_human.servokit.servo[i].fraction = None
+        self._worker.cancel()
+        self.motor.power.off()
+        ServoTicker.get().cancel()
+        # all channels of the servo board in one transaction
+        self.servo_human.driver.off()
 
     def cleanup(self):
+        self._worker.stop()
         self.motor.cleanup()
         if not self.sensorless:
             self.encoder.cleanup()
         self.servo_human.cleanup()
         self.servo_monkey.cleanup()
 
-    def deploy(self, id, monkey=True, blocking=True, callback=None):
-        self._lock.acquire()
-        self._thread = threading.Thread(target=self._deploy, kwargs={
-            "id": id, "monkey": monkey, "callback": callback})
-        self._thread.start()
-        if blocking:
-            self.move_to_wait()
+    def deploy(self, id, monkey=True, blocking=True, callback=None) -> MotionCommand:
+        """ moves the compartment to the output and opens its door, see move_to """
+        return self._submit(MotionCommand(
+            "deploy", self._deploy, (id, monkey), callback), blocking)
 
-    def _deploy(self, id, monkey, callback=None):
+    def _deploy(self, command):
+        id, monkey = command.args
         servo = self.servo_human
         if monkey:
             servo = self.servo_monkey
-        self._move_to(id, monkey)
+        stats = self._move_to(id, monkey)
+        if command.cancelled:
+            return stats
+        # done as soon as the door is predicted to be closed again
         servo.door_open = True
-        time.sleep(1)
+        self._wait_door(servo.motion, "opening")
         servo.door_open = False
-        time.sleep(1)
-        self._lock.release()
-        if callback is not None:
-            callback()
-
-    def move_to(self, id, monkey=True, blocking=True, callback=None):
-        self._lock.acquire()
-        self._thread = threading.Thread(target=self._move_to_helper, kwargs={
-            "id": id, "monkey": monkey, "callback": callback})
-        self._thread.start()
+        self._wait_door(servo.motion, "closing")
+        return stats
+
+    def _wait_door(self, motion, what):
+        """ waits for a door move of the deploy, raises if it did not reach its target """
+        if motion.wait(motion.remaining_timeout(self.DOOR_TIMEOUT_MARGIN)):
+            return
+        if motion.error is not None:
+            raise RuntimeError("Door %s of the deploy failed: %s" % (what, motion.error))
+        if motion.cancelled:
+            # the door is moved by someone else, e.g. init_hw, leave it to them
+            raise RuntimeError("Door %s of the deploy was interrupted" % what)
+        motion.cancel()
+        raise RuntimeError("Door %s of the deploy timed out" % what)
+
+    def move_to(self, id, monkey=True, blocking=True, callback=None) -> MotionCommand:
+        """Moves a compartment to the output. The move is run by the motion
+        worker of the carousel, a move_to that arrives while another move_to
+        is running and nothing else is queued retargets the running move
+        (carousels with encoder only).
+
+        Args:
+            id (int): Compartment.
+            monkey (bool, optional): Output on the monkey side. Defaults to True.
+            blocking (bool, optional): Wait until the move is finished. Defaults to True.
+            callback (callable, optional): Called without arguments once the move is finished. Defaults to None.
+
+        Returns:
+            MotionCommand: Handle to wait for or cancel the move, its result is the MoveStats
+        """
+        command = MotionCommand("move_to", self._move_to_helper,
+                                (id, monkey), callback)
+        with self._lock:
+            current = self._worker.current
+            # without encoder the position of a stopped move is unknown
+            if current is not None and current.name == "move_to" and not self._worker.pending() \
+                    and not self.sensorless and current.retarget((id, monkey), follower=command):
+                self._command = command
+                logging.debug("Carousel retarget: %s" % (command.args,))
+                if blocking:
+                    command.wait()
+                return command
+        return self._submit(command, blocking)
+
+    def _move_to_helper(self, command):
+        while True:
+            stats = self._move_to(*command.args)
+            # a retarget while moving continues from where the move stopped
+            if command.settle():
+                return stats
+
+    def _submit(self, command, blocking):
+        with self._lock:
+            self._worker.submit(command)
+            self._command = command
         if blocking:
-            self.move_to_wait()
+            command.wait()
+        return command
+
+    def cancel(self):
+        """ cancels the running and all queued moves """
+        self._worker.cancel()
+
+    def calibrate(self, blocking=True) -> MotionCommand:
+        """ sweeps the carousel once around and applies the fitted calibration,
+        the result of the returned command is the CarouselCalibration """
+        return self._submit(MotionCommand(
+            "calibrate", self._calibrate), blocking)
+
+    def _calibrate(self, command):
+        with self.motor.power.held(), self._encoder_priority():
+            self.calibration = None
+            self._move_to(0, False)
+            calibration = calibrate_carousel(self)
+        if command.interrupted():
+            raise RuntimeError("Calibration cancelled")
+        self.apply_calibration(calibration)
+        return calibration
+
+    def apply_calibration(self, calibration: CarouselCalibration):
+        """ uses the measured compartment angles and steps per degree for
+        all moves, returns False if it does not match the encoder setup """
+        if calibration.zeroreg != self.sensor_zeroreg:
+            logging.error("Calibration ignored, measured with zeroreg %d instead of %d" % (
+                calibration.zeroreg, self.sensor_zeroreg))
+            return False
+        if len(calibration.compartment_angles) != self.COMPARTMENTS:
+            logging.error("Calibration ignored, %d compartments" %
+                          len(calibration.compartment_angles))
+            return False
+        self.calibration = calibration
+        self._steps_per_degree = calibration.steps_per_degree * \
+            self.MICROSTEPS / calibration.microsteps
+        return True
+
+    def prepare_move(self, id, monkey=True):
+        """ renders the move to a compartment ahead of time, e.g. during the
+        inter-trial interval. It is used by the next move if the carousel has
+        not moved in between.
+        """
+        if monkey:
+            id = id + self.COMPARTMENTS/2
+        steps = self.getOffsetForID(id)
+        self._prepared = {steps: self._render(steps)}
+
+    def _render(self, steps):
+        """Renders a move of steps at the positioning resolution into segments
+        of (steptype, scale, waveform), scale being the positioning steps per
+        step of the segment. Long moves cruise at the coarse resolution, the
+        TMC2209 keeps its microstep counter when the resolution changes so
+        a coarse step is exactly scale fine steps.
+        """
+        prepared = self._prepared
+        self._prepared = None
+        if prepared is not None and steps in prepared:
+            return prepared[steps]
 
-    def _move_to_helper(self, id, monkey, callback=None):
-        self._move_to(id, monkey)
-        self._lock.release()
-        if callback is not None:
-            callback()
+        return [(steptype, scale, self.motor.render_move(segment_steps, planner=planner))
+                for steptype, scale, segment_steps, planner in self._segments(steps)]
+
+    def _segments(self, steps):
+        """ splits a move into (steptype, scale, steps, planner) segments, see _render """
+        segments = []
+        direction = 1 if steps >= 0 else -1
+        if self.cruise_planner is not None:
+            scale = self.MICROSTEPS // self.CRUISE_MICROSTEPS
+            approach = max(self.APPROACH_ANGLE /
+                           self.ANGLE_RES_STEPS, self.CLOSED_LOOP_APPROACH)
+            cruise = int((abs(steps) - approach) // scale)
+            if cruise > 0:
+                segments.append((self.cruise_steptype, scale,
+                                 direction * cruise, self.cruise_planner))
+                steps -= direction * cruise * scale
+        segments.append((self.steptype, 1, steps, None))
+        return segments
+
+    def estimate_move(self, id, monkey=True, deploy=False):
+        """Predicts the duration of a move started now from the current angle.
+
+        Args:
+            id (int): Compartment.
+            monkey (bool, optional): Output on the monkey side. Defaults to True.
+            deploy (bool, optional): Include opening and closing the door. Defaults to False.
+
+        Returns:
+            float: Duration in s, calibrated against the measured moves
+        """
+        if monkey:
+            id = id + self.COMPARTMENTS/2
+        duration = self.model.predict(
+            self._kinematic_duration(self.getOffsetForID(id)))
+        if deploy:
+            servo = self.servo_monkey if monkey else self.servo_human
+            duration += servo.predict(0, 180) + servo.predict(180, 0)
+        return duration
+
+    def _kinematic_duration(self, steps):
+        """ planned duration in s of a move of steps without the calibration """
+        duration = 0. if self.motor.power.energized else self.WAKE_DELAY
+        for _, _, segment_steps, planner in self._segments(steps):
+            duration += self.motor.estimate_duration(segment_steps, planner)
+        if self.closed_loop:
+            duration += self.SETTLE_TIME
+        else:
+            duration += self.CORRECTION_DELAY
+        return duration
+
+    def _go(self, steps, monitor=None):
+        """Plays a move of steps at the positioning resolution.
+
+        Args:
+            steps (int): Signed steps at the positioning resolution.
+            monitor (callable, optional): Called with (job, played, scale, final)
+            while a segment is played, played being the positioning steps of the
+            previous segments. Defaults to None.
+
+        Returns:
+            int: steps played at the positioning resolution
+        """
+        played = 0
+        command = self._worker.current
+        if command is not None and command.interrupted():
+            return played
+        segments = self._render(steps)
+        for i, (steptype, scale, waveform) in enumerate(segments):
+            interrupted = []
+
+            def segment_monitor(job, played=played, scale=scale, final=i == len(segments) - 1, interrupted=interrupted):
+                if command is not None and command.interrupted():
+                    if not interrupted:
+                        # retargeted or cancelled, once per segment
+                        interrupted.append(job.position)
+                        self._stop(job, scale)
+                    return
+                if monitor is not None:
+                    monitor(job, played, scale, final)
+            job = self.motor.motor_go(
+                steptype=steptype, waveform=waveform, monitor=segment_monitor)
+            played += job.position * scale
+            if interrupted or job.position < waveform.steps:
+                break  # cancelled
+        return played
+
+    def _stop(self, job, scale):
+        """ ends a playing segment of an interrupted move early """
+        if not self.motor.backend.retargetable:
+            # a wave of the daemon can only be stopped abruptly, at speed
+            # that loses steps, it plays to its end and the move is
+            # replanned from there
+            logging.info("Carousel: interrupted segment plays to its end")
+            return
+        # the tail of the delay table is the deceleration ramp
+        job.retarget(min(job.steps, job.position +
+                         self.CLOSED_LOOP_APPROACH // scale))
 
     def _move_to(self, id, monkey):
         if self.sensorless and self.current_id == -1:
@@ -122,18 +472,107 @@ class Carousel(object):
         if monkey:
             id = id + self.COMPARTMENTS/2
 
-        self.motor.motor_go(steps=self.getOffsetForID(id), clockwise=False)
+        predicted = self._kinematic_duration(self.getOffsetForID(id))
+        # the driver stays energized between the passes and segments
+        with self.motor.power.held(), self._encoder_priority():
+            if self.closed_loop:
+                stats = self._move_closed_loop(id)
+            else:
+                stats = self._move_open_loop(id)
+        stats.predicted = predicted
+        command = self._worker.current
+        if not stats.stalled and not (command is not None and command.interrupted()):
+            self.model.record(predicted, stats.duration)
+        self.last_move = stats
+        logging.info(stats)
+        logging.debug("Carousel power: %s" % self.motor.power.report())
+        return stats
+
+    def _encoder_priority(self):
+        # the encoder reads of a move beat telemetry on the I2C bus
+        if self.sensorless:
+            return contextlib.nullcontext()
+        return self.encoder.prioritized(PRIORITY_MOTION)
+
+    def _move_open_loop(self, id):
+        start = time.perf_counter()
+        stats = MoveStats(id, self.getOffsetForID(id))
+        stats.steps_played = self._go(stats.steps)
+        self.current_id = id
+        time.sleep(self.CORRECTION_DELAY)
+        steps = self.getOffsetForID(id)
+        # a calibrated carousel usually lands right the first time
+        if self.calibration is None or abs(steps) > self.CLOSED_LOOP_TOLERANCE:
+            stats.steps_played += self._go(steps)
+            stats.corrections = 1
+            steps = self.getOffsetForID(id)
+        stats.final_error = -steps * self.ANGLE_RES_STEPS
+        stats.duration = time.perf_counter() - start
+        return stats
+
+    def _move_closed_loop(self, id):
+        """Single pass move that follows the encoder while the steps are played.
+        Once the move is within CLOSED_LOOP_APPROACH steps of its planned end the
+        remaining step count is retargeted to the encoder reading. A deviation
+        of more than STALL_TOLERANCE between the played steps and the encoder
+        stops the move as stalled. A corrective move is only made if the final
+        error is outside CLOSED_LOOP_TOLERANCE.
+        """
+        start = time.perf_counter()
+        source = self._angle()
+        stats = MoveStats(id, self._offsetForAngle(id, source), True)
+        direction = 1 if stats.steps >= 0 else -1
+
+        def monitor(job, played, scale, final):
+            if stats.stalled:
+                return
+            before = job.position
+            angle = self._angle(self.SAMPLE_MAX_AGE)
+            # at the time of the reading
+            position = played + (before + job.position) / 2 * scale
+            # positive steps turn towards smaller angles
+            moved = -self._angleDiff(angle, source) / \
+                self.ANGLE_RES_STEPS * direction
+            if abs(moved - position) * self.ANGLE_RES_STEPS > self.STALL_TOLERANCE:
+                logging.error("Carousel stalled: %d steps played, %d steps moved" % (
+                    position, moved))
+                stats.stalled = True
+                job.cancel()
+                return
+            # retarget the final approach at the positioning resolution only
+            position -= played
+            if not final or job.steps - position > self.CLOSED_LOOP_APPROACH:
+                return
+            target = int(round(
+                position + self._offsetForAngle(id, angle) * direction))
+            if abs(target - job.steps) > self.CLOSED_LOOP_TOLERANCE:
+                job.retarget(max(target, 0))
+                stats.corrections += 1
+
+        stats.steps_played = self._go(stats.steps, monitor)
         self.current_id = id
-        time.sleep(.1)
-        self.motor.motor_go(steps=self.getOffsetForID(id), clockwise=False)
+
+        time.sleep(self.SETTLE_TIME)
+        steps = self.getOffsetForID(id)
+        if abs(steps) > self.CLOSED_LOOP_TOLERANCE:
+            stats.steps_played += self._go(steps)
+            stats.corrections += 1
+            steps = self.getOffsetForID(id)
+        stats.final_error = -steps * self.ANGLE_RES_STEPS
+        stats.duration = time.perf_counter() - start
+        return stats
 
     def move_to_wait(self, timeout=-1, spinlock=False):
+        """ waits until all submitted moves are finished, returns False on timeout """
         logging.debug("move to wait")
+        command = self._command
+        if command is None:
+            return True
 
         if spinlock:
             # Spinlock
             timeout = time.time() + timeout   # timeout seconds from now
-            while self._lock.locked():
+            while not command.done():
                 if time.time() > timeout:
                     logging.debug("timeout")
                     return False
@@ -141,20 +580,38 @@ class Carousel(object):
             logging.debug("state reached")
             return True
         else:
-            if self._lock.locked():
-                self._thread.join(timeout)
+            return command.wait(None if timeout < 0 else timeout)
 
     def getOffsetForID(self, id):
+        return self._offsetForAngle(id, self._angle())
 
+    def _angle(self, max_age=None):
+        """ current angle in deg, max_age (s) allows a cached sample of the encoder sampler """
         if self.sensorless:
-            sourceA = self.current_id * self.ANGLE_COMPARTMENT
-        else:
-            sourceA = self.encoder.angleR(unit=self.encoder.units.DEG)
+            return self.current_id * self.ANGLE_COMPARTMENT
+        if max_age is not None and self.encoder.sampling:
+            sample = self.encoder.latestSample()
+            if sample is not None and time.perf_counter_ns() - sample[0] <= max_age * 1e9:
+                return self.encoder.convertAngles(sample[1], self.encoder.units.DEG)
+        return self.encoder.angleR(unit=self.encoder.units.DEG)
+
+    def _angleDiff(self, targetA, sourceA):
+        """ shortest signed angle from sourceA to targetA in [-180, 180) """
+        return (targetA-sourceA+540) % 360-180
+
+    def _offsetForAngle(self, id, sourceA):
+        steps_per_degree = 1 / self.ANGLE_RES_STEPS
         targetA = id * self.ANGLE_COMPARTMENT
+        if self.calibration is not None:
+            # measured positions, the encoder error removed
+            steps_per_degree = self._steps_per_degree
+            targetA = self.calibration.compartment_positions[int(
+                round(id)) % self.COMPARTMENTS]
+            sourceA = self.calibration.position(sourceA)
         logging.debug("id: %d" % (id+1))
         logging.debug("current_id: %d" % (self.current_id+1))
         logging.debug("sourceA: %d" % (sourceA))
         logging.debug("targetA: %d" % (targetA))
-        a = (targetA-sourceA+540) % 360-180
+        a = self._angleDiff(targetA, sourceA)
         logging.debug("a: %d" % (a))
-        return -int(round(a/self.ANGLE_RES_STEPS, 0))
+        return -int(round(a*steps_per_degree, 0))
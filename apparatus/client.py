@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import contextlib
 import logging
-import pickle
+import select
 import socket
 import threading
 
 import apparatus.apparatus_interface
+from apparatus import codec
+from apparatus.framing import FrameDecoder, FrameWriter
+from apparatus.rpc import CommandBatch, CommandFuture, PendingRequests
 
 
 class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
@@ -14,8 +19,6 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
     _recv_thread: threading.Thread
     _stop_recv_thread: bool
 
-    _sig_carousel = []
-
     _sig_io_touch_high: threading.Event
     _sig_io_touch_low: threading.Event
     _sig_io_switch_high: threading.Event
@@ -27,17 +30,22 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
     _logging_switch_callback = None
     _logging_switch_up_callback = None
 
-    def __init__(self, host, port, logging_touch_callback=None, logging_switch_callback=None, logging_switch_up_callback=None) -> None:
+    HELLO_TIMEOUT = 5.  # s, for the codec negotiation
+
+    def __init__(self, host, port, logging_touch_callback=None, logging_switch_callback=None, logging_switch_up_callback=None, codecs=("binary", "pickle")) -> None:
         self._logging_touch_callback = logging_touch_callback
         self._logging_switch_callback = logging_switch_callback
         self._logging_switch_up_callback = logging_switch_up_callback
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((host, port))
+        self._writer = FrameWriter(self._socket)
         # self._socket.setblocking(False)
 
-        self._sig_carousel = [{"_sig_move_to_wait": threading.Event(), "_sig_deploy":  threading.Event()},
-                              {"_sig_move_to_wait": threading.Event(), "_sig_deploy":  threading.Event()}]
+        # commands in flight, and the last move_to or deploy per carousel
+        self._requests = PendingRequests()
+        self._motion = [None, None]
+        self._batches = threading.local()  # the open batch of a thread
 
         self._sig_io_touch_high: threading.Event = threading.Event()
         self._sig_io_touch_low: threading.Event = threading.Event()
@@ -46,6 +54,10 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
         self._sig_io_switch_up_high: threading.Event = threading.Event()
         self._sig_io_switch_up_low: threading.Event = threading.Event()
 
+        self._codec = codec.PICKLE
+        self._decoder = FrameDecoder()
+        self._negotiate(codecs)
+
         self._stop_recv_thread = False
         self._recv_thread = threading.Thread(
             target=self._async_recv, args=(lambda: self._stop_recv_thread,))
@@ -55,100 +67,187 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
             func for func in dir(apparatus.apparatus_interface.ApparatusInterface) if not func.startswith('_') and callable(getattr(apparatus.apparatus_interface.ApparatusInterface, func))]
 
     def _send_dict(self, dict):
-        data: bytes = pickle.dumps(dict)
-        msg: bytes = len(data).to_bytes(
-            self._HEADERSIZE, "little", signed=False)+data
-        self._socket.send(msg)
+        # whole frames, also when several threads send
+        self._writer.send(self._codec.encode(dict))
+
+    def _call(self, func, args) -> CommandFuture:
+        """ sends a command with a new request id, the future is resolved by
+        the reply of the server. Within batch the command is added to the
+        batch instead. """
+        if self._batching():
+            return self._batches.current.add(func, args)
+        future = self._requests.create(func)
+        try:
+            self._send_dict({"type": "command", "func": func,
+                            "args": args, "id": future.request_id})
+        except OSError as e:
+            self._requests.discard(future, e)
+            raise
+        return future
+
+    @contextlib.contextmanager
+    def batch(self, timestamp=None):
+        """Collects the commands called on this thread within the block and
+        sends them in one frame when it ends. The server runs them back to
+        back in the order they were called, at timestamp or at once. Only
+        quick commands can be part of a batch, see rpc.BATCH_COMMANDS, and
+        a move in a batch is done when it started.
+
+            with apparatus.batch(timestamp):
+                apparatus.set_test_light(True)
+                apparatus.set_lever_open(True)
+                apparatus.play_sound("on-status.mp3")
+
+        Args:
+            timestamp (datetime, optional): A future timestamp at which the batch should be executed. Defaults to None.
+
+        Yields:
+            CommandBatch: its future is the reply of the whole batch once sent
+        """
+        if self._batching():
+            raise RuntimeError("Batches can not be nested")
+        batch = CommandBatch(timestamp)
+        self._batches.current = batch
+        try:
+            yield batch
+        finally:
+            self._batches.current = None
+        # not sent if the block raised
+        if batch.commands:
+            batch.sent(self._call(self.batch.__name__, {
+                "commands": batch.commands, "timestamp": timestamp}))
+
+    def _batching(self):
+        return getattr(self._batches, "current", None) is not None
+
+    def _negotiate(self, codecs):
+        """ offers the codecs in order of preference, the server answers with
+        the one to use. A server without codecs answers without one and the
+        connection stays with pickle. """
+        self._send_dict({"type": "hello", "codecs": list(codecs)})
+        while select.select([self._socket], [], [], self.HELLO_TIMEOUT)[0]:
+            if not self._decoder.recv_from(self._socket):
+                break
+            for frame in self._decoder.frames():
+                if not frame:
+                    continue
+                try:
+                    dict = self._codec.decode(frame)
+                except ValueError as e:
+                    logging.warning("Frame skipped: %s" % e)
+                    continue
+                if dict.get("type") != "hello":
+                    # an event sent before the answer
+                    self._dispatch(dict)
+                    continue
+                self._codec = codec.CODECS.get(
+                    dict.get("codec"), codec.PICKLE)
+                logging.info("Codec: %s" % self._codec.name)
+                return
+        logging.warning("No codec negotiated, using pickle")
 
     def _async_recv(self, stop_thread):
+        decoder = self._decoder
         while True:
-            import select
+            # a read may hold any number of frames, the last one partially
+            for frame in decoder.frames():
+                if not frame:
+                    continue
+                try:
+                    dict = self._codec.decode(frame)
+                except ValueError as e:
+                    # the framing is intact, the next frame is read as usual
+                    logging.warning("Frame skipped: %s" % e)
+                    continue
+                self._dispatch(dict)
+
             ready = select.select([self._socket], [], [], 10)
             if stop_thread():
                 break
             if not ready[0]:
                 continue
 
-            head: bytes = self._socket.recv(self._HEADERSIZE)
-            if head == '':
+            if not decoder.recv_from(self._socket):
                 break  # closed connection
-            len: int = int.from_bytes(head, 'little', signed=False)
-            if len:
-                data = self._socket.recv(len)
-                dict = pickle.loads(data)
-
-            if "type" not in dict:
-                # package not to spec
-                continue
-
-            logging.debug(dict["type"])
-
-            # TODO implement recv
-
-            if dict["type"] == "event":
-                logging.debug(dict["event"])
-            elif dict["type"] == "msg":
-                logging.debug(dict["msg"])
-            elif dict["type"] == "command":
-                logging.debug(dict)
-            elif dict["type"] == "wait_event":
-                logging.debug(dict)
-                if dict["func_name"] == 'move_to':
-                    self._sig_carousel[dict["carousel_id"]
-                                       ]["_sig_move_to_wait"].set()
-                elif dict["func_name"] == 'deploy':
-                    self._sig_carousel[dict["carousel_id"].set()
-                                       ]["_sig_deploy_wait"]
-            elif dict["type"] == "io_event":
-                logging.debug(dict)
-                if dict["name"] == 'LEVER_TOUCHS_IO':
-                    if dict["state"]:
-                        logging.debug("LEVER_TOUCHS_IO True")
-                        self._sig_io_touch_high.set()
-                        self._sig_io_touch_low.clear()  # arm since state change
-                    else:
-                        logging.debug("LEVER_TOUCHS_IO False")
-                        self._sig_io_touch_low.set()
-                        self._sig_io_touch_high.clear()  # arm since state change
-                    # Callback for csv writer
-                    if self._logging_touch_callback is not None:
-                        timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
-                        self._logging_touch_callback(
-                            dict["name"], dict["state"] == 1, timestamp)
-
-                elif dict["name"] == 'LEVER_SWITCH_IO':
-                    if dict["state"]:
-                        logging.debug("LEVER_SWITCH_IO True")
-                        self._sig_io_switch_high.set()
-                        self._sig_io_switch_low.clear()  # arm since state change
-                    else:
-                        logging.debug("LEVER_SWITCH_IO False")
-                        self._sig_io_switch_low.set()
-                        self._sig_io_switch_high.clear()  # arm since state change
-                    # Callback for csv writer
-                    if self._logging_switch_callback is not None:
-                        timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
-
-                        self._logging_switch_callback(
-                            dict["name"], dict["state"] == 0, timestamp)
-
-                elif dict["name"] == 'LEVER_SWITCH_UP_IO':
-                    if dict["state"]:
-                        logging.debug("LEVER_SWITCH_UP_IO True")
-                        self._sig_io_switch_up_high.set()
-                        self._sig_io_switch_up_low.clear()  # arm since state change
-                    else:
-                        logging.debug("LEVER_SWITCH_UP_IO False")
-                        self._sig_io_switch_up_low.set()
-                        self._sig_io_switch_up_high.clear()  # arm since state change
-                    # Callback for csv writer
-                    if self._logging_switch_up_callback is not None:
-                        timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
-
-                        self._logging_switch_up_callback(
-                            dict["name"], dict["state"] == 0, timestamp)
-
-            # self.send_dict(data)
+        self._requests.fail_all(ConnectionError("Connection closed"))
+        logging.debug("Frames: %s" % decoder.report())
+        logging.debug("Requests: %s" % self._requests.report())
+
+    def _dispatch(self, dict):
+        if "type" not in dict:
+            # package not to spec
+            return
+
+        logging.debug(dict["type"])
+
+        if "id" in dict and "success" in dict:
+            # reply to a command sent with _call
+            self._requests.resolve(dict)
+            return
+
+        if dict["type"] == "event":
+            logging.debug(dict["event"])
+        elif dict["type"] == "msg":
+            logging.debug(dict["msg"])
+        elif dict["type"] == "command":
+            logging.debug(dict)
+        elif dict["type"] == "wait_event":
+            # the reply of the move_to or deploy follows
+            logging.debug(dict)
+        elif dict["type"] == "io_confirm_event":
+            # the level of an io_event edge held (confirmed) or fell
+            # back, the fall back is sent as an io_event too
+            logging.debug(dict)
+        elif dict["type"] == "io_event":
+            logging.debug(dict)
+            if dict["name"] == 'LEVER_TOUCHS_IO':
+                if dict["state"]:
+                    logging.debug("LEVER_TOUCHS_IO True")
+                    self._sig_io_touch_high.set()
+                    self._sig_io_touch_low.clear()  # arm since state change
+                else:
+                    logging.debug("LEVER_TOUCHS_IO False")
+                    self._sig_io_touch_low.set()
+                    self._sig_io_touch_high.clear()  # arm since state change
+                # Callback for csv writer
+                if self._logging_touch_callback is not None:
+                    timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
+                    self._logging_touch_callback(
+                        dict["name"], dict["state"] == 1, timestamp)
+
+            elif dict["name"] == 'LEVER_SWITCH_IO':
+                if dict["state"]:
+                    logging.debug("LEVER_SWITCH_IO True")
+                    self._sig_io_switch_high.set()
+                    self._sig_io_switch_low.clear()  # arm since state change
+                else:
+                    logging.debug("LEVER_SWITCH_IO False")
+                    self._sig_io_switch_low.set()
+                    self._sig_io_switch_high.clear()  # arm since state change
+                # Callback for csv writer
+                if self._logging_switch_callback is not None:
+                    timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
+
+                    self._logging_switch_callback(
+                        dict["name"], dict["state"] == 0, timestamp)
+
+            elif dict["name"] == 'LEVER_SWITCH_UP_IO':
+                if dict["state"]:
+                    logging.debug("LEVER_SWITCH_UP_IO True")
+                    self._sig_io_switch_up_high.set()
+                    self._sig_io_switch_up_low.clear()  # arm since state change
+                else:
+                    logging.debug("LEVER_SWITCH_UP_IO False")
+                    self._sig_io_switch_up_low.set()
+                    self._sig_io_switch_up_high.clear()  # arm since state change
+                # Callback for csv writer
+                if self._logging_switch_up_callback is not None:
+                    timestamp = dict["timestamp"] if dict["timestamp"] is not None else None
+
+                    self._logging_switch_up_callback(
+                        dict["name"], dict["state"] == 0, timestamp)
+
+        # self.send_dict(data)
 
     def close_connection(self):
         self._stop_recv_thread = True
@@ -163,82 +262,96 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
         l.pop('self', None)
         return l
 
+    # every command returns the CommandFuture of its reply, see
+    # apparatus.rpc
+
     def init_hw(self):
         args = self._localtodict(locals())
-        type = "command"
         func = self.init_hw.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
-        # Wait for done signal (blocking)
-        pass
+        # blocks until the hardware is initialized
+        return self._call(func, args).result()
 
     def hw_self_test(self):
         args = self._localtodict(locals())
-        type = "command"
         func = self.hw_self_test.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
-        # Wait for done signal (blocking)
-        pass
+        return self._call(func, args).result()
 
-    def play_sound(self, file=None, volume=90, timestamp=None):
+    def play_sound(self, file=None, volume=90, timestamp=None) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.play_sound.__name__
-        self._send_dict({"type": type, "func": func,
-                        "args": args})
-        pass
+        return self._call(func, args)
 
     def empty_human(self):
         args = self._localtodict(locals())
-        type = "command"
         func = self.empty_human.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
-        # Wait for done signal (blocking)
-        pass
+        return self._call(func, args).result()
 
-    def move_to(self, carousel_id, compartment_id, monkey=False, blocking=False):
+    def move_to(self, carousel_id, compartment_id, monkey=False, blocking=False) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.move_to.__name__
-        # Arm Event
-        self._sig_carousel[carousel_id]["_sig_move_to_wait"].clear()
-        self._send_dict({"type": type, "func": func, "args": args})
+        # done once the carousel reached the compartment
+        future = self._call(func, args)
+        if not self._batching():
+            # a move in a batch is done when it started
+            self._motion[carousel_id] = future
         if blocking:
-            self.move_to_wait(carousel_id)
-        pass
-
-    def move_to_wait(self, carousel_id, timeout=-1):
-        self._sig_carousel[carousel_id]["_sig_move_to_wait"].wait(timeout)
-        # Wait for move_to "done" signal to come back
-
-    def deploy(self, carousel_id, compartment_id, monkey=False, blocking=False):
+            future.result()
+        return future
+
+    def move_to_wait(self, carousel_id, timeout=None) -> bool:
+        """ waits for the last move_to or deploy of the carousel, returns
+        False on timeout """
+        future = self._motion[carousel_id]
+        if future is None:
+            return True
+        concurrent.futures.wait((future,), timeout)
+        return future.done()
+
+    def deploy(self, carousel_id, compartment_id, monkey=False, blocking=False) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.deploy.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
+        # done once the door is closed again
+        future = self._call(func, args)
+        if not self._batching():
+            # a move in a batch is done when it started
+            self._motion[carousel_id] = future
         if blocking:
-            self.deploy_wait(carousel_id)
-        pass
+            future.result()
+        return future
+
+    def deploy_wait(self, carousel_id, timeout=None) -> bool:
+        return self.move_to_wait(carousel_id, timeout)
 
-    def deploy_wait(self, carousel_id, timeout=-1):
-        self._sig_carousel[carousel_id]["_sig_deploy"].wait(timeout)
+    def estimate_move(self, carousel_id, compartment_id, monkey=False, deploy=False, timeout=None) -> float:
+        args = self._localtodict(locals())
+        args.pop('timeout')
+        func = self.estimate_move.__name__
+        try:
+            return self._call(func, args).result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None  # Timeout
+
+    def prepare_move(self, carousel_id, compartment_id, monkey=False):
+        """ the carousel renders the move during the inter-trial interval,
+        returns the future of the command """
+        args = self._localtodict(locals())
+        func = self.prepare_move.__name__
+        return self._call(func, args)
 
-    def set_test_light(self, state, color=None, timestamp=None):
+    def set_test_light(self, state, color=None, timestamp=None) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.set_test_light.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
+        return self._call(func, args)
 
-    def set_human_light(self, state, color=None):
+    def set_human_light(self, state, color=None) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.set_human_light.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
+        return self._call(func, args)
 
-    def set_light(self, color, timestamp=None):
+    def set_light(self, color, timestamp=None) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.set_light.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
+        return self._call(func, args)
 
     def get_wait_lever_state_event(self, pin_io, state) -> threading.Event:
         if pin_io == self.LEVER_TOUCH:
@@ -278,8 +391,7 @@ class ApparatusClient(apparatus.apparatus_interface.ApparatusInterface):
             # Wait for state "done" signal to come back
         return False  # False->Timeout
 
-    def set_lever_open(self, state, timestamp=None):
+    def set_lever_open(self, state, timestamp=None) -> CommandFuture:
         args = self._localtodict(locals())
-        type = "command"
         func = self.set_lever_open.__name__
-        self._send_dict({"type": type, "func": func, "args": args})
+        return self._call(func, args)
@@ -0,0 +1,327 @@
+import pickle
+import struct
+from datetime import datetime
+
+import numpy as np
+
+# commands by opcode, each with the order its args are packed in
+COMMANDS = (
+    ("init_hw", ()),
+    ("hw_self_test", ()),
+    ("play_sound", ("file", "volume", "timestamp")),
+    ("empty_human", ()),
+    ("move_to", ("carousel_id", "compartment_id", "monkey", "blocking")),
+    ("move_to_wait", ("carousel_id",)),
+    ("deploy", ("carousel_id", "compartment_id", "monkey", "blocking")),
+    ("deploy_wait", ("carousel_id",)),
+    ("estimate_move", ("carousel_id", "compartment_id", "monkey", "deploy")),
+    ("set_test_light", ("state", "color", "timestamp")),
+    ("set_human_light", ("state", "color")),
+    ("set_light", ("color", "timestamp")),
+    ("wait_lever_state", ("pin_io", "state", "timeout", "spinlock")),
+    ("set_lever_open", ("state", "timestamp")),
+    ("batch", ("commands", "timestamp")),
+    ("prepare_move", ("carousel_id", "compartment_id", "monkey")),
+)
+OPCODES = {name: opcode for opcode, (name, _) in enumerate(COMMANDS)}
+
+IO_NAMES = ("LEVER_SWITCH_IO", "LEVER_TOUCHS_IO", "LEVER_SWITCH_UP_IO")
+IO_NAME_IDS = {name: i for i, name in enumerate(IO_NAMES)}
+
+# message kinds, the first byte of a binary frame
+MSG_DICT = 0  # any other dict, keys and values tagged
+MSG_COMMAND = 1  # opcode, request id, args in COMMANDS order
+MSG_REPLY = 2  # success, request id, executed, type, msg, result
+MSG_IO_EVENT = 3  # pin, name, state, timestamp
+MSG_IO_CONFIRM = 4  # pin, name, state, confirmed, timestamp
+MSG_WAIT_EVENT = 5  # carousel, func opcode
+
+# request id 0 and executed 0 stand for none
+COMMAND = struct.Struct("<BBI")
+REPLY = struct.Struct("<B?Iq")
+IO_EVENT = struct.Struct("<BBBBq")
+IO_CONFIRM = struct.Struct("<BBBB?q")
+WAIT_EVENT = struct.Struct("<BBB")
+
+_INT64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+_COUNT = struct.Struct("<H")
+
+_REPLY_KEYS = frozenset(("type", "success", "msg", "id", "executed", "result"))
+
+
+def datetime_to_ns(timestamp: datetime) -> int:
+    """ ns since the epoch, naive datetimes are local time """
+    # a double resolves the epoch to well below 1 us, rounding keeps the
+    # microseconds of the datetime exact
+    return round(timestamp.timestamp() * 1e6) * 1000
+
+
+def ns_to_datetime(ns: int) -> datetime:
+    """ naive local datetime like datetime.now(), rounded to the microsecond """
+    return datetime.fromtimestamp(ns / 1e9)
+
+
+class PickleCodec(object):
+    """ The former wire format, kept for peers without the binary codec """
+
+    name = "pickle"
+
+    def encode(self, dict) -> bytes:
+        return pickle.dumps(dict)
+
+    def decode(self, frame) -> dict:
+        """ raises ValueError for a frame that is not a pickled message """
+        try:
+            return pickle.loads(frame)
+        except (pickle.UnpicklingError, EOFError, IndexError, AttributeError, ImportError, TypeError) as e:
+            raise ValueError("Malformed frame: %r" % e) from e
+
+
+class BinaryCodec(object):
+    """ Struct packed messages of the apparatus protocol.
+
+    Commands are sent as their opcode, request id and their args in the
+    order of COMMANDS, without the keys. Replies and events have fixed
+    layouts with the timestamps as int64 ns. Everything else is a dict of tagged values:
+    None, bool, int, float, str, datetime, list, tuple, set, frozenset and
+    dict, numpy scalars and arrays are sent as their Python values.
+    """
+
+    name = "binary"
+
+    def encode(self, dict) -> bytes:
+        type = dict.get("type")
+        try:
+            if type == "command" and "func" in dict:
+                return self._encode_command(dict)
+            if type == "io_event":
+                return IO_EVENT.pack(MSG_IO_EVENT, dict["pin_io"], IO_NAME_IDS[dict["name"]],
+                                     dict["state"], datetime_to_ns(dict["timestamp"]))
+            if type == "io_confirm_event":
+                return IO_CONFIRM.pack(MSG_IO_CONFIRM, dict["pin_io"], IO_NAME_IDS[dict["name"]],
+                                       dict["state"], dict["confirmed"], datetime_to_ns(dict["timestamp"]))
+            if type == "wait_event":
+                return WAIT_EVENT.pack(MSG_WAIT_EVENT, dict["carousel_id"], OPCODES[dict["func_name"]])
+            if "success" in dict and dict.keys() <= _REPLY_KEYS:
+                executed = dict.get("executed")
+                parts = [REPLY.pack(MSG_REPLY, dict["success"], dict.get("id", 0),
+                                    datetime_to_ns(executed) if executed is not None else 0)]
+                _encode_value(type, parts)
+                _encode_value(dict.get("msg"), parts)
+                _encode_value(dict.get("result"), parts)
+                return b"".join(parts)
+        except (KeyError, TypeError, struct.error):
+            # not the layout of its type, e.g. an unknown IO name
+            pass
+        parts = [bytes((MSG_DICT,))]
+        _encode_value(dict, parts)
+        return b"".join(parts)
+
+    def _encode_command(self, dict):
+        opcode = OPCODES[dict["func"]]
+        args = dict["args"]
+        arg_names = COMMANDS[opcode][1]
+        if len(args) != len(arg_names) or len(dict) != 3 + ("id" in dict):
+            # extra keys would be lost
+            raise KeyError(dict["func"])
+        parts = [COMMAND.pack(MSG_COMMAND, opcode, dict.get("id", 0))]
+        for name in arg_names:
+            _encode_value(args[name], parts)
+        return b"".join(parts)
+
+    def decode(self, frame) -> dict:
+        """ raises ValueError for a frame that is not a message, e.g. a truncated one """
+        try:
+            return self._decode(frame)
+        except (IndexError, KeyError, TypeError, struct.error, UnicodeDecodeError, OverflowError, OSError) as e:
+            raise ValueError("Malformed frame: %r" % e) from e
+
+    def _decode(self, frame):
+        kind = frame[0]
+        if kind == MSG_COMMAND:
+            _, opcode, request_id = COMMAND.unpack_from(frame)
+            name, arg_names = COMMANDS[opcode]
+            args = {}
+            offset = COMMAND.size
+            for arg in arg_names:
+                args[arg], offset = _decode_value(frame, offset)
+            command = {"type": "command", "func": name, "args": args}
+            if request_id:
+                command["id"] = request_id
+            return command
+        if kind == MSG_IO_EVENT:
+            _, pin_io, name, state, ns = IO_EVENT.unpack_from(frame)
+            return {"type": "io_event", "pin_io": pin_io, "name": IO_NAMES[name], "state": state,
+                    "timestamp": ns_to_datetime(ns)}
+        if kind == MSG_IO_CONFIRM:
+            _, pin_io, name, state, confirmed, ns = IO_CONFIRM.unpack_from(frame)
+            return {"type": "io_confirm_event", "pin_io": pin_io, "name": IO_NAMES[name], "state": state,
+                    "timestamp": ns_to_datetime(ns), "confirmed": confirmed}
+        if kind == MSG_WAIT_EVENT:
+            _, carousel_id, func = WAIT_EVENT.unpack_from(frame)
+            return {"type": "wait_event", "carousel_id": carousel_id, "func_name": COMMANDS[func][0]}
+        if kind == MSG_REPLY:
+            _, success, request_id, executed = REPLY.unpack_from(frame)
+            type, offset = _decode_value(frame, REPLY.size)
+            msg, offset = _decode_value(frame, offset)
+            result, offset = _decode_value(frame, offset)
+            reply = {"type": type, "success": success}
+            if msg is not None:
+                reply["msg"] = msg
+            if request_id:
+                reply["id"] = request_id
+            if executed:
+                reply["executed"] = ns_to_datetime(executed)
+            if result is not None:
+                reply["result"] = result
+            return reply
+        if kind == MSG_DICT:
+            return _decode_value(frame, 1)[0]
+        raise ValueError("Unknown message kind: %d" % kind)
+
+
+def _encode_none(value, parts):
+    parts.append(b"N")
+
+
+def _encode_bool(value, parts):
+    parts.append(b"T" if value else b"F")
+
+
+def _encode_int(value, parts):
+    parts.append(b"i" + _INT64.pack(value))
+
+
+def _encode_float(value, parts):
+    parts.append(b"d" + _DOUBLE.pack(value))
+
+
+def _encode_str(value, parts):
+    data = value.encode("utf-8")
+    parts.append(b"s" + _COUNT.pack(len(data)) + data)
+
+
+def _encode_datetime(value, parts):
+    parts.append(b"t" + _INT64.pack(datetime_to_ns(value)))
+
+
+def _encode_sequence(value, parts):
+    parts.append((b"l" if isinstance(value, list) else b"u") + _COUNT.pack(len(value)))
+    for item in value:
+        _encode_value(item, parts)
+
+
+def _encode_set(value, parts):
+    parts.append((b"e" if isinstance(value, set) else b"f") + _COUNT.pack(len(value)))
+    for item in value:
+        _encode_value(item, parts)
+
+
+def _encode_dict(value, parts):
+    parts.append(b"m" + _COUNT.pack(len(value)))
+    for key, item in value.items():
+        _encode_value(key, parts)
+        _encode_value(item, parts)
+
+
+# by exact type, subclasses fall back to the isinstance checks
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    datetime: _encode_datetime,
+    list: _encode_sequence,
+    tuple: _encode_sequence,
+    set: _encode_set,
+    frozenset: _encode_set,
+    dict: _encode_dict,
+}
+
+
+def _encode_value(value, parts):
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        if isinstance(value, np.generic):
+            # numpy scalars, e.g. np.int64 or np.bool_ from a calculation
+            return _encode_value(value.item(), parts)
+        if isinstance(value, np.ndarray):
+            return _encode_value(value.tolist(), parts)
+        # bool before int, it is a subclass
+        for base in (bool, int, float, str, datetime, list, tuple, set, frozenset, dict):
+            if isinstance(value, base):
+                encoder = _ENCODERS[base]
+                break
+        else:
+            raise TypeError("Not encodable: %r" % (value,))
+    encoder(value, parts)
+
+
+def _decode_sequence(frame, offset, tag):
+    count = _COUNT.unpack_from(frame, offset)[0]
+    offset += 2
+    items = []
+    for _ in range(count):
+        item, offset = _decode_value(frame, offset)
+        items.append(item)
+    if tag == 0x6C:
+        return items, offset
+    if tag == 0x75:
+        return tuple(items), offset
+    return (set(items) if tag == 0x65 else frozenset(items)), offset
+
+
+def _decode_str(frame, offset, tag):
+    length = _COUNT.unpack_from(frame, offset)[0]
+    offset += 2
+    if offset + length > len(frame):
+        raise ValueError("Truncated string")
+    return str(frame[offset:offset + length], "utf-8"), offset + length
+
+
+def _decode_dict(frame, offset, tag):
+    count = _COUNT.unpack_from(frame, offset)[0]
+    offset += 2
+    result = {}
+    for _ in range(count):
+        key, offset = _decode_value(frame, offset)
+        result[key], offset = _decode_value(frame, offset)
+    return result, offset
+
+
+_CONSTANTS = {ord("N"): None, ord("T"): True, ord("F"): False}
+_DECODERS = {
+    ord("i"): lambda frame, offset, tag: (_INT64.unpack_from(frame, offset)[0], offset + 8),
+    ord("d"): lambda frame, offset, tag: (_DOUBLE.unpack_from(frame, offset)[0], offset + 8),
+    ord("t"): lambda frame, offset, tag: (ns_to_datetime(_INT64.unpack_from(frame, offset)[0]), offset + 8),
+    ord("s"): _decode_str,
+    ord("l"): _decode_sequence,
+    ord("u"): _decode_sequence,
+    ord("e"): _decode_sequence,
+    ord("f"): _decode_sequence,
+    ord("m"): _decode_dict,
+}
+
+
+def _decode_value(frame, offset):
+    tag = frame[offset]
+    if tag in _CONSTANTS:
+        return _CONSTANTS[tag], offset + 1
+    decoder = _DECODERS.get(tag)
+    if decoder is None:
+        raise ValueError("Unknown tag: %d" % tag)
+    return decoder(frame, offset + 1, tag)
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), PickleCodec())}
+PICKLE = CODECS["pickle"]
+
+
+def negotiate(offered):
+    """ the first codec of the client's list that is known here, pickle otherwise """
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return PICKLE
@@ -0,0 +1,210 @@
+import collections
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from apparatus.stepgen import sleep_until_ns
+
+WAKE_AHEAD_NS = 2000000  # coarse wait ends this early, the rest is sleep_until_ns
+GROUP_WINDOW_NS = 500000  # commands this close to the first of a group fire with it
+HISTORY = 256  # firing errors kept for the report
+
+
+class ScheduledCommand(object):
+    """ A command queued on the CommandExecutor """
+
+    def __init__(self, target_ns, func, args):
+        """ class init
+        (1) target_ns type=int, help=perf_counter_ns at which func is called
+        (2) func type=callable, help=Called on the executor thread
+        (3) args type=tuple, help=Arguments of func
+        """
+        self.target_ns = target_ns
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.fired_ns = None
+        self.seq = None
+        self.result = None
+        self.error = None
+        self._done = False
+        self._done_callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def error_ns(self):
+        """ firing time minus target in ns, None until fired """
+        if self.fired_ns is None:
+            return None
+        return self.fired_ns - self.target_ns
+
+    def cancel(self):
+        """ returns False if the command already fired, a cancelled command
+        is done, its callbacks are called at once """
+        with self._lock:
+            if self.fired_ns is not None or self.cancelled:
+                return self.cancelled
+            self.cancelled = True
+        self._finish()
+        return True
+
+    def _fire(self):
+        """ marks the command as fired, False if it was cancelled """
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.fired_ns = time.perf_counter_ns()
+            return True
+
+    def add_done_callback(self, func):
+        """ calls func(command) once the command is done, at once if it is.
+        A fired command calls it on the callback thread of the executor,
+        after the rest of its group, a cancelled one on the thread that
+        cancelled it. """
+        with self._lock:
+            if not self._done:
+                self._done_callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done = True
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                logging.exception(e)
+
+
+class CommandExecutor(object):
+    """ Fires commands at a wall clock timestamp, e.g. the synchronized
+    lights and sounds of two rigs.
+
+    The timestamp is converted to perf_counter_ns once when the command is
+    queued. The executor thread waits coarsely until shortly before the
+    earliest command and spins the rest with sleep_until_ns. Commands whose
+    targets lie within GROUP_WINDOW_NS of each other fire back to back in
+    one wake up. The firing error of every command is recorded. The done
+    callbacks, e.g. the replies to the clients, run on a thread of their
+    own, so a slow client does not delay the next group.
+
+    There is one instance, see get.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ the executor, started on first use """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, wake_ahead_ns=WAKE_AHEAD_NS, group_window_ns=GROUP_WINDOW_NS):
+        self.wake_ahead_ns = wake_ahead_ns
+        self.group_window_ns = group_window_ns
+        self._heap = []  # (target_ns, seq, command)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+        self.fired = 0
+        self.groups = 0
+        self._errors = collections.deque(maxlen=HISTORY)  # ns
+
+        self._finished = queue.Queue()  # fired commands for _run_callbacks
+        self._thread = threading.Thread(
+            target=self._run, name="CommandExecutor", daemon=True)
+        self._thread.start()
+        self._callback_thread = threading.Thread(
+            target=self._run_callbacks, name="CommandExecutorCallbacks", daemon=True)
+        self._callback_thread.start()
+
+    def submit_at(self, timestamp, func, *args) -> ScheduledCommand:
+        """Queues func(*args) to be called at timestamp.
+
+        Args:
+            timestamp (datetime): Wall clock time, like datetime.now(). A time
+                in the past fires as soon as possible.
+            func (callable): Called on the executor thread, has to return quickly.
+
+        Returns:
+            ScheduledCommand: the handle, with the firing error once fired
+        """
+        delay = timestamp.timestamp() - time.time()
+        return self.submit_ns(time.perf_counter_ns() + int(delay * 1e9), func, *args)
+
+    def submit_ns(self, target_ns, func, *args) -> ScheduledCommand:
+        """ queues func(*args) to be called at perf_counter_ns target_ns """
+        command = ScheduledCommand(target_ns, func, args)
+        with self._cond:
+            command.seq = next(self._seq)
+            heapq.heappush(self._heap, (target_ns, command.seq, command))
+            if self._heap[0][2] is command:
+                self._cond.notify()
+        return command
+
+    def report(self):
+        with self._cond:
+            errors = np.array(self._errors, dtype=np.double) / 1e3
+        if not len(errors):
+            return "fired: 0"
+        return "fired: %d in %d groups, error: mean %.1f us, abs mean %.1f us, max %.1f us" % (
+            self.fired, self.groups, errors.mean(), np.abs(errors).mean(), np.abs(errors).max())
+
+    def _next_group(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                target_ns = self._heap[0][0]
+                remaining_ns = target_ns - time.perf_counter_ns()
+                if remaining_ns > self.wake_ahead_ns:
+                    # an earlier command wakes the wait
+                    self._cond.wait((remaining_ns - self.wake_ahead_ns) / 1e9)
+                    continue
+                group = []
+                while self._heap and self._heap[0][0] <= target_ns + self.group_window_ns:
+                    command = heapq.heappop(self._heap)[2]
+                    if not command.cancelled:
+                        group.append(command)
+                return target_ns, group
+
+    def _run(self):
+        while True:
+            target_ns, group = self._next_group()
+            sleep_until_ns(target_ns)
+            for command in group:
+                if not command._fire():
+                    continue
+                try:
+                    command.result = command.func(*command.args)
+                except Exception as e:
+                    logging.exception(e)
+                    command.error = e
+            # the callbacks, e.g. replies, do not delay the rest of the group
+            # nor the next one
+            for command in group:
+                if command.fired_ns is not None:
+                    self._finished.put(command)
+            with self._cond:
+                self.groups += 1
+                for command in group:
+                    if command.fired_ns is not None:
+                        self.fired += 1
+                        self._errors.append(command.error_ns)
+
+    def _run_callbacks(self):
+        while True:
+            self._finished.get()._finish()
@@ -1,3 +1,4 @@
+import asyncio
 from threading import Event, Thread
 from typing import List, Tuple
 
@@ -39,3 +40,29 @@ def joinThreads():
     for t in thread_list:
         if t is not None and t.is_alive():
             t.join()
+
+
+async def OrWaitAsync(*awaitables, timeout=None) -> Tuple[bool, int]:
+    """ waits for the first of the awaitables that returns a true result, e.g.
+    the wait_lever_state of two AsyncApparatusClients, and cancels the others.
+    One that returns a false result, e.g. a wait_lever_state that timed out,
+    does not count and the others are waited for. Returns whether one returned
+    true before the timeout and its index. """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    tasks = [asyncio.ensure_future(aw) for aw in awaitables]
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break  # timeout
+            for index, task in enumerate(tasks):
+                # an awaitable that raised raises here
+                if task in done and task.result():
+                    return True, index
+    finally:
+        for task in tasks:
+            task.cancel()
+    return False, None
@@ -0,0 +1,116 @@
+import threading
+
+HEADERSIZE = 4  # little endian length in front of every frame
+BUFFER_SIZE = 65536  # initial receive buffer, grown for larger frames
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """ payload with its length header """
+    return len(payload).to_bytes(HEADERSIZE, "little", signed=False) + payload
+
+
+class FrameDecoder(object):
+    """ Reassembles the length prefixed frames of a byte stream.
+
+    The stream is read with recv_into into one preallocated buffer, so a
+    frame may arrive in any number of pieces and several frames may arrive
+    in one read. Complete frames are returned as memoryview slices of the
+    buffer without copying, they are valid until the next read.
+    """
+
+    def __init__(self, size=BUFFER_SIZE):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first byte not consumed
+        self._end = 0  # end of the received bytes
+
+        # counters
+        self.decoded = 0
+        self.bytes = 0
+        self.reads = 0
+        self.grows = 0
+
+    def recv_from(self, sock) -> int:
+        """Reads what is available from sock, blocks like sock.recv_into.
+
+        Returns:
+            int: Bytes read, 0 if the peer closed the connection
+        """
+        self._make_room()
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        self.bytes += n
+        self.reads += 1
+        return n
+
+    def feed(self, data):
+        """ appends data, e.g. of a stream that is not a socket """
+        self._make_room(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        self.bytes += len(data)
+
+    def frames(self):
+        """ yields the complete frames received so far as memoryviews """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def next_frame(self):
+        """ the next complete frame as a memoryview, None if incomplete """
+        available = self._end - self._start
+        if available < HEADERSIZE:
+            return None
+        length = int.from_bytes(
+            self._view[self._start:self._start + HEADERSIZE], "little", signed=False)
+        if available < HEADERSIZE + length:
+            self._need = HEADERSIZE + length
+            return None
+        start = self._start + HEADERSIZE
+        self._start = start + length
+        self.decoded += 1
+        return self._view[start:self._start]
+
+    _need = 0  # size of the incomplete frame at _start
+
+    def _make_room(self, n=1):
+        pending = self._end - self._start
+        if not pending:
+            self._start = self._end = 0
+        # the incomplete frame and n more bytes have to fit behind _start
+        needed = max(pending + n, self._need)
+        self._need = 0
+        if needed > len(self._buf):
+            # a frame larger than the buffer, views into the old buffer stay valid
+            size = len(self._buf)
+            while size < needed:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+            self._start, self._end = 0, pending
+            self.grows += 1
+        elif self._start + needed > len(self._buf):
+            # move the incomplete frame to the front
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def report(self):
+        return "frames: %d, bytes: %d, reads: %d, frames per read: %.2f, buffer: %d, grows: %d" % (
+            self.decoded, self.bytes, self.reads, self.decoded / max(self.reads, 1), len(self._buf), self.grows)
+
+
+class FrameWriter(object):
+    """ Writes whole frames to a socket, serialized between threads """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, payload: bytes):
+        msg = encode_frame(payload)
+        with self._lock:
+            self._sock.sendall(msg)
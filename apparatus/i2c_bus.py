@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+I2C_BUS = 1  # the I2C bus of the Raspberry Pi header
+
+# transaction priorities, lower runs first
+PRIORITY_MOTION = 0  # encoder reads of a moving carousel
+PRIORITY_ACTUATOR = 1  # servo writes
+PRIORITY_TELEMETRY = 2  # everything else, e.g. idle encoder sampling
+
+RETRIES = 3  # retries of a failed transaction
+BACKOFF = .001  # s, doubled on every retry
+
+
+class I2CTransaction(object):
+    """ Completion handle of a transaction queued on an I2CBus """
+
+    def __init__(self, device, func, args, priority, key):
+        """ class init
+        (1) device type=int, help=I2C address, the metrics are kept per device
+        (2) func type=callable, help=Runs the transaction on the bus thread, its
+        return value is the result
+        (3) args type=tuple, help=Arguments of func
+        (4) priority type=int, help=PRIORITY_*, lower runs first
+        (5) key type=hashable, help=Writes with the same key are coalesced, None for reads
+        """
+        self.device = device
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.key = key
+
+        self.result = None
+        self.error = None
+        self.started = False
+        self.seq = None  # of its current place in the queue
+        self.submitted = time.perf_counter()
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ returns True once the transaction is finished, False on timeout """
+        return self._done.wait(timeout)
+
+    def get(self, timeout=None):
+        """ waits for the transaction, returns its result or raises its error """
+        if not self._done.wait(timeout):
+            raise TimeoutError("I2C 0x%02x: transaction timed out" % (self.device,))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class I2CDeviceStats(object):
+    """ Transaction metrics of one device """
+
+    def __init__(self):
+        self.transactions = 0
+        self.errors = 0  # transactions that failed after all retries
+        self.retries = 0
+        self.coalesced = 0  # writes merged into a queued one
+        self.wait_time = 0.  # s, queued before the transaction started
+        self.busy_time = 0.  # s, on the bus including retries
+        self.max_latency = 0.  # s, submit to finish
+        self.first = None  # perf_counter of the first transaction
+
+    def report(self):
+        n = max(self.transactions, 1)
+        elapsed = time.perf_counter() - self.first if self.first is not None else 0.
+        return "transactions: %d (%.1f/s), errors: %d, retries: %d, coalesced: %d, wait: %.3f ms, bus: %.3f ms, max latency: %.3f ms" % (
+            self.transactions, self.transactions / elapsed if elapsed > 0 else 0.,
+            self.errors, self.retries, self.coalesced,
+            self.wait_time / n * 1e3, self.busy_time / n * 1e3, self.max_latency * 1e3)
+
+
+class I2CBus(object):
+    """ Serializes the transactions of all devices on one I2C bus.
+
+    The encoders (smbus) and the servo board (busio) are used from the move
+    threads, the encoder samplers, the servo timers and the server thread.
+    All their transactions run on one thread in the order of their priority,
+    so the encoder reads of a moving carousel do not wait behind telemetry.
+    A queued write is replaced by a newer write with the same key, failed
+    transactions are retried with an exponential backoff.
+
+    There is one instance per bus, see get.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, bus=I2C_BUS):
+        """ the manager of the bus, created on first use """
+        with cls._instances_lock:
+            if bus not in cls._instances:
+                cls._instances[bus] = cls(bus)
+            return cls._instances[bus]
+
+    def __init__(self, bus=I2C_BUS, retries=RETRIES, backoff=BACKOFF):
+        """ class init, use get to share the manager
+        (1) bus type=int, help=Number of the I2C bus
+        (2) retries type=int, help=Retries of a failed transaction
+        (3) backoff type=float, help=Delay in s before the first retry, doubled on every retry
+        """
+        self.bus = bus
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {}  # device -> I2CDeviceStats
+
+        self._queue = []  # heap of (priority, seq, transaction)
+        self._seq = itertools.count()
+        self._writes = {}  # key -> queued write transaction
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="I2CBus-%d" % bus, daemon=True)
+        self._thread.start()
+
+    def submit(self, device, func, *args, priority=PRIORITY_TELEMETRY, key=None) -> I2CTransaction:
+        """Queues a transaction without waiting for it.
+
+        Args:
+            device (int): I2C address of the device.
+            func (callable): Runs the transaction on the bus thread.
+            priority (int, optional): PRIORITY_*, lower runs first. Defaults to PRIORITY_TELEMETRY.
+            key (hashable, optional): Write key, a queued write with the same key
+                is replaced by this one. Only for writes of a state, not for
+                command sequences. Defaults to None.
+
+        Returns:
+            I2CTransaction: the handle, shared with the replaced write if coalesced
+        """
+        with self._cond:
+            stats = self._device_stats(device)
+            transaction = self._writes.get(key) if key is not None else None
+            if transaction is not None:
+                # the newer write wins and moves to the end of the queue, so
+                # it stays behind writes queued in between
+                transaction.func = func
+                transaction.args = args
+                transaction.priority = priority
+                stats.coalesced += 1
+            else:
+                transaction = I2CTransaction(device, func, args, priority, key)
+                if key is not None:
+                    self._writes[key] = transaction
+            transaction.seq = next(self._seq)
+            heapq.heappush(self._queue, (priority, transaction.seq, transaction))
+            self._cond.notify()
+            return transaction
+
+    def call(self, device, func, *args, priority=PRIORITY_TELEMETRY, key=None):
+        """ runs a transaction and returns its result, see submit """
+        if threading.current_thread() is self._thread:
+            # nested in a transaction, the bus is ours already
+            return func(*args)
+        return self.submit(device, func, *args, priority=priority, key=key).get()
+
+    def pending(self):
+        """ number of queued transactions """
+        with self._cond:
+            return sum(seq == transaction.seq for _, seq, transaction in self._queue)
+
+    def report(self):
+        with self._cond:
+            return "\n".join("0x%02x: %s" % (device, stats.report())
+                             for device, stats in sorted(self.stats.items()))
+
+    def _device_stats(self, device):
+        stats = self.stats.get(device)
+        if stats is None:
+            stats = self.stats[device] = I2CDeviceStats()
+        return stats
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+                _, seq, transaction = heapq.heappop(self._queue)
+                # the former place of a coalesced write is skipped
+                if seq == transaction.seq:
+                    transaction.started = True
+                    if transaction.key is not None:
+                        del self._writes[transaction.key]
+                    return transaction
+
+    def _run(self):
+        while True:
+            transaction = self._next()
+            start = time.perf_counter()
+            retries = 0
+            while True:
+                try:
+                    transaction.result = transaction.func(*transaction.args)
+                except OSError as e:
+                    if retries >= self.retries:
+                        logging.error("I2C 0x%02x: %s" % (transaction.device, e))
+                        transaction.error = e
+                        break
+                    time.sleep(self.backoff * 2 ** retries)
+                    retries += 1
+                except Exception as e:
+                    logging.exception(e)
+                    transaction.error = e
+                    break
+                else:
+                    break
+            end = time.perf_counter()
+
+            with self._cond:
+                stats = self._device_stats(transaction.device)
+                if stats.first is None:
+                    stats.first = start
+                stats.transactions += 1
+                stats.retries += retries
+                stats.errors += transaction.error is not None
+                stats.wait_time += start - transaction.submitted
+                stats.busy_time += end - start
+                stats.max_latency = max(stats.max_latency, end - transaction.submitted)
+            transaction._done.set()
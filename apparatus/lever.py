@@ -1,15 +1,75 @@
 import logging
+import queue
 import threading
 import time
 from contextlib import contextmanager
+from datetime import datetime
 
 import RPi.GPIO as GPIO
 
 from apparatus.apparatus_config import config
 from apparatus.servo import Servo
+from apparatus.timer_service import TimerService
+
+
+class ButtonEvents(object):
+    """ Thread that ends the debounce windows of all ButtonHandlers.
+
+    The window is timed by the TimerService, its read and the CONFIRM or
+    RETRACT report run here, so a report that blocks on a slow client does
+    not hold up the other timers.
+
+    There is one instance, see get.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ the thread, started on first use """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="ButtonEvents", daemon=True)
+        self._thread.start()
+
+    def put(self, func, *args):
+        """ calls func(*args) on the thread """
+        self._queue.put((func, args))
+
+    def _run(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception(e)
 
 
 class ButtonHandler():
+    """ Leading edge debounce of an input.
+
+    The first edge is reported at once with the time of the interrupt, the
+    edges within bouncetime after it are bounces and ignored. At the end of
+    the window the level is read again: it confirms the edge, or retracts it
+    if the level did not hold.
+
+    func is called with (state, timestamp, status), status is
+    EDGE for a reported edge, CONFIRM with the state and timestamp of the
+    edge once it held, RETRACT with the level it fell back to. EDGE is
+    called on the GPIO event thread, CONFIRM and RETRACT on ButtonEvents.
+    """
+
+    EDGE = "edge"
+    CONFIRM = "confirm"
+    RETRACT = "retract"
+
     def __init__(self, pin, func, edge='both', bouncetime=50):
         GPIO.setup(pin, GPIO.IN)
         self.edge = edge
@@ -19,6 +79,12 @@ class ButtonHandler():
 
         self.lastpinval = GPIO.input(self.pin)
         self.lock = threading.Lock()
+        self._open = False  # debounce window of the last edge, until read
+
+        # counters
+        self.edges = 0
+        self.bounces = 0
+        self.retractions = 0
 
         gpioedge = GPIO.BOTH
 
@@ -30,25 +96,41 @@ class ButtonHandler():
         GPIO.add_event_detect(pin, gpioedge, callback=self.call)
 
     def call(self, *args):
-        if not self.lock.acquire(blocking=False):
-            return
-
-        t = threading.Timer(self.bouncetime, self.read, args=args)
-        t.start()
-
-    def read(self, *args):
-        pinval = GPIO.input(self.pin)
-
-        if (
-                ((pinval == 0 and self.lastpinval == 1) and
-                 (self.edge in ['falling', 'both'])) or
-                ((pinval == 1 and self.lastpinval == 0) and
-                 (self.edge in ['rising', 'both']))
-        ):
-            self.func(*args)
-
-        self.lastpinval = pinval
-        self.lock.release()
+        timestamp = datetime.now()
+        with self.lock:
+            if self._open:
+                self.bounces += 1
+                return
+            # the level might have bounced back already, an edge always
+            # toggles the reported state
+            pinval = 1 - self.lastpinval
+            self.lastpinval = pinval
+            self._open = True
+            TimerService.get().schedule(
+                self.bouncetime, ButtonEvents.get().put, self.read, pinval, timestamp)
+            self.edges += 1
+        if self._reported(pinval):
+            self.func(pinval, timestamp, self.EDGE)
+
+    def read(self, reported, timestamp):
+        """ ends the debounce window of the edge reported as state reported
+        at timestamp, the level read now confirms or retracts it """
+        with self.lock:
+            pinval = GPIO.input(self.pin)
+            self.lastpinval = pinval
+            self._open = False
+            if pinval != reported:
+                self.retractions += 1
+        if pinval == reported:
+            if self._reported(pinval):
+                self.func(pinval, timestamp, self.CONFIRM)
+        elif self._reported(reported):
+            self.func(pinval, datetime.now(), self.RETRACT)
+
+    def _reported(self, pinval):
+        if pinval:
+            return self.edge in ['rising', 'both']
+        return self.edge in ['falling', 'both']
 
 
 class Lever(object):
@@ -71,8 +153,10 @@ class Lever(object):
     switch_up_io_lock_target_state = None
     switch_up_io_handler = None
 
-    def __init__(self, switch_io, touch_io, switch_up_io, servo_id=0, servo_range=(0, 1), servo_timeout=0, io_callback=None):
+    def __init__(self, switch_io, touch_io, switch_up_io, servo_id=0, servo_range=(0, 1), servo_timeout=0, io_callback=None, servo_velocity=None, servo_speed=None, servo_latency=None):
         """ class init
+        servo_velocity (deg/s), servo_speed (us/s) and servo_latency (s)
+        configure the motion of the lock servo, see Servo.
         """
         self.switch_io = switch_io
         self.touch_io = touch_io
@@ -82,18 +166,19 @@ class Lever(object):
         self.switch_io_lock = threading.Lock()
         self.touch_io_lock = threading.Lock()
 
-        self.servo = Servo(self.channel, servo_range, servo_timeout)
+        self.servo = Servo(self.channel, servo_range, servo_timeout,
+                           velocity=servo_velocity, speed=servo_speed, latency=servo_latency)
 
         self.io_callback = io_callback
 
-        self.switch_io_handler = ButtonHandler(switch_io, lambda x: self.io_handler(
-            switch_io, "LEVER_SWITCH_IO"), bouncetime=config.lever["switch_io_bounce_time"])
+        self.switch_io_handler = ButtonHandler(switch_io, lambda *x: self.io_handler(
+            switch_io, "LEVER_SWITCH_IO", *x), bouncetime=config.lever["switch_io_bounce_time"])
 
-        self.touch_io_handler = ButtonHandler(touch_io, lambda x: self.io_handler(
-            touch_io, "LEVER_TOUCHS_IO"), bouncetime=config.lever["touch_io_bounce_time"])
+        self.touch_io_handler = ButtonHandler(touch_io, lambda *x: self.io_handler(
+            touch_io, "LEVER_TOUCHS_IO", *x), bouncetime=config.lever["touch_io_bounce_time"])
 
-        self.touch_io_handler = ButtonHandler(switch_up_io, lambda x: self.io_handler(
-            switch_up_io, "LEVER_SWITCH_UP_IO"), bouncetime=config.lever["switch_up_io_bounce_time"])
+        self.touch_io_handler = ButtonHandler(switch_up_io, lambda *x: self.io_handler(
+            switch_up_io, "LEVER_SWITCH_UP_IO", *x), bouncetime=config.lever["switch_up_io_bounce_time"])
 
     @property
     def lever_open(self):
@@ -160,8 +245,12 @@ class Lever(object):
                     logging.info("timeout")
                     return False
 
-    def io_handler(self, pin_io, name):
-        state = GPIO.input(pin_io)
+    def io_handler(self, pin_io, name, state, timestamp, status=ButtonHandler.EDGE):
+        if status == ButtonHandler.CONFIRM:
+            # the state is reported already
+            if self.io_callback:
+                self.io_callback(pin_io, name, state, timestamp, status)
+            return
         if pin_io == self.switch_io and self.switch_io_lock_target_state is not None and self.switch_io_lock_target_state == state:
             self.switch_io_lock_target_state = None  # Disable release on switch
             logging.debug("release lock switch")
@@ -176,7 +265,7 @@ class Lever(object):
             self.switch_up_io_lock.release()
         # callback
         if self.io_callback:
-            self.io_callback(pin_io, name, state)
+            self.io_callback(pin_io, name, state, timestamp, status)
         if state:
             logging.info(name+' HIGH!')
         else:
@@ -0,0 +1,46 @@
+import collections
+import threading
+
+import numpy as np
+
+
+class MotionModel(object):
+    """ Calibration of predicted move durations against measured ones.
+
+    The kinematic duration of a move (planned step times, wake up and settle
+    times) misses overheads like the encoder reads and the thread hand over.
+    A linear fit measured = scale * predicted + offset over the most recent
+    moves corrects for them.
+    """
+
+    HISTORY = 64  # moves used for the fit
+
+    def __init__(self, history=HISTORY):
+        self.scale = 1.
+        self.offset = 0.
+        self._samples = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def record(self, predicted, measured):
+        """Adds a measured move and refits the model.
+
+        Args:
+            predicted (float): Kinematic duration of the move in s.
+            measured (float): Measured duration of the move in s.
+        """
+        with self._lock:
+            self._samples.append((predicted, measured))
+            predicted, measured = np.array(self._samples).T
+            if len(self._samples) >= 3 and np.ptp(predicted) > .1:
+                self.scale, self.offset = np.polyfit(predicted, measured, 1)
+            else:
+                # too few or too similar moves for a slope
+                self.scale = 1.
+                self.offset = float(np.mean(measured - predicted))
+
+    def predict(self, predicted):
+        """ calibrated duration in s of a move with the kinematic duration predicted """
+        return max(self.scale * predicted + self.offset, 0.)
+
+    def report(self):
+        return "moves: %d, scale: %.3f, offset: %.3f s" % (len(self._samples), self.scale, self.offset)
@@ -0,0 +1,160 @@
+import functools
+import math
+
+import numpy as np
+
+from apparatus.motion_profile import PROFILE_CACHE_SIZE
+
+# Resolution of the time grid the step times are sampled from
+PLANNER_GRID_S = 0.00002
+
+
+def _accel_segments(dv, max_accel, max_jerk):
+    """Segments (duration, start acceleration, jerk) that raise the velocity by dv
+    as fast as the acceleration and jerk limits allow."""
+    if dv <= 0:
+        return []
+    if not max_jerk:
+        # trapezoidal: constant acceleration
+        return [(dv / max_accel, max_accel, 0.)]
+    t_jerk = max_accel / max_jerk
+    if dv >= max_accel * t_jerk:
+        # S-curve that reaches max_accel
+        t_const = dv / max_accel - t_jerk
+        return [(t_jerk, 0., max_jerk),
+                (t_const, max_accel, 0.),
+                (t_jerk, max_accel, -max_jerk)]
+    # S-curve that never reaches max_accel
+    t_jerk = math.sqrt(dv / max_jerk)
+    peak_accel = max_jerk * t_jerk
+    return [(t_jerk, 0., max_jerk),
+            (t_jerk, peak_accel, -max_jerk)]
+
+
+def _accel_duration(dv, max_accel, max_jerk):
+    return sum(segment[0] for segment in _accel_segments(dv, max_accel, max_jerk))
+
+
+def _plan_segments(distance, start_velocity, max_velocity, max_accel, max_jerk):
+    """Rest to rest (start_velocity to start_velocity) segments of a move over
+    distance, symmetric ramps and a cruise at the highest reachable velocity."""
+
+    def ramp_distance(v):
+        # a symmetric ramp averages the start and end velocity
+        return (start_velocity + v) / 2 * _accel_duration(v - start_velocity, max_accel, max_jerk)
+
+    peak = max_velocity
+    if 2 * ramp_distance(peak) > distance:
+        # never reaches max_velocity, search the peak velocity of a triangle move
+        low, high = start_velocity, max_velocity
+        for _ in range(60):
+            peak = (low + high) / 2
+            if 2 * ramp_distance(peak) > distance:
+                high = peak
+            else:
+                low = peak
+        peak = low
+
+    ramp = _accel_segments(peak - start_velocity, max_accel, max_jerk)
+    cruise = distance - 2 * ramp_distance(peak)
+    segments = list(ramp)
+    if cruise > 0:
+        segments.append((cruise / peak, 0., 0.))
+    # the deceleration mirrors the acceleration
+    segments += [(duration, -accel - jerk * duration, jerk)
+                 for duration, accel, jerk in reversed(ramp)]
+    return segments
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def scurve_profile(steps, start_velocity, max_velocity, max_accel, max_jerk) -> np.ndarray:
+    """Builds the half step delay table of a jerk limited move. All limits are in steps.
+
+    Args:
+        steps (int): Number of steps of the move.
+        start_velocity (float): Velocity the motor can start and stop at without ramp in steps/s.
+        max_velocity (float): Cruise velocity in steps/s.
+        max_accel (float): Acceleration limit in steps/s^2.
+        max_jerk (float): Jerk limit in steps/s^3, 0 or None for a trapezoidal profile.
+
+    Returns:
+        np.ndarray: Read only int64 array of 2*steps delays in ns
+    """
+    if steps <= 0:
+        delays_ns = np.zeros(0, dtype=np.int64)
+        delays_ns.setflags(write=False)
+        return delays_ns
+
+    segments = _plan_segments(
+        steps, start_velocity, max_velocity, max_accel, max_jerk)
+
+    # sample the piecewise cubic position on a fine grid
+    times = [np.zeros(1)]
+    positions = [np.zeros(1)]
+    t0 = s0 = 0.
+    v0 = start_velocity
+    for duration, accel, jerk in segments:
+        t = np.arange(1, max(2, int(math.ceil(duration / PLANNER_GRID_S))) + 1)
+        t = t * (duration / t[-1])
+        times.append(t0 + t)
+        positions.append(s0 + v0 * t + accel * t ** 2 / 2 + jerk * t ** 3 / 6)
+        t0 += duration
+        s0 += v0 * duration + accel * duration ** 2 / 2 + jerk * duration ** 3 / 6
+        v0 += accel * duration + jerk * duration ** 2 / 2
+    times = np.concatenate(times)
+    positions = np.concatenate(positions)
+
+    # the step pulse is centered on the half step position
+    edges = np.interp(np.arange(steps) + 0.5, positions, times)
+    periods = np.diff(edges)
+    periods = np.append(periods, periods[-1] if len(periods) else 1 / start_velocity)
+    delays_ns = np.rint(np.repeat(periods / 2, 2) * 1e9).astype(np.int64)
+    delays_ns.setflags(write=False)
+    return delays_ns
+
+
+class MotionPlanner(object):
+    """ Time optimal S-curve (or trapezoidal) planner for a stepper axis.
+
+    Limits are given in degrees of the driven axis and converted to steps with
+    step_angle, so they do not change with the microstep resolution.
+    """
+
+    def __init__(self, step_angle, max_velocity, max_accel, max_jerk=None, start_velocity=None):
+        """ class init
+        (1) step_angle type=float, help=Angle in degrees of a single step
+        (2) max_velocity type=float, help=Cruise velocity in deg/s
+        (3) max_accel type=float, help=Acceleration limit in deg/s^2
+        (4) max_jerk type=float, help=Jerk limit in deg/s^3, None for a trapezoidal profile
+        (5) start_velocity type=float, help=Velocity in deg/s the motor starts and
+        stops at without ramp. Defaults to a tenth of max_velocity.
+        """
+        if start_velocity is None:
+            start_velocity = max_velocity / 10
+        if not 0 < start_velocity <= max_velocity or max_accel <= 0:
+            raise ValueError("invalid motion limits")
+        self.step_angle = step_angle
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.max_jerk = max_jerk
+        self.start_velocity = start_velocity
+
+    def _limits(self):
+        # in steps
+        return (
+            self.start_velocity / self.step_angle,
+            self.max_velocity / self.step_angle,
+            self.max_accel / self.step_angle,
+            self.max_jerk / self.step_angle if self.max_jerk else 0,
+        )
+
+    def delays(self, steps) -> np.ndarray:
+        """ cached delay table of a move in ns, one entry per half step """
+        return scurve_profile(abs(int(steps)), *self._limits())
+
+    def estimate_duration(self, steps) -> float:
+        """ planned duration of a move in s """
+        steps = abs(int(steps))
+        if steps == 0:
+            return 0.
+        return sum(segment[0] for segment in _plan_segments(steps, *self._limits()))
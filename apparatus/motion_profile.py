@@ -0,0 +1,40 @@
+import functools
+
+import numpy as np
+
+# Number of step tables kept, moves are keyed by (steps, profile parameters)
+PROFILE_CACHE_SIZE = 64
+
+# Default sigmoid ramp of NemaMotor (c_1, c_2, max, min)
+SIGMOID_PROFILE = (0.2, 20, 0.00120, 0.00060)
+
+
+def sigmoid(x, c_1, c_2, max, min):
+    return ((max - min) / (1 + np.exp(-c_1 * (x - c_2)))) + min
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def sigmoid_profile(steps, c_1, c_2, max, min) -> np.ndarray:
+    """Builds the half step delay table of a move with a sigmoid ramp up and down.
+    Vectorized version of NemaMotor.motor_times for every half step of the move.
+
+    Args:
+        steps (int): Number of steps of the move.
+        c_1 (float): Slope of the ramp.
+        c_2 (float): Step at which the ramp reaches half speed.
+        max (float): Longest half step delay in s (start and end of the move).
+        min (float): Shortest half step delay in s (cruise).
+
+    Returns:
+        np.ndarray: Read only int64 array of 2*steps delays in ns
+    """
+    step = np.arange(2 * steps) // 2 + 1
+    x = np.where(step <= steps / 2, step, steps - step - 1)
+    delays = max + min - sigmoid(x, c_1, c_2, max, min)
+    delays_ns = np.rint(delays * 1e9).astype(np.int64)
+    delays_ns.setflags(write=False)
+    return delays_ns
+
+
+def cache_info():
+    return sigmoid_profile.cache_info()
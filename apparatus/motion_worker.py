@@ -0,0 +1,176 @@
+import logging
+import queue
+import threading
+
+
+class MotionCommand(object):
+    """ Completion handle of a command run by a MotionWorker """
+
+    def __init__(self, name, func, args=(), callback=None):
+        """ class init
+        (1) name type=string, help=Name of the command, e.g. move_to
+        (2) func type=callable, help=Called with the command on the worker thread,
+        its return value is the result of the command
+        (3) args type=tuple, help=Arguments of the command, may be replaced by retarget
+        (4) callback type=callable, help=Called without arguments once the command is finished
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.callback = callback
+
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+        self._followers = []  # commands merged into this one by retarget
+        self._leader = None  # command this one is merged into
+        self._settled = False
+        self._lock = threading.Lock()
+        self._interrupt = threading.Event()
+        self._done = threading.Event()
+        self._done_callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ returns True once the command is finished, False on timeout """
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, func):
+        """ calls func(command) once the command is finished, at once if it
+        already is """
+        with self._lock:
+            if not self._done.is_set():
+                self._done_callbacks.append(func)
+                return
+        func(self)
+
+    def cancel(self):
+        """ cancels the command, a running move is stopped on its deceleration ramp """
+        if self._leader is not None:
+            return self._leader.cancel()
+        with self._lock:
+            if self._settled:
+                return False
+            self.cancelled = True
+            self._interrupt.set()
+        for follower in self._followers:
+            follower.cancelled = True
+        return True
+
+    def interrupted(self):
+        """ True if the running command should stop its current motion """
+        return self._interrupt.is_set()
+
+    def retarget(self, args, follower=None):
+        """Replaces the arguments of a running command.
+
+        Args:
+            args (tuple): New arguments.
+            follower (MotionCommand, optional): Handle finished together with this command. Defaults to None.
+
+        Returns:
+            bool: False if the command is already finishing and can not be retargeted
+        """
+        with self._lock:
+            if self._settled or self.cancelled:
+                return False
+            self.args = args
+            if follower is not None:
+                follower._leader = self
+                self._followers.append(follower)
+            self._interrupt.set()
+            return True
+
+    def settle(self):
+        """ called by func when its motion is finished, returns False if it
+        was retargeted in the meantime and has to continue with the new args """
+        with self._lock:
+            if self._interrupt.is_set() and not self.cancelled:
+                self._interrupt.clear()
+                return False
+            self._settled = True
+            return True
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._settled = True
+        for command in [self] + self._followers:
+            with command._lock:
+                command.result = result
+                command.error = error
+                command._done.set()
+                callbacks, command._done_callbacks = command._done_callbacks, []
+            if command.callback is not None:
+                try:
+                    command.callback()
+                except Exception as e:
+                    logging.exception(e)
+            for func in callbacks:
+                try:
+                    func(command)
+                except Exception as e:
+                    logging.exception(e)
+
+
+class MotionWorker(object):
+    """ Long-lived thread that runs the motion commands of one axis in order.
+
+    Commands are queued in a bounded queue, submit never blocks the caller.
+    """
+
+    QUEUE_SIZE = 8
+
+    current: MotionCommand = None
+
+    def __init__(self, name="MotionWorker", queue_size=QUEUE_SIZE):
+        self._commands = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, command: MotionCommand) -> MotionCommand:
+        try:
+            self._commands.put_nowait(command)
+        except queue.Full:
+            raise RuntimeError("%s: command queue full" %
+                               (self._thread.name,))
+        return command
+
+    def pending(self):
+        """ number of queued commands that are not started yet """
+        return self._commands.qsize()
+
+    def cancel(self):
+        """ cancels the running and all queued commands """
+        for command in list(self._commands.queue):
+            command.cancel()
+        command = self.current
+        if command is not None:
+            command.cancel()
+
+    def stop(self):
+        self.cancel()
+        self._commands.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            if command.cancelled:
+                command._finish()
+                continue
+            self.current = command
+            try:
+                result = command.func(command)
+            except Exception as e:
+                logging.exception(e)
+                command._finish(error=e)
+            else:
+                command._finish(result)
+            finally:
+                self.current = None
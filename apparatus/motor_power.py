@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from apparatus.timer_service import TimerHandle, TimerService
+
+
+class MotorPower(object):
+    """ Power state of a stepper driver.
+
+    Keeps the driver energized while moves are expected and only de-energizes
+    it after an idle window without moves or holds. A move that starts while
+    the driver is still energized skips the wake up delay.
+    """
+
+    _timer: TimerHandle = None
+
+    def __init__(self, enable, idle_timeout=0):
+        """ class init
+        (1) enable type=callable, help=Switches the driver, enable(True) energizes it
+        (2) idle_timeout type=float, help=Time in s without moves after which the
+        driver is de-energized, never if <= 0
+        """
+        self._enable = enable
+        self.idle_timeout = idle_timeout
+        self.energized = False
+        self._energized_at = 0.
+        self._holds = 0
+        self._generation = 0  # of the idle timer, a fired timer of an older one is stale
+        self._lock = threading.RLock()
+
+        # counters
+        self.enable_transitions = 0
+        self.disable_transitions = 0
+        self.wakeups_skipped = 0
+        self.latency_saved = 0.  # s
+
+    def on(self):
+        with self._lock:
+            self._cancel_timer()
+            if not self.energized:
+                self._enable(True)
+                self.energized = True
+                self._energized_at = time.perf_counter()
+                self.enable_transitions += 1
+
+    def off(self):
+        with self._lock:
+            self._cancel_timer()
+            if self.energized:
+                self._enable(False)
+                self.energized = False
+                self.disable_transitions += 1
+
+    def acquire(self, wake_delay=.05):
+        """Energizes the driver for a move.
+
+        Args:
+            wake_delay (float, optional): Time in s the driver needs after being energized. Defaults to .05.
+
+        Returns:
+            float: The part of wake_delay that is still to be waited before stepping
+        """
+        with self._lock:
+            was_energized = self.energized
+            self.on()
+            remaining = max(0., wake_delay -
+                            (time.perf_counter() - self._energized_at))
+            if was_energized:
+                self.wakeups_skipped += 1
+                self.latency_saved += wake_delay - remaining
+            return remaining
+
+    def release(self):
+        """ a move is finished, de-energize after the idle window unless held """
+        with self._lock:
+            self._start_timer()
+
+    def hold(self):
+        """ keep the driver energized until unhold, e.g. for the duration of a trial """
+        with self._lock:
+            self._holds += 1
+            self.on()
+
+    def unhold(self):
+        with self._lock:
+            self._holds = max(0, self._holds - 1)
+            self._start_timer()
+
+    @contextmanager
+    def held(self):
+        self.hold()
+        try:
+            yield self
+        finally:
+            self.unhold()
+
+    def report(self):
+        return "energized: %s, enable transitions: %d, disable transitions: %d, wake ups skipped: %d, latency saved: %.3f s" % (
+            self.energized,
+            self.enable_transitions,
+            self.disable_transitions,
+            self.wakeups_skipped,
+            self.latency_saved,
+        )
+
+    def _start_timer(self):
+        self._cancel_timer()
+        if self.idle_timeout <= 0 or self._holds or not self.energized:
+            return
+        self._timer = TimerService.get().schedule(
+            self.idle_timeout, self._idle, self._generation)
+
+    def _cancel_timer(self):
+        # a timer that fired already may be waiting for the lock
+        self._generation += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _idle(self, generation):
+        with self._lock:
+            if generation != self._generation or self._holds:
+                # cancelled after it fired, e.g. by the acquire of a move
+                return
+            self.off()
+            logging.debug("MotorPower idle: %s" % self.report())
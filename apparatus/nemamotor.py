@@ -7,20 +7,40 @@ import time
 
 import RPi.GPIO as GPIO
 
+from apparatus.motion_planner import MotionPlanner
+from apparatus.motion_profile import SIGMOID_PROFILE, sigmoid_profile
+from apparatus.motor_power import MotorPower
+from apparatus.stepgen import StepGenerator, StepJob
+from apparatus.waveform import GPIOBackend, Waveform, WaveformBackend
+
 
 class NemaMotor(object):
     """ Class to control a Nema bi-polar stepper motor with a TMC2209 """
 
-    _timer: threading.Timer = None
-    _nema_timeout: float = 0
+    _generator: StepGenerator = None
+    backend: WaveformBackend = None
+    last_job: StepJob = None
+    planner: MotionPlanner = None
+    power: MotorPower = None
+
+    # sigmoid ramp (c_1, c_2, max, min) used by motor_times and motor_delays
+    profile = SIGMOID_PROFILE
 
-    def __init__(self, direction_pin, step_pin, enable_pin, mode_pins=None, spread_pin=None, motor_type="TMC2209", nema_timeout=0):
+    def __init__(self, direction_pin, step_pin, enable_pin, mode_pins=None, spread_pin=None, motor_type="TMC2209", nema_timeout=0, step_generator=None, planner=None, backend=None):
         """ class init method 3 inputs
         (1) direction type=int , help=GPIO pin connected to DIR pin of IC
         (2) step_pin type=int , help=GPIO pin connected to STEP of IC
         (3) mode_pins type=tuple of 2 ints, help=GPIO pins connected to
         Microstep Resolution pins MS1-MS2 of IC
         (4) motor_type type=string, help=TYpe of motor two options: TMC2209 or DRV8825
+        (5) step_generator type=StepGenerator, help=Generator thread that plays
+        the step pulses. A dedicated one is started if None.
+        (6) planner type=MotionPlanner, help=Plans the step times of a move.
+        The sigmoid ramp of motor_times is used if None.
+        (7) backend type=WaveformBackend, help=Plays the rendered moves.
+        Bit-banged with RPi.GPIO by the step_generator if None.
+        (8) nema_timeout type=float, help=Idle time in s after the last move
+        before the driver is de-energized, never if <= 0.
         """
         self.motor_type = motor_type
         self.direction_pin = direction_pin
@@ -29,14 +49,23 @@ class NemaMotor(object):
         self.mode_pins = mode_pins
         self.spread_pin = spread_pin
 
-        self._nema_timeout = nema_timeout
+        self.power = MotorPower(self.motor_enable, nema_timeout)
+        self.planner = planner
 
         self.running = threading.Lock()
 
+        if step_generator is None:
+            step_generator = StepGenerator(
+                GPIO.output, name="NemaMotor-%d" % (step_pin,))
+        self._generator = step_generator
+        if backend is None:
+            backend = GPIOBackend(GPIO.output, step_generator)
+        self.backend = backend
+
         GPIO.setwarnings(False)
 
     def cleanup(self):
-        self.motor_enable(False)
+        self.power.off()
         # GPIO.cleanup()
 
     def resolution_set(self, steptype):
@@ -65,24 +94,43 @@ class NemaMotor(object):
         GPIO.output(self.enable_pin,
                     GPIO.LOW if enable else GPIO.HIGH)  # Enable
 
-    def motor_step(self, steps, step=0, state=False):
-        if step == 0:
-            self.running.acquire()
-        if state:
-            state = False
-        else:
-            step += 1
-            state = True
-
-        GPIO.setmode(GPIO.BCM)
-
-        GPIO.output(self.step_pin, state)
+    def render_move(self, steps, clockwise=False, initdelay=0, planner=None) -> Waveform:
+        """ render_move, plans a move into a waveform that can be played
+        later by motor_go, e.g. prepared during an inter-trial interval.
+        The enable and direction edges are followed by the step train after
+        initdelay s. motor_go waits for the driver to wake up itself, so
+        initdelay is only needed if the waveform is played elsewhere. planner overrides the planner of the motor, e.g. for
+        a segment at a different microstep resolution.
+        """
+        if steps < 0:
+            steps = -steps
+            clockwise = not clockwise
+        return Waveform.from_move(
+            self.step_pin,
+            self.motor_delays(steps, planner),
+            dir_pin=self.direction_pin,
+            clockwise=clockwise,
+            enable_pin=self.enable_pin,
+            enable_level=GPIO.LOW,
+            setup_ns=int(initdelay * 1e9),
+        )
 
-        if step < steps:
-            threading.Timer(self.motor_times(step, steps),
-                            self.motor_step, args=[steps, step, state]).start()
-        else:
+    def motor_step(self, steps=0, waveform=None):
+        self.running.acquire()
+        if waveform is None:
+            waveform = Waveform.from_move(
+                self.step_pin, self.motor_delays(steps))
+        try:
+            self.last_job = self.backend.play(
+                waveform, callback=self._motor_step_finished)
+        except Exception:
             self.running.release()
+            raise
+        return self.last_job
+
+    def _motor_step_finished(self, job):
+        logging.debug("NemaMotor %d: %s" % (self.step_pin, job.report()))
+        self.running.release()
 
     def wait_finished(self):
         self.running.acquire()
@@ -92,7 +140,8 @@ class NemaMotor(object):
         self.running.lo
 
     def motor_go(self, clockwise=False, steptype="1/8",
-                 steps=200, stepdelay=.001, verbose=False, initdelay=.05):
+                 steps=200, stepdelay=.001, verbose=False, initdelay=.05,
+                 monitor=None, monitor_interval=.005, waveform=None):
         """ motor_go,  moves stepper motor based on 6 inputs
 
          (1) clockwise, type=bool default=False
@@ -108,27 +157,40 @@ class NemaMotor(object):
          help="Write pin actions",
          (6) initdelay, type=float, default=1mS, help= Intial delay after
          GPIO pins initialized but before motor is moved.
+         (7) monitor, type=callable, default=None, help=Called with the
+         running StepJob every monitor_interval s, may retarget or cancel it.
+         (8) monitor_interval, type=float, default=5mS
+         (9) waveform, type=Waveform, default=None, help=Move rendered by
+         render_move, replaces clockwise and steps.
+
+        initdelay is only waited if the driver was de-energized, see MotorPower.
 
         """
-        if steps < 0:
-            steps = -steps
-            clockwise = not clockwise
+        if waveform is None:
+            waveform = self.render_move(steps, clockwise)
+        steps = waveform.steps
 
         # setup GPIO
-        self.motor_enable()
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.enable_pin, GPIO.OUT)
         GPIO.setup(self.direction_pin, GPIO.OUT)
         GPIO.setup(self.step_pin, GPIO.OUT)
 
-        GPIO.output(self.direction_pin, clockwise)
         if self.mode_pins:
             GPIO.setup(self.mode_pins, GPIO.OUT)
 
         try:
             # dict resolution
             self.resolution_set(steptype)
-            time.sleep(initdelay)
 
-            self.motor_step(steps)
+            # skips initdelay if the driver is still energized
+            time.sleep(self.power.acquire(initdelay))
+
+            # direction is part of the waveform
+            job = self.motor_step(waveform=waveform)
+            if monitor is not None:
+                while not job.wait(monitor_interval):
+                    monitor(job)
 
             self.wait_finished()
 
@@ -155,11 +217,11 @@ class NemaMotor(object):
             # cleanup
             GPIO.output(self.step_pin, False)
             GPIO.output(self.direction_pin, False)
-            GPIO.output(self.enable_pin, False)
             if self.mode_pins:
                 for pin in self.mode_pins:
                     GPIO.output(pin, False)
-        self._startTimeout()
+        self.power.release()
+        return self.last_job
 
     # import math
     # [sigmoid(x) for x in range(-10,10)]
@@ -167,10 +229,7 @@ class NemaMotor(object):
         return ((max - min) / (1 + math.exp(-c_1 * (x - c_2)))) + min
 
     def motor_times(self, step, steps):
-        c_1 = 0.2
-        c_2 = 20
-        max = 0.00120
-        min = 0.00060
+        c_1, c_2, max, min = self.profile
         x = 0
 
         if(step <= steps / 2):
@@ -180,17 +239,22 @@ class NemaMotor(object):
 
         return max + min - self.sigmoid(x, c_1, c_2, max, min)
 
-    # [motor_times(x, 50) for x in range(0, 50)]
+    def motor_delays(self, steps, planner=None):
+        """ cached delay table of a move in ns, one entry per half step """
+        if planner is None:
+            planner = self.planner
+        if planner is not None:
+            return planner.delays(steps)
+        return sigmoid_profile(steps, *self.profile)
 
-    def _startTimeout(self):
-        if self._nema_timeout <= 0:
-            return
-        if self._timer is not None:
-            self._timer.cancel()
-        # Disable Servo after "_servo_timeout" sec.
-        self._timer = threading.Timer(
-            interval=self._nema_timeout,
-            function=self.motor_enable,
-            args=(False,),
-        )
-        self._timer.start()
+    def estimate_duration(self, steps, planner=None):
+        """ duration of the step pulses of a move in s """
+        delays = self.motor_delays(abs(int(steps)), planner)
+        return delays[:-1].sum() / 1e9 if len(delays) else 0.
+
+    def warm_profiles(self, steps_list):
+        """ precompute the delay tables of moves that are known to be common """
+        for steps in steps_list:
+            self.motor_delays(abs(int(steps)))
+
+    # [motor_times(x, 50) for x in range(0, 50)]
@@ -0,0 +1,167 @@
+import threading
+from contextlib import contextmanager
+
+import board
+from adafruit_pca9685 import PCA9685
+
+from apparatus.i2c_bus import PRIORITY_ACTUATOR, I2CBus
+
+PCA9685_ADDRESS = 0x43  # servo board of the apparatus
+PCA9685_FREQUENCY = 50  # Hz, servo frame rate
+PCA9685_CHANNELS = 16
+
+LED0_ON_L = 0x06  # LEDn registers: 0x06 + 4 * n, ON_L, ON_H, OFF_L, OFF_H
+MODE1_AI = 0x20  # register auto increment
+FULL = 0x1000  # full on / full off bit of the ON_H / OFF_H register pair
+
+
+class PCA9685Driver(object):
+    """ Shared, thread-safe driver of one PCA9685.
+
+    There is one instance per I2C address, see get. The ON/OFF counts of
+    every channel are cached, so writes that do not change a channel are
+    skipped. Inside batch() the writes of all threads are collected and
+    written on exit in one auto-increment transaction over the register
+    range of the changed channels. The transactions run on the I2CBus, a
+    queued write of a register range is replaced by a newer one.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, address=PCA9685_ADDRESS, frequency=PCA9685_FREQUENCY):
+        """ the driver of the chip at address, created on first use """
+        with cls._instances_lock:
+            if address not in cls._instances:
+                cls._instances[address] = cls(address, frequency)
+            return cls._instances[address]
+
+    def __init__(self, address=PCA9685_ADDRESS, frequency=PCA9685_FREQUENCY):
+        """ class init, use get to share the driver
+        (1) address type=int, help=I2C address of the PCA9685
+        (2) frequency type=float, help=PWM frequency in Hz
+        """
+        self.address = address
+        self.bus = I2CBus.get()
+        self._pca = self.bus.call(address, self._init, frequency,
+                                  priority=PRIORITY_ACTUATOR)
+        self.frequency = self._pca.frequency
+        self._device = self._pca.i2c_device
+
+        self._lock = threading.RLock()
+        self._cache = [None] * PCA9685_CHANNELS  # (on, off) as written
+        self._pending = {}  # channel -> (on, off) inside a batch
+        self._batch_depth = 0
+        self.transactions = 0
+
+    def _init(self, frequency):
+        pca = PCA9685(board.I2C(), address=self.address)
+        pca.frequency = frequency
+        pca.mode1_reg = pca.mode1_reg | MODE1_AI
+        return pca
+
+    @contextmanager
+    def batch(self):
+        """ collects the channel writes, they are written together on exit """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                transactions = self._flush() if not self._batch_depth else []
+            self._wait(transactions)
+
+    def set_counts(self, channel, on, off):
+        """Sets the raw 12 bit ON and OFF counts of a channel.
+
+        Args:
+            channel (int): Channel 0..15.
+            on (int): Count the output turns on, FULL for always on.
+            off (int): Count the output turns off, FULL for always off.
+        """
+        with self._lock:
+            self._pending[channel] = (on, off)
+            if self._batch_depth:
+                return
+            transactions = self._flush()
+        self._wait(transactions)
+
+    def set_pulse_width(self, channel, pulse_us):
+        """ sets the pulse width of a channel in us, None turns the output off """
+        if pulse_us is None:
+            self.set_counts(channel, 0, FULL)
+            return
+        off = int(round(pulse_us * self.frequency * 4096 / 1e6))
+        self.set_counts(channel, 0, min(max(off, 0), 4095))
+
+    def off(self, channels=None):
+        """ turns channels off, all by default, in one transaction """
+        if channels is None:
+            channels = range(PCA9685_CHANNELS)
+        with self.batch():
+            for channel in channels:
+                self.set_counts(channel, 0, FULL)
+
+    def invalidate(self):
+        """ forget the cached channel state, e.g. after a reset of the chip """
+        with self._lock:
+            self._cache = [None] * PCA9685_CHANNELS
+
+    def flush(self):
+        """ writes the pending channels and waits for the transactions """
+        with self._lock:
+            transactions = self._flush()
+        self._wait(transactions)
+
+    def _flush(self):
+        # queues the writes under the lock, so they reach the bus in order,
+        # the caller waits for them after releasing it
+        changed = sorted(channel for channel, counts in self._pending.items()
+                         if self._cache[channel] != counts)
+        transactions = []
+        try:
+            # channels in between with a known state are rewritten
+            # unchanged, so a run of channels needs one transaction
+            start = 0
+            for i in range(1, len(changed) + 1):
+                if i == len(changed) or not self._bridges(changed[i - 1], changed[i]):
+                    transactions.append(self._write(changed[start], changed[i - 1]))
+                    start = i
+        finally:
+            self._pending = {}
+        return transactions
+
+    def _wait(self, transactions):
+        for transaction in transactions:
+            try:
+                transaction.get()
+            except OSError:
+                # the channels of the failed write are unknown now
+                self.invalidate()
+                raise
+
+    def _bridges(self, first, last):
+        return all(self._cache[channel] is not None or channel in self._pending
+                   for channel in range(first + 1, last))
+
+    def _write(self, first, last):
+        channels = range(first, last + 1)
+        counts = [self._pending.get(channel, self._cache[channel])
+                  for channel in channels]
+        buf = bytearray(1 + 4 * len(channels))
+        buf[0] = LED0_ON_L + 4 * first
+        for i, (on, off) in enumerate(counts):
+            buf[1 + 4 * i:5 + 4 * i] = bytes(
+                (on & 0xFF, on >> 8, off & 0xFF, off >> 8))
+        self.transactions += 1
+        for channel, channel_counts in zip(channels, counts):
+            self._cache[channel] = channel_counts
+        return self.bus.submit(self.address, self._transfer, buf,
+                               priority=PRIORITY_ACTUATOR, key=(self.address, first, last))
+
+    def _transfer(self, buf):
+        with self._device as i2c:
+            i2c.write(buf)
@@ -0,0 +1,178 @@
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+
+import numpy as np
+
+HISTORY = 256  # round trips kept for the report
+
+
+class CommandError(Exception):
+    """ A command failed on the server, the message is the server's """
+
+    def __init__(self, func, msg):
+        super().__init__("%s: %s" % (func, msg))
+        self.func = func
+        self.msg = msg
+
+
+class CommandFuture(concurrent.futures.Future):
+    """ The reply to a command sent by ApparatusClient.
+
+    result() returns the return value of the command on the server, e.g. the
+    duration of estimate_move or the MoveStats of move_to as a dict, and
+    raises CommandError if the command failed there. A move or a timestamped
+    command is done once it finished on the server, not when it arrived.
+    """
+
+    def __init__(self, request_id, func):
+        """ class init
+        (1) request_id type=int, help=Id of the request on its connection
+        (2) func type=string, help=Name of the command
+        """
+        super().__init__()
+        self.request_id = request_id
+        self.func = func
+        self.sent_ns = time.perf_counter_ns()
+        self.executed = None  # datetime at which the command finished on the server
+        self.round_trip_ns = None
+
+
+class PendingRequests(object):
+    """ The commands of a connection that wait for their reply.
+
+    Every request gets the next id, any number of them may be in flight.
+    The replies are matched by id and may arrive in any order, a move that
+    finishes late does not hold up the replies of later commands.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count(1)  # 0 is no id on the wire
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.unmatched = 0
+        self._round_trips = collections.deque(maxlen=HISTORY)  # ns
+
+    def create(self, func) -> CommandFuture:
+        """ a future with a new request id, pending until resolved """
+        with self._lock:
+            future = CommandFuture(next(self._ids), func)
+            # a command on the wire can not be cancelled
+            future.set_running_or_notify_cancel()
+            self._pending[future.request_id] = future
+            self.sent += 1
+        return future
+
+    def discard(self, future, error):
+        """ fails a request that could not be sent """
+        with self._lock:
+            self._pending.pop(future.request_id, None)
+        future.set_exception(error)
+
+    def resolve(self, reply) -> bool:
+        """Completes the future of a reply.
+
+        Args:
+            reply (dict): Reply of the server with id, success, executed and
+                result or msg.
+
+        Returns:
+            bool: False if no request is waiting for the id
+        """
+        with self._lock:
+            future = self._pending.pop(reply.get("id"), None)
+            if future is None:
+                self.unmatched += 1
+                return False
+            future.round_trip_ns = time.perf_counter_ns() - future.sent_ns
+            self._round_trips.append(future.round_trip_ns)
+            if reply.get("success"):
+                self.succeeded += 1
+            else:
+                self.failed += 1
+        # set before the waiters wake up
+        future.executed = reply.get("executed")
+        if reply.get("success"):
+            future.set_result(reply.get("result"))
+        else:
+            future.set_exception(CommandError(
+                future.func, reply.get("msg", "failed")))
+        return True
+
+    def fail_all(self, error):
+        """ fails every pending request, e.g. when the connection is closed """
+        with self._lock:
+            futures = list(self._pending.values())
+            self._pending.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def report(self):
+        with self._lock:
+            round_trips = np.array(self._round_trips, dtype=np.double) / 1e3
+            in_flight = len(self._pending)
+        text = "sent: %d, succeeded: %d, failed: %d, unmatched: %d, in flight: %d" % (
+            self.sent, self.succeeded, self.failed, self.unmatched, in_flight)
+        if len(round_trips):
+            text += ", round trip: median %.1f us, max %.1f us" % (
+                np.median(round_trips), round_trips.max())
+        return text
+
+
+# commands that may be part of a batch, they return quickly on the server
+BATCH_COMMANDS = ("set_test_light", "set_human_light", "set_light",
+                  "set_lever_open", "play_sound", "move_to", "deploy")
+
+
+class CommandBatch(object):
+    """ Commands collected by ApparatusClient.batch, sent in one frame and
+    run back to back on the server at one timestamp """
+
+    def __init__(self, timestamp=None):
+        """ class init
+        (1) timestamp type=datetime, help=Time at which the server runs the batch, None for at once
+        """
+        self.timestamp = timestamp
+        self.commands = []  # {"func", "args"} in order
+        self.futures = []  # one per command
+        self.future = None  # the batch, once sent
+
+    def add(self, func, args) -> CommandFuture:
+        """ records a command, its future is resolved with the batch """
+        if func not in BATCH_COMMANDS:
+            raise ValueError("%s can not be part of a batch" % func)
+        if args.get("blocking"):
+            raise ValueError("%s: a batch can not block" % func)
+        timestamp = args.pop("timestamp", None)
+        if timestamp is not None and timestamp != self.timestamp:
+            raise ValueError("%s: the batch has one timestamp" % func)
+        future = CommandFuture(None, func)
+        future.set_running_or_notify_cancel()
+        self.commands.append({"func": func, "args": args})
+        self.futures.append(future)
+        return future
+
+    def sent(self, future):
+        self.future = future
+        future.add_done_callback(self._resolve)
+
+    def _resolve(self, future):
+        error = future.exception()
+        for i, command in enumerate(self.futures):
+            command.request_id = future.request_id
+            command.executed = future.executed
+            command.round_trip_ns = future.round_trip_ns
+            if error is not None:
+                command.set_exception(error)
+            else:
+                command.set_result(future.result()[i])
@@ -1,8 +1,12 @@
 import logging
-import pickle
 import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
 
+from apparatus import codec
 from apparatus.apparatus import Apparatus
+from apparatus.framing import FrameDecoder, FrameWriter
 
 
 class Handler(socketserver.StreamRequestHandler):
@@ -14,6 +18,11 @@ class Handler(socketserver.StreamRequestHandler):
     def handle(self):
         self.client = f'{self.client_address}'
         logging.info(f'Connected: {self.client}')
+        # events and replies are sent from several threads
+        self.writer = FrameWriter(self.request)
+        # pickle until the client negotiates another codec, see negotiate
+        self.codec = codec.PICKLE
+        self._codec_lock = threading.Lock()
         try:
             self.initialize()
             self.apparatus_handler.startThread()
@@ -35,41 +44,100 @@ class Handler(socketserver.StreamRequestHandler):
 
     def send_dict(self, dict):
         logging.info(dict)
-        msg: bytes = pickle.dumps(dict)
-        msg = len(msg).to_bytes(self.HEADERSIZE, "little", signed=False)+msg
-
-        self.wfile.write(msg)
-
-    def recv_dict(self, bytes):
-        return self.rfile.read(bytes)
+        with self._codec_lock:
+            self.writer.send(self.codec.encode(dict))
 
     def process_commands(self):
-        while True:
-            head: bytes = self.recv_dict(self.HEADERSIZE)
-            len: int = int.from_bytes(head, 'little', signed=False)
-            dict = {}
-            type = "error"
-            if head == b'':
-                # Client closed connection
-                break
-            if len:
-                data = self.recv_dict(len)
-                dict = pickle.loads(data)
-            else:
-                continue
-            if "type" in dict:
-                type = dict["type"]
-                try:
-                    self.run_apparatus_command(dict)
-                    self.send_dict({"type": type, "success": True})
+        decoder = FrameDecoder()
+        # 0 bytes: Client closed connection
+        while decoder.recv_from(self.request):
+            # a read may hold any number of frames, the last one partially
+            for frame in decoder.frames():
+                if not frame:
                     continue
-                except Exception as e:
-                    logging.exception(e)
-                    self.send_dict(
-                        {"type": type, "success": False, "msg": str(e)})
+                try:
+                    dict = self.codec.decode(frame)
+                except ValueError as e:
+                    # the framing is intact, the next frame is read as usual
+                    logging.warning("Frame skipped: %s" % e)
                     continue
-            self.send_dict({"type": type, "success": False,
-                           "msg": "Type not in dict"})
+                self.process_command(dict)
+        logging.debug("Frames: %s" % decoder.report())
+
+    def process_command(self, dict):
+        """ runs a command and replies with its result. A request with an id
+        gets the id back, with the time the command finished and its result.
+        Commands that finish later, a move or a timestamped command, return
+        their handle and are replied to once it is done. """
+        type = "error"
+        if dict.get("type") == "hello":
+            self.negotiate(dict)
+            return
+        request_id = dict.get("id")
+        if "type" in dict:
+            type = dict["type"]
+            try:
+                result = self.run_apparatus_command(dict)
+            except Exception as e:
+                logging.exception(e)
+                self.reply(type, request_id, error=e)
+                return
+            if hasattr(result, "add_done_callback"):
+                result.add_done_callback(
+                    lambda handle: self.reply_done(type, request_id, handle))
+                return
+            self.reply(type, request_id, result)
+            return
+        self.reply(type, request_id, error="Type not in dict")
+
+    def reply(self, type, request_id, result=None, error=None, executed=None):
+        reply = {"type": type, "success": error is None}
+        if error is not None:
+            reply["msg"] = str(error)
+        if request_id is not None:
+            reply["id"] = request_id
+            reply["executed"] = executed if executed is not None else datetime.now()
+            if result is not None:
+                # e.g. MoveStats, sent as a dict
+                reply["result"] = vars(result) if hasattr(
+                    result, "__dict__") else result
+        try:
+            self.send_dict(reply)
+        except OSError as e:
+            # the client left while the command ran
+            logging.info(e)
+        except Exception as e:
+            # a result the codec can not encode fails the command, not the session
+            logging.exception(e)
+            reply.pop("result", None)
+            reply["success"] = False
+            reply["msg"] = "Reply not encodable: %s" % e
+            try:
+                self.send_dict(reply)
+            except OSError as e:
+                logging.info(e)
+
+    def reply_done(self, type, request_id, handle):
+        """ reply for a MotionCommand or ScheduledCommand that is done """
+        error = handle.error
+        if error is None and handle.cancelled:
+            error = "cancelled"
+        executed = None
+        if getattr(handle, "fired_ns", None) is not None:
+            # the callback runs after the rest of the group fired
+            executed = datetime.now() - timedelta(
+                microseconds=(time.perf_counter_ns() - handle.fired_ns) / 1000)
+        self.reply(type, request_id, handle.result, error, executed)
+
+    def negotiate(self, dict):
+        """ answers the hello of the client with the codec both sides use from
+        now on, the answer itself is still pickled """
+        chosen = codec.negotiate(dict.get("codecs"))
+        logging.info("Codec: %s" % chosen.name)
+        with self._codec_lock:
+            self.writer.send(self.codec.encode(
+                {"type": "hello", "success": True, "codec": chosen.name}))
+            self.codec = chosen
 
     def run_apparatus_command(self, dict):
         func = ""
@@ -79,7 +147,7 @@ class Handler(socketserver.StreamRequestHandler):
             if callable(method):
                 args = dict["args"]
                 logging.debug(args)
-                method(**args)
+                return method(**args)
 
     def initialize(self):
         logging.info(f'Welcome {self.client}')
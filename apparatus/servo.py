@@ -1,37 +1,135 @@
-import threading
-from adafruit_servokit import ServoKit
+import time
+
+from apparatus.pca9685 import PCA9685Driver
+from apparatus.servo_motion import PROFILES, ServoMotion, ServoTicker
+from apparatus.timer_service import TimerHandle, TimerService
 
 
 class Servo(object):
 
-    servokit: ServoKit = None
+    driver: PCA9685Driver = None
     channel: int = 0
-    _timer: threading.Timer = None
+    motion: ServoMotion = None  # last started move
+    _timer: TimerHandle = None
     _servo_timeout: float = 0
 
-    def __init__(self, channel_id, range, servo_timeout=0):
-        self.servokit = ServoKit(channels=16, address=0x43)
+    ACTUATION_RANGE = 180  # deg
+
+    # motion profile and timing calibration, see move
+    VELOCITY = 360.  # deg/s, peak velocity of the profile, 0 jumps to the target
+    PROFILE = "minjerk"
+    SPEED = 2500.  # us/s, pulse width the servo follows per second at most
+    LATENCY = .02  # s, until the servo starts to follow
+
+    def __init__(self, channel_id, range, servo_timeout=0, velocity=None, profile=None, speed=None, latency=None):
+        """ class init
+        (1) channel_id type=int, help=Channel on the PCA9685
+        (2) range type=(int, int), help=Pulse widths in us at 0 and ACTUATION_RANGE deg
+        (3) servo_timeout type=float, help=Turns the servo off after s, 0 keeps it on
+        (4) velocity type=float, help=Peak velocity of the motion profile in deg/s
+        (5) profile type=string, help=Name of the motion profile, see servo_motion.PROFILES
+        (6) speed type=float, help=Calibrated pulse width the servo follows per second in us/s
+        (7) latency type=float, help=Calibrated delay in s until the servo follows
+        """
+        # all servos share the driver of the board
+        self.driver = PCA9685Driver.get()
         self.channel = channel_id
         self.range = range
         self._servo_timeout = servo_timeout
+        self.velocity = self.VELOCITY if velocity is None else velocity
+        self.profile = self.PROFILE if profile is None else profile
+        self.speed = self.SPEED if speed is None else speed
+        self.latency = self.LATENCY if latency is None else latency
 
     _range = None
     _open_state = False
 
     def cleanup(self):
         # turn of servos
-        for i in range(0, 16):
-            self.servokit.servo[i].fraction = None
+        if self.motion is not None:
+            self.motion.cancel()
+        self.driver.off()
 
     @property
     def range(self):
-        """I'm the 'x' property."""
+        """ pulse width range (min, max) in us """
         return self._range
 
     @range.setter
     def range(self, value):
         self._range = value
-        self.servokit.servo[self.channel].set_pulse_width_range(*value)
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        """ angle in deg within ACTUATION_RANGE, None turns the servo off,
+        a running move is cancelled """
+        if self.motion is not None:
+            self.motion.cancel()
+        self._write(value)
+
+    _angle = None
+
+    def _write(self, value):
+        self._angle = value
+        if value is None:
+            self.driver.set_pulse_width(self.channel, None)
+            return
+        self.driver.set_pulse_width(self.channel, self._pulse(value))
+
+    def _pulse(self, angle):
+        min_pulse, max_pulse = self._range
+        return min_pulse + (max_pulse - min_pulse) * angle / self.ACTUATION_RANGE
+
+    def _profile_duration(self, start, target):
+        if not self.velocity or start is None:
+            return 0.
+        return abs(target - start) / self.velocity * PROFILES[self.profile][1]
+
+    def predict(self, target, start=None):
+        """Predicts how long a move takes until the servo is at target. The
+        servo follows the profile after its latency, or its own speed if the
+        profile is faster. The speed is in pulse width, so the range of the
+        servo scales it.
+
+        Args:
+            target (float): Angle in deg.
+            start (float, optional): Angle in deg, defaults to the current
+                angle. An unknown angle (servo off) is assumed to be a move
+                over the whole range.
+
+        Returns:
+            float: Duration in s
+        """
+        if start is None:
+            start = self._angle
+        travel = self.ACTUATION_RANGE if start is None else abs(target - start)
+        pulse = travel * abs(self._range[1] - self._range[0]) / self.ACTUATION_RANGE
+        return self.latency + max(self._profile_duration(start, target), pulse / self.speed)
+
+    def move(self, target, callback=None) -> ServoMotion:
+        """Moves the servo along the motion profile on the ServoTicker.
+
+        Args:
+            target (float): Angle in deg.
+            callback (callable, optional): Called with the motion once the
+                servo is predicted to be at target. Defaults to None.
+
+        Returns:
+            ServoMotion: the handle, wait on it for the servo to be at target
+        """
+        start = self._angle
+        duration = self._profile_duration(start, target)
+        eta = time.perf_counter() + self.predict(target, start)
+        motion = ServoMotion(self, target if start is None else start, target, duration, eta,
+                             PROFILES[self.profile][0], callback)
+        self.motion = motion
+        ServoTicker.get().add(motion)
+        self._startTimeout()
+        return motion
 
     @property
     def door_open(self):
@@ -41,8 +139,7 @@ class Servo(object):
     @door_open.setter
     def door_open(self, value):
         self._open_state = value
-        self.servokit.servo[self.channel].angle = 180 if not value else 0
-        self._startTimeout()
+        self.move(180 if not value else 0)
 
     @property
     def lever_open(self):
@@ -52,18 +149,13 @@ class Servo(object):
     @lever_open.setter
     def lever_open(self, value):
         self._open_state = value
-        self.servokit.servo[self.channel].angle = 180 if not value else 0
-        self._startTimeout()
+        self.move(180 if not value else 0)
 
     def _startTimeout(self):
         if self._servo_timeout <= 0:
             return
-        if self._timer is not None:
-            self._timer.cancel()
         # Disable Servo after "_servo_timeout" sec.
-        self._timer = threading.Timer(
-            interval=self._servo_timeout,
-            function=setattr,
-            args=(self.servokit.servo[self.channel], 'angle', None),
-        )
-        self._timer.start()
+        if self._timer is not None and self._timer.reschedule(self._servo_timeout):
+            return
+        self._timer = TimerService.get().schedule(
+            self._servo_timeout, setattr, self, 'angle', None)
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+TICK_RATE = 50  # Hz, the servo frame rate, faster updates are not seen by the servos
+
+
+def _linear(u):
+    return u
+
+
+def _cosine(u):
+    return .5 - .5 * np.cos(np.pi * u)
+
+
+def _minjerk(u):
+    return u * u * u * (10. + u * (-15. + 6. * u))
+
+
+# position over normalized time 0..1 and its peak velocity relative to the
+# mean velocity, the duration of a move is scaled so the peak is the velocity
+PROFILES = {
+    "linear": (_linear, 1.),
+    "cosine": (_cosine, np.pi / 2),
+    "minjerk": (_minjerk, 1.875),
+}
+
+
+class ServoMotion(object):
+    """ Completion handle of a servo move run by the ServoTicker """
+
+    def __init__(self, servo, start, target, duration, eta, profile, callback=None):
+        """ class init
+        (1) servo type=Servo, help=Servo that is moved
+        (2) start type=float, help=Angle in deg at the start
+        (3) target type=float, help=Angle in deg at the end
+        (4) duration type=float, help=Duration in s of the commanded profile
+        (5) eta type=float, help=perf_counter when the servo is predicted to be at target
+        (6) profile type=callable, help=Position over normalized time, see PROFILES
+        (7) callback type=callable, help=Called with the motion once the servo is at target
+        """
+        self.servo = servo
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.eta = eta
+        self.profile = profile
+        self.callback = callback
+
+        self.started = time.perf_counter()
+        self.cancelled = False
+        self.error = None  # the write of the profile failed
+        self.commanded = False  # the target is written, the servo catches up
+        self._done = threading.Event()
+
+    def angle(self, now):
+        """ commanded angle at perf_counter now """
+        if now - self.started >= self.duration:
+            return self.target
+        u = (now - self.started) / self.duration
+        return self.start + (self.target - self.start) * float(self.profile(u))
+
+    def remaining(self):
+        """ s until the servo is predicted to be at target """
+        return max(self.eta - time.perf_counter(), 0.)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ returns True once the servo is at target, False on timeout, if the
+        motion was cancelled or replaced by another move of the servo or if
+        its write failed, see error """
+        return self._done.wait(timeout) and not self.cancelled and self.error is None
+
+    def remaining_timeout(self, margin):
+        """ s to wait for the motion, its predicted completion plus margin """
+        return max(self.eta - time.perf_counter(), 0.) + margin
+
+    def cancel(self):
+        """ stops the profile at its current angle, the callback is not
+        called. A motion that finished stays finished """
+        ServoTicker.get().remove(self, cancelled=True)
+
+    def _finish(self):
+        self._done.set()
+        if self.callback is not None and not self.cancelled and self.error is None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                logging.exception(e)
+
+
+class ServoTicker(object):
+    """ Thread that steps all running servo motions at TICK_RATE.
+
+    The pulse widths of one tick are written in one PCA9685 batch. A motion
+    stays on the ticker after its profile until its predicted completion,
+    then its callback is called on the ticker thread. A failed write ends
+    the motions of the tick with the error, the ticker keeps running.
+
+    There is one instance, see get.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ the ticker, started on first use """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, rate=TICK_RATE):
+        self.period = 1. / rate
+        self._motions = {}  # servo -> running motion
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="ServoTicker", daemon=True)
+        self._thread.start()
+
+    def add(self, motion: ServoMotion):
+        """ runs motion, a running motion of the same servo is replaced """
+        with self._cond:
+            previous = self._motions.get(motion.servo)
+            self._motions[motion.servo] = motion
+            self._cond.notify()
+        if previous is not None:
+            previous.cancelled = True
+            previous._finish()
+
+    def remove(self, motion: ServoMotion, cancelled=False, error=None):
+        """ finishes a running motion, cancelled or failed with error. A
+        motion that is not running any more is left as it finished """
+        with self._cond:
+            if self._motions.get(motion.servo) is not motion:
+                return
+            del self._motions[motion.servo]
+            motion.cancelled = motion.cancelled or cancelled
+            motion.error = error
+        motion._finish()
+
+    def cancel(self):
+        """ cancels all running motions """
+        with self._cond:
+            motions = list(self._motions.values())
+        for motion in motions:
+            motion.cancel()
+
+    def _run(self):
+        deadline = time.perf_counter()
+        while True:
+            with self._cond:
+                while not self._motions:
+                    self._cond.wait()
+                    deadline = time.perf_counter()
+                motions = list(self._motions.values())
+
+            now = time.perf_counter()
+            moving = [motion for motion in motions if not motion.commanded]
+            try:
+                self._tick(moving, now)
+            except Exception as e:
+                # e.g. an I2C error, the servos of the tick are at unknown angles
+                logging.exception(e)
+                for motion in moving:
+                    self.remove(motion, error=e)
+            for motion in motions:
+                if motion.commanded and now >= motion.eta:
+                    self.remove(motion)
+
+            deadline += self.period
+            delay = deadline - time.perf_counter()
+            if delay < 0:
+                # overrun, do not try to catch up
+                deadline -= delay
+                delay = 0
+            with self._cond:
+                # a new motion wakes the ticker early
+                self._cond.wait(delay)
+
+    def _tick(self, moving, now):
+        """ writes the angles of the moving motions at now in one batch """
+        if not moving:
+            return
+        with moving[0].servo.driver.batch():
+            for motion in moving:
+                if not motion.cancelled:
+                    motion.servo._write(motion.angle(now))
+                    motion.commanded = now - motion.started >= motion.duration
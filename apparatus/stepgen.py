@@ -0,0 +1,266 @@
+import heapq
+import logging
+import queue
+import threading
+import time
+
+# Below this remaining time the wait stops sleeping and spins on the clock
+SPIN_THRESHOLD_NS = 150000
+
+
+def sleep_until_ns(deadline_ns, spin_threshold_ns=SPIN_THRESHOLD_NS):
+    """Hybrid wait against time.perf_counter_ns: a coarse sleep that wakes up
+    shortly before the deadline followed by a busy wait for the rest.
+
+    Args:
+        deadline_ns (int): Absolute perf_counter_ns deadline.
+        spin_threshold_ns (int, optional): Time before the deadline that is spent spinning. Defaults to SPIN_THRESHOLD_NS.
+    """
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > spin_threshold_ns:
+        time.sleep((remaining - spin_threshold_ns) / 1e9)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+
+class StepJob(object):
+    """ A single move: a table of half step delays played on one step pin """
+
+    def __init__(self, pin, delays_ns, callback=None):
+        """ class init
+        (1) pin type=int, help=GPIO pin connected to STEP of IC
+        (2) delays_ns type=sequence of int, help=Delay in ns after every edge,
+        two entries per step (rising and falling edge)
+        (3) callback type=callable, help=Called with the job once it is finished,
+        from the generator thread, so it has to return quickly
+        """
+        self.pin = pin
+        self.delays_ns = delays_ns
+        self.callback = callback
+
+        self.start_ns = 0
+        self.end_ns = 0
+        self.edges = 0
+        self.drift_sum_ns = 0
+        self.drift_max_ns = 0
+
+        self._delays = None  # working copy of delays_ns while playing
+        self._edge = 0
+        self._level = False
+        self._deadline = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def steps(self):
+        delays = self._delays if self._delays is not None else self.delays_ns
+        return len(delays) // 2
+
+    @property
+    def position(self):
+        """ steps played so far """
+        return (self.edges + 1) // 2
+
+    def retarget(self, steps):
+        """Changes the total step count of the job, also while it is played.
+        A shorter move keeps the slow end of the deceleration ramp, a longer
+        move is extended with steps at the final (slowest) delay.
+
+        Args:
+            steps (int): New total number of steps, at least the steps already played.
+        """
+        with self._lock:
+            delays = self._working_delays()
+            played = self.edges + self.edges % 2  # finish the current pulse
+            remaining = max(2 * steps, played) - played
+            if remaining <= len(delays) - played:
+                tail = delays[len(delays) - remaining:] if remaining else []
+            else:
+                tail = delays[played:]
+                tail += [delays[-1] if delays else 0] * \
+                    (remaining - len(tail))
+            self._delays = delays[:played] + tail
+
+    def _working_delays(self):
+        if self._delays is None:
+            delays_ns = self.delays_ns
+            # plain ints are faster to add up
+            self._delays = delays_ns.tolist() if hasattr(
+                delays_ns, "tolist") else list(delays_ns)
+        return self._delays
+
+    def cancel(self) -> bool:
+        """ stops the job after the current step pulse, returns whether it stops early """
+        self.retarget(0)
+        return True
+
+    @property
+    def drift_mean_ns(self):
+        if self.edges == 0:
+            return 0
+        return self.drift_sum_ns / self.edges
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def report(self):
+        return "steps: %d, edges: %d, drift mean: %.1f us, drift max: %.1f us, duration: %.3f s" % (
+            self.steps,
+            self.edges,
+            self.drift_mean_ns / 1000,
+            self.drift_max_ns / 1000,
+            (self.end_ns - self.start_ns) / 1e9,
+        )
+
+    def _record(self, drift_ns):
+        self.edges += 1
+        self.drift_sum_ns += drift_ns
+        if drift_ns > self.drift_max_ns:
+            self.drift_max_ns = drift_ns
+
+    def _finish(self):
+        self.end_ns = time.perf_counter_ns()
+        self._done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+
+class StepGenerator(object):
+    """ Persistent step pulse generator thread for one or more axes.
+
+    The edges of all running jobs are merged into one time ordered queue that
+    is serviced by a single loop, so several motors can move at the same time
+    without competing timer threads. Jobs on the same pin are played one after
+    another. Every edge is scheduled against an absolute deadline so the timing
+    error of one edge does not carry over to the next one; the error of each
+    edge is recorded in the job and, grouped by the number of axes that were
+    moving at the same time, in the generator (see jitter_report).
+    """
+
+    def __init__(self, output, name="StepGenerator", spin_threshold_ns=SPIN_THRESHOLD_NS):
+        """ class init
+        (1) output type=callable, help=Pin write function with the
+        signature of GPIO.output(pin, state)
+        (2) name type=string, help=Name of the generator thread
+        (3) spin_threshold_ns type=int, help=Busy wait window before each edge
+        """
+        self._output = output
+        self.spin_threshold_ns = spin_threshold_ns
+        self._jobs = queue.Queue()
+        self._jitter = {}
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, job: StepJob) -> StepJob:
+        self._jobs.put(job)
+        return job
+
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def jitter_report(self):
+        """Edge drift since the last reset, grouped by the number of axes moving at once.
+
+        Returns:
+            dict: {axes: (edges, drift mean in us, drift max in us)}
+        """
+        return {axes: (edges, drift_sum / edges / 1000, drift_max / 1000)
+                for axes, (edges, drift_sum, drift_max) in sorted(self._jitter.items())}
+
+    def reset_jitter(self):
+        self._jitter = {}
+
+    def _run(self):
+        active = []  # heap of (deadline, sequence, job)
+        waiting = {}  # pin -> jobs queued behind the active job of that pin
+        sequence = 0
+        while True:
+            # new jobs are picked up while waiting for the next edge
+            try:
+                if not active:
+                    job = self._jobs.get()
+                else:
+                    timeout = (active[0][0] - time.perf_counter_ns() -
+                               self.spin_threshold_ns) / 1e9
+                    job = self._jobs.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                pass
+            else:
+                if job is None:
+                    break
+                if job.pin in waiting:
+                    waiting[job.pin].append(job)
+                elif self._start(job):
+                    waiting[job.pin] = []
+                    sequence += 1
+                    heapq.heappush(active, (job._deadline, sequence, job))
+                continue
+
+            deadline, _, job = heapq.heappop(active)
+            sleep_until_ns(deadline, self.spin_threshold_ns)
+            if self._edge(job, deadline, len(active) + 1):
+                sequence += 1
+                heapq.heappush(active, (job._deadline, sequence, job))
+                continue
+
+            self._stop(job)
+            # start the next job on the same pin
+            while waiting[job.pin]:
+                job = waiting[job.pin].pop(0)
+                if self._start(job):
+                    sequence += 1
+                    heapq.heappush(active, (job._deadline, sequence, job))
+                    break
+            else:
+                del waiting[job.pin]
+
+        for _, _, job in active:
+            self._stop(job)
+        for jobs in waiting.values():
+            for job in jobs:
+                self._stop(job)
+
+    def _start(self, job: StepJob):
+        """ prepares a job, returns False if there is nothing to play """
+        with job._lock:
+            job._working_delays()
+            job._edge = 0
+            job._level = False
+            job._deadline = job.start_ns = time.perf_counter_ns()
+            if job._delays:
+                return True
+        self._stop(job)
+        return False
+
+    def _edge(self, job: StepJob, deadline, axes):
+        """ plays the next edge of a job, returns False once the job is finished """
+        with job._lock:
+            # the job might have been retargeted while waiting
+            delays = job._delays
+            if job._edge >= len(delays):
+                return False
+            job._level = not job._level
+            self._output(job.pin, job._level)
+            drift = time.perf_counter_ns() - deadline
+            job._record(drift)
+            job._deadline = deadline + delays[job._edge]
+            job._edge += 1
+            more = job._edge < len(delays)
+
+        jitter = self._jitter.setdefault(axes, [0, 0, 0])
+        jitter[0] += 1
+        jitter[1] += drift
+        if drift > jitter[2]:
+            jitter[2] = drift
+        return more
+
+    def _stop(self, job: StepJob):
+        try:
+            job._finish()
+        except Exception as e:
+            logging.exception(e)
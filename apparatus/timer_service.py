@@ -0,0 +1,178 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerHandle(object):
+    """ A callback scheduled on the TimerService """
+
+    def __init__(self, service, deadline, func, args):
+        """ class init, see TimerService.schedule
+        (1) service type=TimerService, help=Service the timer is scheduled on
+        (2) deadline type=float, help=perf_counter at which func is called
+        (3) func type=callable, help=Called on the timer thread
+        (4) args type=tuple, help=Arguments of func
+        """
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+        self.seq = None  # of its current place in the heap
+        self._service = service
+
+    def pending(self):
+        return not (self.cancelled or self.fired)
+
+    def remaining(self):
+        """ s until the timer fires """
+        return max(self.deadline - time.perf_counter(), 0.)
+
+    def cancel(self):
+        """ returns False if the timer already fired or was cancelled """
+        return self._service.cancel(self)
+
+    def reschedule(self, delay):
+        """ returns False if the timer already fired or was cancelled """
+        return self._service.reschedule(self, delay)
+
+
+class TimerService(object):
+    """ One thread that runs all timeouts of the apparatus.
+
+    Replaces a threading.Timer, and with it a thread, per timeout. The timers
+    are kept in a heap ordered by deadline: schedule and reschedule are
+    O(log n), cancel is O(1) and leaves the heap entry behind until it is
+    popped or the heap is compacted. The callbacks run on the timer thread
+    and have to return quickly, long work is handed to another thread.
+
+    There is one instance, see get.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ the service, started on first use """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self._heap = []  # (deadline, seq, timer)
+        self._seq = itertools.count()
+        self._stale = 0  # heap entries of cancelled or rescheduled timers
+        self._cond = threading.Condition()
+
+        # counters
+        self.scheduled = 0
+        self.rescheduled = 0
+        self.cancelled = 0
+        self.fired = 0
+        self.latency = 0.  # s, sum of the delays of the fired timers after their deadline
+        self.max_latency = 0.  # s
+        self.max_threads = threading.active_count()
+
+        self._thread = threading.Thread(
+            target=self._run, name="TimerService", daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, func, *args) -> TimerHandle:
+        """Calls func(*args) on the timer thread after delay.
+
+        Args:
+            delay (float): Delay in s, <= 0 fires as soon as possible.
+            func (callable): Called on the timer thread, has to return quickly.
+
+        Returns:
+            TimerHandle: the handle to cancel or reschedule the timer
+        """
+        with self._cond:
+            timer = TimerHandle(self, time.perf_counter() + delay, func, args)
+            self._push(timer)
+            self.scheduled += 1
+            return timer
+
+    def cancel(self, timer: TimerHandle):
+        with self._cond:
+            if not timer.pending():
+                return False
+            timer.cancelled = True
+            self._stale += 1
+            self.cancelled += 1
+            return True
+
+    def reschedule(self, timer: TimerHandle, delay):
+        """ moves the deadline of a pending timer to delay from now """
+        with self._cond:
+            if not timer.pending():
+                return False
+            timer.deadline = time.perf_counter() + delay
+            self._stale += 1
+            self._push(timer)
+            self.rescheduled += 1
+            return True
+
+    def pending(self):
+        """ number of pending timers """
+        with self._cond:
+            return len(self._heap) - self._stale
+
+    def report(self):
+        return "threads: %d (max %d), pending: %d, scheduled: %d, rescheduled: %d, cancelled: %d, fired: %d, latency: %.3f ms (max %.3f ms)" % (
+            threading.active_count(), self.max_threads, self.pending(),
+            self.scheduled, self.rescheduled, self.cancelled, self.fired,
+            self.latency / max(self.fired, 1) * 1e3, self.max_latency * 1e3)
+
+    def _push(self, timer):
+        timer.seq = next(self._seq)
+        heapq.heappush(self._heap, (timer.deadline, timer.seq, timer))
+        if self._heap[0][2] is timer:
+            # new earliest deadline
+            self._cond.notify()
+        if self._stale > 64 and self._stale > len(self._heap) // 2:
+            self._compact()
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap
+                      if entry[1] == entry[2].seq and entry[2].pending()]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, seq, timer = self._heap[0]
+                if seq != timer.seq or not timer.pending():
+                    heapq.heappop(self._heap)
+                    self._stale -= 1
+                    continue
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                timer.fired = True
+                return timer
+
+    def _run(self):
+        while True:
+            timer = self._next()
+            latency = time.perf_counter() - timer.deadline
+            try:
+                timer.func(*timer.args)
+            except Exception as e:
+                logging.exception(e)
+            with self._cond:
+                self.fired += 1
+                self.latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.max_threads = max(
+                    self.max_threads, threading.active_count())
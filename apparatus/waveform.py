@@ -0,0 +1,364 @@
+import abc
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from apparatus.stepgen import StepGenerator, StepJob, sleep_until_ns
+
+
+class Waveform(object):
+    """ Pre-rendered pin edges of a move.
+
+    Compact array backed list of edges, each with a time in ns relative to the
+    start of the waveform, a pin and a level. The edges of step_pin form the
+    step train, all other edges (enable, direction) are setup edges that come
+    before the first step.
+    """
+
+    def __init__(self, times_ns, pins, levels, step_pin):
+        self.times_ns = np.asarray(times_ns, dtype=np.int64)
+        self.pins = np.asarray(pins, dtype=np.uint8)
+        self.levels = np.asarray(levels, dtype=np.uint8)
+        self.step_pin = step_pin
+
+    @classmethod
+    def from_move(cls, step_pin, delays_ns, dir_pin=None, clockwise=False, enable_pin=None, enable_level=0, setup_ns=0):
+        """Renders a move into a waveform.
+
+        Args:
+            step_pin (int): GPIO pin connected to STEP of IC.
+            delays_ns (sequence of int): Delay in ns after every step edge, two entries per step.
+            dir_pin (int, optional): GPIO pin connected to DIR of IC. Defaults to None.
+            clockwise (bool, optional): Level of dir_pin. Defaults to False.
+            enable_pin (int, optional): GPIO pin connected to EN of IC. Defaults to None.
+            enable_level (int, optional): Level of enable_pin that energizes the driver. Defaults to 0.
+            setup_ns (int, optional): Time between the setup edges and the first step. Defaults to 0.
+
+        Returns:
+            Waveform: the rendered move
+        """
+        setup_pins = []
+        setup_levels = []
+        if enable_pin is not None:
+            setup_pins.append(enable_pin)
+            setup_levels.append(enable_level)
+        if dir_pin is not None:
+            setup_pins.append(dir_pin)
+            setup_levels.append(int(bool(clockwise)))
+
+        delays_ns = np.asarray(delays_ns, dtype=np.int64)
+        step_times = np.zeros(len(delays_ns), dtype=np.int64)
+        if len(delays_ns):
+            step_times[1:] = np.cumsum(delays_ns[:-1])
+        step_times += setup_ns
+
+        times_ns = np.concatenate(
+            [np.zeros(len(setup_pins), dtype=np.int64), step_times])
+        pins = np.concatenate([np.array(setup_pins, dtype=np.uint8),
+                               np.full(len(step_times), step_pin, dtype=np.uint8)])
+        levels = np.concatenate([np.array(setup_levels, dtype=np.uint8),
+                                 np.arange(1, len(step_times) + 1, dtype=np.uint8) % 2])
+        waveform = cls(times_ns, pins, levels, step_pin)
+        waveform._delays_ns = delays_ns
+        return waveform
+
+    def __len__(self):
+        return len(self.times_ns)
+
+    @property
+    def duration_ns(self):
+        return int(self.times_ns[-1]) if len(self.times_ns) else 0
+
+    @property
+    def steps(self):
+        return int(np.count_nonzero(self.levels[self.pins == self.step_pin]))
+
+    def setup_edges(self):
+        """ edges before the step train as (time_ns, pin, level) """
+        first = np.flatnonzero(self.pins == self.step_pin)
+        end = first[0] if len(first) else len(self)
+        return list(zip(self.times_ns[:end].tolist(), self.pins[:end].tolist(), self.levels[:end].tolist()))
+
+    def step_delays_ns(self) -> np.ndarray:
+        """ delay after every step edge in ns, as played by a StepJob """
+        delays_ns = getattr(self, "_delays_ns", None)
+        if delays_ns is None:
+            times = self.times_ns[self.pins == self.step_pin]
+            delays_ns = np.append(np.diff(times), 0) if len(
+                times) else np.zeros(0, dtype=np.int64)
+        return delays_ns
+
+
+class WaveformBackend(metaclass=abc.ABCMeta):
+    """ Plays waveforms on an output """
+
+    retargetable = True  # a playing StepJob can be shortened and extended
+    max_edges = None  # edges of one waveform, None for no limit
+
+    @abc.abstractmethod
+    def play(self, waveform: Waveform, callback=None) -> StepJob:
+        """[summary]
+        Starts playing a waveform.
+        Args:
+            waveform (Waveform): The waveform to play.
+            callback (callable, optional): Called with the job once the waveform is played. Defaults to None.
+        Returns:
+            StepJob: Handle to wait for, retarget or cancel the step train.
+        """
+        pass
+
+
+class GPIOBackend(WaveformBackend):
+    """ Bit-bangs waveforms with RPi.GPIO, the step train is played by a StepGenerator """
+
+    def __init__(self, output, step_generator: StepGenerator):
+        self._output = output
+        self.step_generator = step_generator
+
+    def play(self, waveform: Waveform, callback=None) -> StepJob:
+        start = time.perf_counter_ns()
+        for time_ns, pin, level in waveform.setup_edges():
+            sleep_until_ns(start + time_ns)
+            self._output(pin, level)
+        # the step train starts at its first edge
+        step_times = waveform.times_ns[waveform.pins == waveform.step_pin]
+        if len(step_times):
+            sleep_until_ns(start + int(step_times[0]))
+        return self.step_generator.submit(StepJob(
+            waveform.step_pin, waveform.step_delays_ns(), callback=callback))
+
+
+class ArraySink(WaveformBackend):
+    """ Records waveforms instead of playing them, for tests and timing checks off the Pi """
+
+    def __init__(self):
+        self.waveforms = []
+
+    def play(self, waveform: Waveform, callback=None) -> StepJob:
+        self.waveforms.append(waveform)
+        job = StepJob(waveform.step_pin,
+                      waveform.step_delays_ns(), callback=callback)
+        job.edges = job.steps * 2
+        job._finish()
+        return job
+
+    def edges(self):
+        """ all recorded edges, waveforms are concatenated in time
+
+        Returns:
+            tuple: (times_ns, pins, levels) arrays
+        """
+        times, pins, levels = [], [], []
+        offset = 0
+        for waveform in self.waveforms:
+            times.append(waveform.times_ns + offset)
+            pins.append(waveform.pins)
+            levels.append(waveform.levels)
+            offset += waveform.duration_ns
+        if not times:
+            return np.zeros(0, np.int64), np.zeros(0, np.uint8), np.zeros(0, np.uint8)
+        return np.concatenate(times), np.concatenate(pins), np.concatenate(levels)
+
+
+class PigpioJob(StepJob):
+    """ StepJob of a waveform played by the pigpio daemon """
+
+    def __init__(self, backend, waveform: Waveform, callback=None):
+        super().__init__(waveform.step_pin, waveform.step_delays_ns(), callback)
+        self._backend = backend
+        self._rising_ns = waveform.times_ns[(waveform.pins == waveform.step_pin) & (
+            waveform.levels == 1)]
+        self.cancelled = False  # cancelled before it was played
+
+    @property
+    def position(self):
+        # pigpio does not report progress, estimate it from the elapsed time
+        if self.end_ns or not self.start_ns:
+            return (self.edges + 1) // 2
+        return int(np.searchsorted(self._rising_ns, time.perf_counter_ns() - self.start_ns, side="right"))
+
+    def retarget(self, steps):
+        # the wave is in the daemon, it plays to its end unless stopped
+        if steps > self.position:
+            logging.warning("PigpioJob: retarget is not supported")
+            return
+        self.cancel()
+
+    def cancel(self) -> bool:
+        """ stops the wave, returns False if it plays to its end, see PigpioBackend.cancel """
+        return self._backend.cancel(self)
+
+
+class PigpioBackend(WaveformBackend):
+    """ Plays waveforms as DMA timed pigpio wave chains.
+
+    pigpio transmits one wave at a time. Waveforms of different step pins
+    that are played within MERGE_WINDOW of each other, e.g. both carousels
+    moving in init_hw, are merged into one wave and run together, later ones
+    wait for the running wave. A playing wave can not be retargeted, only
+    stopped, see Carousel for the checks of closed_loop and max_edges.
+    """
+
+    # pulses per wave, the daemon limits the pulses of all waves together
+    MAX_PULSES = 5000
+    POLL_INTERVAL = .002
+    MERGE_WINDOW = .01  # s, moves started this close together run in one wave
+
+    retargetable = False
+
+    def __init__(self, host=None):
+        import pigpio
+        self._pigpio = pigpio
+        self.pi = pigpio.pi() if host is None else pigpio.pi(host)
+        if not self.pi.connected:
+            raise IOError("pigpio daemon not reachable")
+        # one pulse per edge at most, edges at the same time share one
+        self.max_edges = self.pi.wave_get_max_pulses()
+        self._jobs = queue.Queue()
+        self._deferred = []  # (job, waveform) taken while merging, played next
+        self._current = ()
+        self._lock = threading.Lock()  # cancel against the start of a wave
+        self.merged = 0
+        self._thread = threading.Thread(
+            target=self._run, name="PigpioBackend", daemon=True)
+        self._thread.start()
+
+    def play(self, waveform: Waveform, callback=None) -> StepJob:
+        if len(waveform) > self.max_edges:
+            raise ValueError("Waveform of %d edges exceeds the %d pulses of the pigpio daemon" % (
+                len(waveform), self.max_edges))
+        job = PigpioJob(self, waveform, callback)
+        self._jobs.put((job, waveform))
+        return job
+
+    def cancel(self, job) -> bool:
+        """Stops a job, a waiting job is not played.
+
+        Returns:
+            bool: False if the job plays to its end, it is merged with the
+            moves of other motors into one wave, stopping it would stop them
+        """
+        with self._lock:
+            if job.done():
+                return False
+            if job not in self._current:
+                job.cancelled = True
+                return True
+            if len(self._current) > 1:
+                return False
+            self.pi.wave_tx_stop()
+            return True
+
+    def _pulses(self, waveform: Waveform):
+        pulses = []
+        times = waveform.times_ns.tolist()
+        pins = waveform.pins.tolist()
+        levels = waveform.levels.tolist()
+        i = 0
+        while i < len(times):
+            on = off = 0
+            t = times[i]
+            # edges at the same time become one pulse
+            while i < len(times) and times[i] == t:
+                if levels[i]:
+                    on |= 1 << pins[i]
+                else:
+                    off |= 1 << pins[i]
+                i += 1
+            delay_us = (times[i] - t) // 1000 if i < len(times) else 0
+            pulses.append(self._pigpio.pulse(on, off, delay_us))
+        return pulses
+
+    def _next(self):
+        """ the next waveform and those of other step pins that start with it """
+        batch = [self._deferred.pop(0) if self._deferred else self._jobs.get()]
+        edges = len(batch[0][1])
+        deadline = time.perf_counter() + self.MERGE_WINDOW
+        while True:
+            try:
+                item = self._jobs.get(
+                    timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            pins = {waveform.step_pin for _, waveform in batch}
+            if item[1].step_pin in pins or edges + len(item[1]) > self.max_edges:
+                # the same motor or over the pulse budget, next wave
+                self._deferred.append(item)
+                continue
+            batch.append(item)
+            edges += len(item[1])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            with self._lock:
+                for job, _ in batch:
+                    if job.cancelled:
+                        job._finish()
+                batch = [(job, waveform) for job, waveform in batch if not job.cancelled]
+                self._current = tuple(job for job, _ in batch)
+            if not batch:
+                continue
+            try:
+                self._transmit(batch)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self._current = ()
+                for job, _ in batch:
+                    if not job.end_ns:
+                        job._finish()
+
+    @staticmethod
+    def _merge(waveforms):
+        """ one waveform of the edges of all, each on its own pins """
+        if len(waveforms) == 1:
+            return waveforms[0]
+        times = np.concatenate([waveform.times_ns for waveform in waveforms])
+        order = np.argsort(times, kind="stable")
+        return Waveform(times[order],
+                        np.concatenate([waveform.pins for waveform in waveforms])[order],
+                        np.concatenate([waveform.levels for waveform in waveforms])[order],
+                        waveforms[0].step_pin)
+
+    def _transmit(self, batch):
+        pi = self.pi
+        waveform = self._merge([waveform for _, waveform in batch])
+        if len(batch) > 1:
+            self.merged += len(batch) - 1
+        for pin in set(waveform.pins.tolist()):
+            pi.set_mode(pin, self._pigpio.OUTPUT)
+        pulses = self._pulses(waveform)
+        wave_ids = []
+        try:
+            for i in range(0, len(pulses), self.MAX_PULSES):
+                pi.wave_add_generic(pulses[i:i + self.MAX_PULSES])
+                wave_ids.append(pi.wave_create())
+            start_ns = time.perf_counter_ns()
+            for job, _ in batch:
+                job.start_ns = start_ns
+            pi.wave_chain(wave_ids)
+            pending = list(batch)
+            while pi.wave_tx_busy():
+                time.sleep(self.POLL_INTERVAL)
+                # the shorter moves of a merged wave finish on their own
+                elapsed_ns = time.perf_counter_ns() - start_ns
+                for job, job_waveform in list(pending):
+                    if elapsed_ns >= job_waveform.duration_ns:
+                        self._finish(job, job_waveform, start_ns)
+                        pending.remove((job, job_waveform))
+            for job, job_waveform in pending:
+                self._finish(job, job_waveform, start_ns)
+        finally:
+            for wave_id in wave_ids:
+                pi.wave_delete(wave_id)
+
+    def _finish(self, job: PigpioJob, waveform: Waveform, start_ns):
+        job.edges = int(np.count_nonzero(waveform.pins == waveform.step_pin))
+        if time.perf_counter_ns() - start_ns < waveform.duration_ns:
+            job.edges = job.position * 2  # stopped early
+        job._finish()
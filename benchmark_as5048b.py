@@ -0,0 +1,66 @@
+"""[summary]
+Benchmark of the AS5048B encoder reads, run on the apparatus with the sensor attached.
+Compares the former read path, one read_byte_data transaction per register,
+with the block reads of apparatus.as5048b: the angle alone and the full
+snapshot of angle, magnitude, auto gain and diagnostics.
+Run from the repository root: python3 benchmark_as5048b.py [address] [seconds]
+"""
+import sys
+import time
+
+from apparatus.as5048b import (AS5048B, AS5048B_ANGLMSB_REG, AS5048B_DIAG_REG,
+                               AS5048B_GAIN_REG, AS5048B_MAGNMSB_REG, MASK_14BITS)
+
+
+def legacy_reg16(sensor, address):
+    # Copy of the former AS5048B.__readReg16, two transactions
+    bus = sensor.bus
+    chip = sensor._AS5048B__chipAddress
+    return (bus.read_byte_data(chip, address) << 6 | bus.read_byte_data(chip, address + 1)) & MASK_14BITS
+
+
+def legacy_angle(sensor):
+    return legacy_reg16(sensor, AS5048B_ANGLMSB_REG)
+
+
+def legacy_diagnostics(sensor):
+    bus = sensor.bus
+    chip = sensor._AS5048B__chipAddress
+    return (legacy_reg16(sensor, AS5048B_ANGLMSB_REG),
+            legacy_reg16(sensor, AS5048B_MAGNMSB_REG),
+            bus.read_byte_data(chip, AS5048B_GAIN_REG),
+            bus.read_byte_data(chip, AS5048B_DIAG_REG))
+
+
+def rate(func, seconds):
+    """ calls per second of func and the mean time of one call in us """
+    calls = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        func()
+        calls += 1
+    elapsed = time.perf_counter() - start
+    return calls / elapsed, elapsed / calls * 1e6
+
+
+def main():
+    address = int(sys.argv[1], 0) if len(sys.argv) > 1 else 0x40
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.
+    sensor = AS5048B(address=address)
+
+    print("AS5048B at 0x%02x, %.1f s per test" % (address, seconds))
+    for name, transactions, func in (
+            ("angle, read_byte_data", 2, lambda: legacy_angle(sensor)),
+            ("angle, block read", 1, lambda: sensor.angleR()),
+            ("angle + magnitude + gain + diag, read_byte_data",
+             6, lambda: legacy_diagnostics(sensor)),
+            ("snapshot, block read", 1, lambda: sensor.snapshot())):
+        per_second, per_call = rate(func, seconds)
+        print("%-48s transactions: %d, reads/s: %7.0f, per read: %6.1f us" % (
+            name, transactions, per_second, per_call))
+    print(sensor.snapshot(sensor.units.DEG))
+
+
+if __name__ == "__main__":
+    main()
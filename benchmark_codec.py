@@ -0,0 +1,54 @@
+"""[summary]
+Microbenchmark of the wire codecs of the client/server protocol.
+Encodes and decodes the common messages with apparatus.codec.BinaryCodec and
+the former pickle format and prints the time per message and the size.
+Run from the repository root: python3 benchmark_codec.py [seconds]
+"""
+import sys
+import time
+from datetime import datetime
+
+from apparatus.codec import CODECS
+
+MESSAGES = (
+    ("io_event", {"type": "io_event", "pin_io": 16, "name": "LEVER_TOUCHS_IO",
+                  "state": 1, "timestamp": datetime.now()}),
+    ("wait_event", {"type": "wait_event",
+                    "carousel_id": 1, "func_name": "move_to"}),
+    ("reply", {"type": "command", "success": True}),
+    ("move_to", {"type": "command", "func": "move_to", "args": {
+        "carousel_id": 0, "compartment_id": 5, "monkey": True, "blocking": False}}),
+    ("set_light", {"type": "command", "func": "set_light", "args": {
+        "color": (255, 0, 0), "timestamp": datetime.now()}}),
+    ("generic", {"type": "msg", "msg": "heartbeat"}),
+)
+
+
+def per_call(func, seconds):
+    """ mean time of one call in us """
+    calls = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        for _ in range(100):
+            func()
+        calls += 100
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else .5
+    print("%-12s %-8s %10s %10s %6s" %
+          ("message", "codec", "encode us", "decode us", "bytes"))
+    for name, message in MESSAGES:
+        for codec in CODECS.values():
+            data = codec.encode(message)
+            assert codec.decode(memoryview(data)) == message
+            encode = per_call(lambda: codec.encode(message), seconds)
+            decode = per_call(lambda: codec.decode(memoryview(data)), seconds)
+            print("%-12s %-8s %10.2f %10.2f %6d" %
+                  (name, codec.name, encode, decode, len(data)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""[summary]
+Benchmark of the receive path of the client/server protocol over loopback.
+A sender thread streams io_event like frames, each with its send time, to a
+receiver that decodes them
+  - naive: one recv for the header and one for the body, the former
+    ApparatusClient._async_recv, desynchronizes on partial reads
+  - exact: recv loops until header and body are complete, copies every piece
+  - decoder: apparatus.framing.FrameDecoder, recv_into and memoryview frames
+Burst measures the throughput, paced the latency at a fixed event rate.
+Run from the repository root: python3 benchmark_protocol.py [frames] [rate]
+"""
+import pickle
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from apparatus.framing import HEADERSIZE, FrameDecoder, encode_frame
+
+CHUNK = 7  # bytes per send in the fragmented test
+
+
+def event(i):
+    return {"type": "io_event", "pin_io": 16, "name": "LEVER_TOUCHS_IO", "state": i % 2,
+            "timestamp": datetime.now(), "sent": time.perf_counter_ns()}
+
+
+def sender(sock, frames, rate, fragment):
+    period = 1. / rate if rate else 0.
+    start = time.perf_counter()
+    for i in range(frames):
+        if period:
+            delay = start + i * period - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        msg = encode_frame(pickle.dumps(event(i)))
+        if fragment:
+            for j in range(0, len(msg), CHUNK):
+                sock.sendall(msg[j:j + CHUNK])
+        else:
+            sock.sendall(msg)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def recv_naive(sock, on_frame):
+    errors = 0
+    while True:
+        head = sock.recv(HEADERSIZE)
+        if not head:
+            return errors
+        length = int.from_bytes(head, "little", signed=False)
+        try:
+            on_frame(sock.recv(length))
+        except Exception:
+            # the stream is out of sync from here on
+            errors += 1
+
+
+def recv_exact(sock, on_frame):
+    def read(n):
+        data = b""
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+    while True:
+        head = read(HEADERSIZE)
+        if head is None:
+            return 0
+        on_frame(read(int.from_bytes(head, "little", signed=False)))
+
+
+def recv_decoder(sock, on_frame):
+    decoder = FrameDecoder()
+    while decoder.recv_from(sock):
+        for frame in decoder.frames():
+            on_frame(frame)
+    return 0
+
+
+def run(receiver, frames, rate=0, fragment=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn, _ = server.accept()
+
+    latencies = []
+
+    def on_frame(frame):
+        latencies.append(time.perf_counter_ns() - pickle.loads(frame)["sent"])
+
+    thread = threading.Thread(target=sender, args=(client, frames, rate, fragment))
+    start = time.perf_counter()
+    thread.start()
+    errors = receiver(conn, on_frame)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    for sock in (client, conn, server):
+        sock.close()
+    return len(latencies), errors, elapsed, np.array(latencies) / 1e3
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 5000.
+    receivers = (("naive", recv_naive), ("exact", recv_exact), ("decoder", recv_decoder))
+
+    print("burst, %d frames" % frames)
+    for name, receiver in receivers:
+        received, errors, elapsed, _ = run(receiver, frames)
+        print("%-8s received: %6d, errors: %5d, frames/s: %8.0f" %
+              (name, received, errors, received / elapsed))
+
+    print("fragmented in %d byte sends, %d frames" % (CHUNK, frames // 10))
+    for name, receiver in receivers:
+        received, errors, elapsed, _ = run(receiver, frames // 10, fragment=True)
+        print("%-8s received: %6d, errors: %5d, frames/s: %8.0f" %
+              (name, received, errors, received / elapsed))
+
+    print("paced at %.0f frames/s, %d frames" % (rate, frames // 10))
+    for name, receiver in receivers[1:]:
+        received, errors, elapsed, latency = run(receiver, frames // 10, rate)
+        print("%-8s latency p50: %7.1f us, p99: %7.1f us, max: %8.1f us" % (
+            name, np.percentile(latency, 50), np.percentile(latency, 99), latency.max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""[summary]
+Benchmark of the stepper pulse timing without any hardware attached.
+Compares the former per half step threading.Timer chain of NemaMotor.motor_step
+with the persistent StepGenerator thread and reports the drift of the edges
+from their planned time and the number of threads each approach needs.
+Both are also run with two axes moving at the same time, the former as two
+competing Timer chains and now as two jobs of one shared StepGenerator.
+Also measures the per step overhead of computing the acceleration profile on
+the fly against the cached delay tables of apparatus.motion_profile.
+Run from the repository root: python3 benchmark_stepper.py [steps]
+"""
+import sys
+import threading
+import time
+
+from apparatus import motion_profile
+from apparatus.stepgen import StepGenerator, StepJob
+
+
+def motor_times(step, steps):
+    # Copy of the former NemaMotor.motor_times, so RPi.GPIO is not needed here
+    import math
+    c_1, c_2, max, min = motion_profile.SIGMOID_PROFILE
+    x = step if step <= steps / 2 else steps - step - 1
+    return max + min - (((max - min) / (1 + math.exp(-c_1 * (x - c_2)))) + min)
+
+
+def motor_delays(steps):
+    return motion_profile.sigmoid_profile(steps, *motion_profile.SIGMOID_PROFILE)
+
+
+class ThreadCounter(object):
+    def __init__(self):
+        self.started = 0
+        self.peak = threading.active_count()
+        self._start = threading.Thread.start
+
+    def __enter__(self):
+        counter = self
+        original = self._start
+
+        def start(thread):
+            counter.started += 1
+            original(thread)
+            counter.peak = max(counter.peak, threading.active_count())
+        threading.Thread.start = start
+        return self
+
+    def __exit__(self, *args):
+        threading.Thread.start = self._start
+
+
+def profile_overhead(steps, repeat=20):
+    """ Per step cost of the delay lookup in ns: on the fly, cold and warm cache """
+    half_steps = 2 * steps
+
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        for i in range(half_steps):
+            motor_times(i // 2 + 1, steps)
+    on_the_fly = (time.perf_counter_ns() - start) / (repeat * half_steps)
+
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        motion_profile.sigmoid_profile.cache_clear()
+        delays = motor_delays(steps).tolist()
+        for i in range(half_steps):
+            delays[i]
+    cold = (time.perf_counter_ns() - start) / (repeat * half_steps)
+
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        delays = motor_delays(steps).tolist()
+        for i in range(half_steps):
+            delays[i]
+    warm = (time.perf_counter_ns() - start) / (repeat * half_steps)
+
+    return on_the_fly, cold, warm
+
+
+def legacy_timer_chain(delays):
+    """ Emulates the removed recursive threading.Timer implementation """
+    delays = [delay / 1e9 for delay in delays.tolist()]
+    drift = []
+    finished = threading.Event()
+    start = time.perf_counter_ns()
+
+    def edge(i, planned):
+        drift.append(time.perf_counter_ns() - planned)
+        if i + 1 < len(delays):
+            next_planned = planned + int(delays[i] * 1e9)
+            threading.Timer(delays[i], edge, args=[i + 1, next_planned]).start()
+        else:
+            finished.set()
+    edge(0, start)
+    finished.wait()
+    return drift, time.perf_counter_ns() - start
+
+
+def legacy_timer_chains(delays, axes):
+    results = [None] * axes
+
+    def run(axis):
+        results[axis] = legacy_timer_chain(delays)
+    threads = [threading.Thread(target=run, args=(axis,))
+               for axis in range(axes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [d for drift, _ in results for d in drift], max(duration for _, duration in results)
+
+
+def step_generator(delays, axes=1):
+    generator = StepGenerator(lambda pin, state: None)
+    jobs = [generator.submit(StepJob(axis, delays)) for axis in range(axes)]
+    for job in jobs:
+        job.wait()
+    generator.stop()
+    return jobs, generator.jitter_report()
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 2880  # 180 deg
+    for profile_steps in (steps, 360, 2880):  # 1/16 and 1/2 rotation
+        print("profile %d steps, per half step: motor_times %.0f ns, cold cache %.0f ns, warm cache %.0f ns" % (
+            (profile_steps,) + profile_overhead(profile_steps)))
+    print(motion_profile.cache_info())
+
+    delays = motor_delays(steps)
+    print("steps: %d, edges: %d, planned duration: %.3f s" %
+          (steps, len(delays), delays[:-1].sum() / 1e9))
+
+    for axes in (1, 2):
+        print("--- %d axis" % axes)
+        with ThreadCounter() as counter:
+            drift, duration = legacy_timer_chains(delays, axes)
+        drift_abs = [abs(d) for d in drift]
+        print("threading.Timer chain: threads started: %d, peak alive: %d, drift mean: %.1f us, drift max: %.1f us, duration: %.3f s" % (
+            counter.started, counter.peak,
+            sum(drift_abs) / len(drift_abs) / 1000, max(drift_abs) / 1000,
+            duration / 1e9))
+
+        with ThreadCounter() as counter:
+            jobs, jitter = step_generator(delays, axes)
+        edges = sum(job.edges for job in jobs)
+        print("StepGenerator:         threads started: %d, peak alive: %d, drift mean: %.1f us, drift max: %.1f us, duration: %.3f s" % (
+            counter.started, counter.peak,
+            sum(job.drift_sum_ns for job in jobs) / edges / 1000,
+            max(job.drift_max_ns for job in jobs) / 1000,
+            max(job.end_ns - job.start_ns for job in jobs) / 1e9))
+        for active, (edges, mean, max_drift) in jitter.items():
+            print("StepGenerator jitter with %d axes moving: edges: %d, drift mean: %.1f us, drift max: %.1f us" % (
+                active, edges, mean, max_drift))
+
+
+if __name__ == "__main__":
+    main()
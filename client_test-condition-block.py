@@ -375,16 +375,12 @@ for trial_id in range(0, 16):
     timestamp += timedelta(seconds=max(PRETRIAL_LIGHT_TIME -
                            SYCHRONISATION_DELAY, 0))
 
-    apparatus_left.set_test_light(True, timestamp=timestamp)
-    apparatus_right.set_test_light(True, timestamp=timestamp)
-    apparatus_left.set_lever_open(True, timestamp=timestamp)
-    apparatus_right.set_lever_open(True, timestamp=timestamp)
-    apparatus_left.play_sound("on-status.mp3",
-                              volume=VOLUME,
-                              timestamp=timestamp)
-    apparatus_right.play_sound("on-status.mp3",
-                               volume=VOLUME,
-                               timestamp=timestamp)
+    # one frame per rig, light, lever and sound run together at timestamp
+    for rig in (apparatus_left, apparatus_right):
+        with rig.batch(timestamp):
+            rig.set_test_light(True)
+            rig.set_lever_open(True)
+            rig.play_sound("on-status.mp3", volume=VOLUME)
 
     util.wait_till(timestamp)
     csv_logger.write(trial_nr=trial_id+1,
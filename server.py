@@ -31,6 +31,8 @@ def main():
                     help="file to read for mcu protocol dictionary")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
+    opts.add_option("-c", "--calibrate", action="store_true", dest="calibrate",
+                    help="calibrate the carousels, write the calibration file and exit")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
@@ -71,6 +73,13 @@ def main():
     config.apparatus_hw = Apparatus()
     config.apparatus_hw.init_hw()
 
+    if options.calibrate:
+        config.apparatus_hw.calibrate()
+        config.apparatus_hw.cleanup()
+        if bglogger is not None:
+            bglogger.stop()
+        return
+
     server = socketserver.TCPServer(
         ('', config.apparatus['port']), Handler,)
     logging.info('The server is running...')